@@ -0,0 +1,283 @@
+import os
+import sys
+import copy
+import atexit
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# ====================================================================
+# 単一ファイル (SQLite) のキー・値キャッシュ
+# --------------------------------------------------------------------
+# ・値は JSON にシリアライズして保存する
+# ・件数 / 合計バイト数 / 経過時間 (TTL) による LRU 追い出し
+# ・namespace でキャッシュの用途 (LLM応答、検索結果など) を分けて同じファイルに同居できる
+# ・get() の最終アクセス時刻はまとめて書き込む (読み込みのたびにコミットしない)
+# ====================================================================
+
+ACCESS_FLUSH_ITEMS = 256   # 最終アクセス時刻をこの件数たまるごとにファイルへ書き込む
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    namespace   TEXT    NOT NULL,
+    key         TEXT    NOT NULL,
+    value       TEXT    NOT NULL,
+    size        INTEGER NOT NULL,
+    created_at  REAL    NOT NULL,
+    accessed_at REAL    NOT NULL,
+    expires_at  REAL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS idx_cache_entries_accessed ON cache_entries (namespace, accessed_at);
+"""
+
+def make_cache_key(*parts: Any) -> str:
+    """
+    任意の値 (辞書・リストを含む) から正規化したハッシュキーを作る。(純粋)
+    辞書のキー順の違いでキーが変わらないよう、sort_keys で JSON 化してからハッシュする。
+    """
+    canonical = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class SQLiteCache:
+    """
+    SQLite 1ファイルに保存する LRU キャッシュ。
+    複数スレッドから共有でき、プロセスが落ちても書き込み済みのエントリは次回起動時に再利用されます。
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        namespace: str = "default",
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        ttl_sec: Optional[float] = None,
+        memory_items: int = 0
+    ):
+        """
+        db_path: キャッシュファイルのパス
+        namespace: 同一ファイル内での用途の区別
+        max_entries / max_bytes: 超過時に最終アクセスが古い順に削除 (None で無制限)
+        ttl_sec: 作成からこの秒数を過ぎたエントリは無効 (None で無期限)。set() でエントリ毎に上書き可能
+        memory_items: 直近に使ったエントリをメモリ上にも保持する件数 (0 で無効)
+        get() が返す値はキャッシュ内の値のコピーなので、変更してもキャッシュには影響しません。
+        """
+        self.db_path = db_path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self.memory_items = memory_items
+        self._memory: "OrderedDict[str, Tuple[Optional[float], Any]]" = OrderedDict()  # キー -> (有効期限, 値)
+        self._pending_access: Dict[str, float] = {}  # キー -> まだ書き込んでいない最終アクセス時刻
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        # WAL: 読み込みと書き込みを並行でき、途中終了してもファイルが壊れにくい
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(cache_entries)")}
+        if "expires_at" not in columns:
+            # エントリ毎のTTLに対応する前に作成されたファイル
+            self._connection.execute("ALTER TABLE cache_entries ADD COLUMN expires_at REAL")
+        self._connection.commit()
+        self._closed = False
+        atexit.register(self.close)
+
+    @staticmethod
+    def _is_expired(expires_at: Optional[float], now: float) -> bool:
+        return expires_at is not None and now > expires_at
+
+    def _remember(self, key: str, expires_at: Optional[float], value: Any):
+        if self.memory_items <= 0:
+            return
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _touch_locked(self, key: str, now: float):
+        """最終アクセス時刻を記録する。ファイルへは ACCESS_FLUSH_ITEMS 件ごと、または追い出し・終了時にまとめて書き込む"""
+        self._pending_access[key] = now
+        if len(self._pending_access) >= ACCESS_FLUSH_ITEMS:
+            self._flush_access_locked()
+            self._connection.commit()
+
+    def _flush_access_locked(self):
+        if not self._pending_access:
+            return
+        self._connection.executemany(
+            "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+            [(accessed_at, self.namespace, key) for key, accessed_at in self._pending_access.items()]
+        )
+        self._pending_access.clear()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """キーに対応する値のコピーを返す。無い・期限切れの場合は default を返す。"""
+        now = time.time()
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None and not self._is_expired(cached[0], now):
+                self._memory.move_to_end(key)
+                self._touch_locked(key, now)
+                return copy.deepcopy(cached[1])
+
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+            ).fetchone()
+            if row is None:
+                return default
+            value_text, expires_at = row
+            if self._is_expired(expires_at, now):
+                self._delete_locked(key)
+                return default
+            self._touch_locked(key, now)
+
+        try:
+            value = json.loads(value_text)
+        except json.JSONDecodeError:
+            print(f"キャッシュの値が壊れているため破棄します: {key}", file=sys.stderr)
+            self.delete(key)
+            return default
+        with self._lock:
+            self._remember(key, expires_at, value)
+        return copy.deepcopy(value) if self.memory_items > 0 else value
+
+    def set(self, key: str, value: Any, ttl_sec: Optional[float] = None):
+        """
+        値を保存し、制限を超えた分を LRU で追い出す。
+        ttl_sec を指定するとこのエントリだけ有効期間を変更します (省略時はインスタンスの ttl_sec)。
+        """
+        value_text = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        ttl_sec = ttl_sec if ttl_sec is not None else self.ttl_sec
+        expires_at = now + ttl_sec if ttl_sec is not None else None
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache_entries (namespace, key, value, size, created_at, accessed_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.namespace, key, value_text, len(value_text.encode("utf-8")), now, now, expires_at)
+            )
+            self._pending_access.pop(key, None)
+            # 呼び出し側が後から value を変更してもキャッシュに影響しないよう、保存した JSON から復元した値を保持する
+            self._remember(key, expires_at, json.loads(value_text) if self.memory_items > 0 else None)
+            self._evict_locked(now)
+            self._connection.commit()
+
+    def set_many(self, items: Dict[str, Any], ttl_sec: Optional[float] = None):
+        """複数の値を1トランザクションで保存する (既存データの一括取り込み用)"""
+        now = time.time()
+        ttl_sec = ttl_sec if ttl_sec is not None else self.ttl_sec
+        expires_at = now + ttl_sec if ttl_sec is not None else None
+        rows = []
+        for key, value in items.items():
+            value_text = json.dumps(value, ensure_ascii=False)
+            rows.append((self.namespace, key, value_text, len(value_text.encode("utf-8")), now, now, expires_at))
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO cache_entries (namespace, key, value, size, created_at, accessed_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self._evict_locked(now)
+            self._connection.commit()
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+
+    def _delete_locked(self, key: str):
+        self._memory.pop(key, None)
+        self._pending_access.pop(key, None)
+        self._connection.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (self.namespace, key)
+        )
+        self._connection.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._delete_locked(key)
+
+    def clear(self):
+        """この namespace のエントリをすべて削除する"""
+        with self._lock:
+            self._memory.clear()
+            self._pending_access.clear()
+            self._connection.execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,))
+            self._connection.commit()
+
+    def _evict_locked(self, now: float):
+        """期限切れ → 件数超過 → バイト数超過 の順に、最終アクセスが古いものから削除する"""
+        self._flush_access_locked()
+        changes_before = self._connection.total_changes
+        self._connection.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND expires_at IS NOT NULL AND expires_at < ?",
+            (self.namespace, now)
+        )
+
+        if self.max_entries is not None:
+            self._connection.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND key IN ("
+                "  SELECT key FROM cache_entries WHERE namespace = ?"
+                "  ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.namespace, self.namespace, max(0, self.max_entries))
+            )
+
+        if self.max_bytes is not None:
+            total = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM cache_entries WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+            if total > self.max_bytes:
+                rows = self._connection.execute(
+                    "SELECT key, size FROM cache_entries WHERE namespace = ? ORDER BY accessed_at ASC",
+                    (self.namespace,)
+                ).fetchall()
+                victims = []
+                for key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    victims.append((self.namespace, key))
+                    total -= size
+                self._connection.executemany(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key = ?", victims
+                )
+
+        if self._connection.total_changes != changes_before:
+            # 追い出しが発生した場合はメモリ側も作り直す (次回アクセス時にファイルから読み直す)
+            self._memory.clear()
+
+    def flush(self):
+        """まだ書き込んでいない最終アクセス時刻をファイルに書き込む"""
+        with self._lock:
+            if self._closed:
+                return
+            self._flush_access_locked()
+            self._connection.commit()
+
+    def close(self):
+        """最終アクセス時刻を書き込んでから閉じる (終了時にも自動で呼ばれます)"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._flush_access_locked()
+            self._connection.commit()
+            self._connection.close()
+        atexit.unregister(self.close)
+
+
+_MISSING = object()
@@ -0,0 +1,241 @@
+import os
+import sys
+import csv
+import io
+from collections import Counter
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+# --- パス設定 ---
+source_directory = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(source_directory, "..", ".."))
+sys.path.insert(0, project_root)
+
+from Sources.Common import LLM_Control
+
+# ====================================================================
+# CSV の列プロファイル
+# --------------------------------------------------------------------
+# 全行をテキスト化してLLMに渡す代わりに、ファイルを1回だけ分割読み込みして
+# 列ごとの統計 (型・欠損率・最頻値・分位点) と層化サンプルを作り、コンパクトな参照データにする
+# ====================================================================
+
+PROFILE_CHUNK_ROWS = 100000       # pandas で一度に読み込む行数
+PROFILE_SAMPLE_ROWS = 60          # 参照データに含めるサンプル行数
+PROFILE_TOP_VALUES = 5            # 列ごとに表示する最頻値の数
+PROFILE_RESERVOIR_SIZE = 20000    # 分位点計算のために保持する数値の件数 (列ごと)
+PROFILE_MAX_TRACKED_VALUES = 20000  # 最頻値の集計で保持する値の種類数の上限 (超過時は少ないものから間引く)
+PROFILE_MAX_STRATA = 30           # 自動で層化に使う列の最大カテゴリ数
+PROFILE_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def _reservoir_update(reservoir: np.ndarray, keys: np.ndarray, values: np.ndarray, rng: np.random.Generator, size: int):
+    """
+    乱数キーの小さい順に size 件を残すことで、一様な無作為抽出 (リザーバーサンプリング) をまとめて更新する。(純粋)
+    戻り値は (新しいリザーバー, 新しいキー)。
+    """
+    new_keys = rng.random(len(values))
+    all_values = np.concatenate([reservoir, values])
+    all_keys = np.concatenate([keys, new_keys])
+    if len(all_values) <= size:
+        return all_values, all_keys
+    keep = np.argpartition(all_keys, size - 1)[:size]
+    return all_values[keep], all_keys[keep]
+
+
+class _ColumnStats:
+    """1列分の集計 (チャンクごとに update し、最後に summary を作る)"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.numeric_count = 0
+        self.integer_like = True
+        self.total = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.reservoir = np.empty(0, dtype=np.float64)
+        self.reservoir_keys = np.empty(0, dtype=np.float64)
+        self.value_counts: Counter = Counter()
+        self.pruned = False
+        self.max_length = 0
+
+    def update(self, series: pd.Series, rng: np.random.Generator):
+        self.count += len(series)
+        stripped = series.str.strip()
+        non_null = stripped[stripped.notna() & (stripped != "")]
+        self.nulls += len(series) - len(non_null)
+        if non_null.empty:
+            return
+
+        numeric = pd.to_numeric(non_null, errors="coerce")
+        numeric_values = numeric[numeric.notna()].to_numpy(dtype=np.float64)
+        if len(numeric_values):
+            self.numeric_count += len(numeric_values)
+            self.integer_like = self.integer_like and bool(np.all(np.mod(numeric_values, 1) == 0))
+            self.total += float(numeric_values.sum())
+            self.minimum = min(self.minimum, float(numeric_values.min()))
+            self.maximum = max(self.maximum, float(numeric_values.max()))
+            self.reservoir, self.reservoir_keys = _reservoir_update(
+                self.reservoir, self.reservoir_keys, numeric_values, rng, PROFILE_RESERVOIR_SIZE
+            )
+
+        self.value_counts.update(non_null.value_counts().to_dict())
+        self.max_length = max(self.max_length, int(non_null.str.len().max()))
+        if len(self.value_counts) > PROFILE_MAX_TRACKED_VALUES:
+            # 種類数が多すぎる列は出現回数の少ない値を間引く (最頻値は近似になる)
+            self.value_counts = Counter(dict(self.value_counts.most_common(PROFILE_MAX_TRACKED_VALUES // 2)))
+            self.pruned = True
+
+    def summary(self) -> Dict[str, Any]:
+        non_null = self.count - self.nulls
+        result: Dict[str, Any] = {
+            "name": self.name,
+            "null_rate": self.nulls / self.count if self.count else 0.0,
+            "distinct": len(self.value_counts),
+            "distinct_is_lower_bound": self.pruned,
+            "top_values": self.value_counts.most_common(PROFILE_TOP_VALUES),
+        }
+        if non_null and self.numeric_count / non_null >= 0.95:
+            result["type"] = "integer" if self.integer_like else "float"
+            result["min"] = self.minimum
+            result["max"] = self.maximum
+            result["mean"] = self.total / self.numeric_count
+            result["quantiles"] = (
+                dict(zip(PROFILE_QUANTILES, np.quantile(self.reservoir, PROFILE_QUANTILES).tolist()))
+                if len(self.reservoir) else {}
+            )
+        else:
+            result["type"] = "text" if non_null else "empty"
+            result["max_length"] = self.max_length
+        return result
+
+
+def _choose_stratify_column(first_chunk: pd.DataFrame) -> Optional[str]:
+    """カテゴリ数が少ない (2〜PROFILE_MAX_STRATA) 非数値の列のうち、欠損が最も少ない列を層化に使う"""
+    best, best_non_null = None, -1
+    for column in first_chunk.columns:
+        values = first_chunk[column].str.strip()
+        values = values[values.notna() & (values != "")]
+        if values.empty or pd.to_numeric(values, errors="coerce").notna().mean() > 0.5:
+            continue
+        distinct = values.nunique()
+        if 2 <= distinct <= PROFILE_MAX_STRATA and len(values) > best_non_null:
+            best, best_non_null = column, len(values)
+    return best
+
+
+def profile_csv(
+    file_path: str,
+    stratify_column: Optional[str] = None,
+    sample_rows: int = PROFILE_SAMPLE_ROWS,
+    chunk_rows: int = PROFILE_CHUNK_ROWS,
+    seed: int = 0
+) -> Dict[str, Any]:
+    """
+    CSVファイルを分割読み込みで1回だけ走査し、列ごとの統計と層化サンプルを返します。
+    stratify_column を省略した場合は、カテゴリ数の少ない列を自動で選びます (無ければ単純無作為抽出)。
+    エンコーディングは先頭サンプルではなくファイル全体で確かめ、デコードできないバイトは捨てずに置換文字にします。
+    """
+    encoding = LLM_Control.detect_full_file_encoding(file_path)
+    rng = np.random.default_rng(seed)
+    columns: Dict[str, _ColumnStats] = {}
+    strata_samples: Dict[str, pd.DataFrame] = {}
+    total_rows = 0
+
+    reader = pd.read_csv(
+        file_path, dtype=str, keep_default_na=False, encoding=encoding, encoding_errors="replace",
+        chunksize=chunk_rows, on_bad_lines="skip", engine="c"
+    )
+    for chunk in reader:
+        if not columns:
+            columns = {column: _ColumnStats(str(column)) for column in chunk.columns}
+            if stratify_column is None:
+                stratify_column = _choose_stratify_column(chunk)
+            elif stratify_column not in chunk.columns:
+                print(f"警告: 層化列 '{stratify_column}' が見つかりません。単純無作為抽出にします。", file=sys.stderr)
+                stratify_column = None
+
+        total_rows += len(chunk)
+        for column, stats in columns.items():
+            stats.update(chunk[column], rng)
+
+        # 層 (カテゴリ) ごとに乱数キーの小さい行を残す
+        keyed = chunk.assign(_sample_key=rng.random(len(chunk)))
+        groups = keyed.groupby(stratify_column, sort=False) if stratify_column else [("全体", keyed)]
+        for stratum, group in groups:
+            stratum = str(stratum)
+            merged = pd.concat([strata_samples[stratum], group]) if stratum in strata_samples else group
+            strata_samples[stratum] = merged.nsmallest(sample_rows, "_sample_key")
+
+    # 層ごとの件数を均等に割り当て、余った枠は残りの候補から無作為に埋める
+    per_stratum = max(1, sample_rows // max(1, len(strata_samples)))
+    sample_frames = [frame.nsmallest(per_stratum, "_sample_key") for frame in strata_samples.values()]
+    sample = pd.concat(sample_frames) if sample_frames else pd.DataFrame()
+    if len(sample) < sample_rows and strata_samples:
+        rest = pd.concat(strata_samples.values())
+        rest = rest[~rest.index.isin(sample.index)]
+        sample = pd.concat([sample, rest.nsmallest(sample_rows - len(sample), "_sample_key")])
+    sample = sample.sort_index().drop(columns="_sample_key", errors="ignore").head(sample_rows)
+
+    return {
+        "file": os.path.basename(file_path),
+        "encoding": encoding,
+        "rows": total_rows,
+        "columns": [stats.summary() for stats in columns.values()],
+        "stratify_column": stratify_column,
+        "strata": len(strata_samples),
+        "sample": sample,
+    }
+
+
+def _format_number(value: float) -> str:
+    return f"{value:.6g}"
+
+def format_csv_profile(profile: Dict[str, Any]) -> str:
+    """profile_csv の結果をLLMに渡す参照テキストに整形する。(純粋)"""
+    lines = [
+        f"[CSVプロファイル] {profile['file']}",
+        f"行数: {profile['rows']} / 列数: {len(profile['columns'])} / 文字コード: {profile['encoding']}",
+        "",
+        "## 列の統計",
+    ]
+    for column in profile["columns"]:
+        distinct = f"{'≥' if column['distinct_is_lower_bound'] else ''}{column['distinct']}"
+        parts = [f"- {column['name']} ({column['type']})", f"欠損 {column['null_rate']:.1%}", f"種類数 {distinct}"]
+        if column["type"] in ("integer", "float"):
+            parts.append(
+                f"最小 {_format_number(column['min'])} / 平均 {_format_number(column['mean'])} / 最大 {_format_number(column['max'])}"
+            )
+            if column["quantiles"]:
+                parts.append("分位点 " + ", ".join(
+                    f"p{int(q * 100)}={_format_number(v)}" for q, v in column["quantiles"].items()
+                ))
+        else:
+            parts.append(f"最大文字数 {column['max_length']}")
+        if column["top_values"]:
+            parts.append("最頻値 " + ", ".join(f"{value[:40]}({count})" for value, count in column["top_values"]))
+        lines.append(" / ".join(parts))
+
+    sample: pd.DataFrame = profile["sample"]
+    if not sample.empty:
+        basis = f"{profile['stratify_column']} の {profile['strata']} 区分から層化抽出" if profile["stratify_column"] else "無作為抽出"
+        lines += ["", f"## サンプル行 ({len(sample)} 行, {basis})"]
+        buffer = io.StringIO()
+        sample.to_csv(buffer, index=False, quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
+        lines.append(buffer.getvalue().rstrip("\n"))
+    return "\n".join(lines)
+
+def read_csv_profile_text(file_path: str, stratify_column: Optional[str] = None, sample_rows: int = PROFILE_SAMPLE_ROWS) -> str:
+    """CSVを列プロファイル + 層化サンプルのテキストとして読み込む (read_csv_with_auto_encoding の代替)"""
+    try:
+        profile = profile_csv(file_path, stratify_column=stratify_column, sample_rows=sample_rows)
+    except Exception as e:
+        print(f"エラー: CSVのプロファイル作成に失敗しました: {e}", file=sys.stderr)
+        return ""
+    text = format_csv_profile(profile)
+    print(f"{file_path}: {profile['rows']} 行をプロファイル化しました ({len(text)} 文字)", file=sys.stderr)
+    return text
@@ -0,0 +1,472 @@
+import re
+import json
+import codecs
+from json.decoder import scanstring
+from json.scanner import NUMBER_RE
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union, BinaryIO, TextIO
+
+# ====================================================================
+# ストリーミング JSON 検証
+# --------------------------------------------------------------------
+# LLM の出力をトークン到着ごとに1文字ずつ読み進め、JSON の文法と JSON Schema の主要な制約
+# (type / required / properties / additionalProperties / items / minLength など) を検証する。
+# 出力が回復不能になった時点 (文法違反・スキーマ違反) で error を設定するので、
+# 呼び出し側は生成を中断して、そのチャンクだけを再実行できる。
+# anyOf / oneOf / $ref など未対応のキーワードを含む部分は検証しない (誤って中断しないため)。
+# ====================================================================
+
+_CODE_FENCE = "```"
+_CODE_FENCE_OPEN = "```json"
+_WHITESPACE = " \t\r\n"
+_NUMBER_CHARS = set("0123456789+-.eE")
+_WORD_LITERALS = ("true", "false", "null")
+_NUMBER_PATTERN = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?")
+_STRING_ESCAPES = set('"\\/bfnrtu')
+_UNSUPPORTED_KEYWORDS = ("anyOf", "oneOf", "allOf", "not", "$ref", "if")
+_VALUE_TYPES = {"{": "object", "[": "array", '"': "string", "t": "boolean", "f": "boolean", "n": "null"}
+
+
+def _normalize_schema(schema: Any) -> Dict[str, Any]:
+    """検証に使うスキーマを返す。未対応のキーワードを含む場合は制約なし ({}) として扱う。(純粋)"""
+    if not isinstance(schema, dict) or any(keyword in schema for keyword in _UNSUPPORTED_KEYWORDS):
+        return {}
+    return schema
+
+def _allowed_types(schema: Dict[str, Any]) -> Optional[set]:
+    """スキーマで許可された型の集合 (指定なしは None)。integer は number の一種として扱う。(純粋)"""
+    types = schema.get("type")
+    if types is None:
+        return None
+    return {types} if isinstance(types, str) else set(types)
+
+
+class _Frame:
+    """入れ子の1段分 (ルート・オブジェクト・配列) の状態"""
+    __slots__ = ("kind", "schema", "expect", "keys", "key", "count")
+
+    def __init__(self, kind: str, schema: Dict[str, Any], expect: str):
+        self.kind = kind        # "root" / "object" / "array"
+        self.schema = schema
+        self.expect = expect    # 次に来るべきもの ("value", "key", "colon", "comma_or_end" など)
+        self.keys: set = set()
+        self.key: Optional[str] = None
+        self.count = 0
+
+    def child_schema(self) -> Dict[str, Any]:
+        if self.kind == "root":
+            return self.schema
+        if self.kind == "array":
+            return _normalize_schema(self.schema.get("items", {}))
+        properties = self.schema.get("properties", {})
+        if self.key in properties:
+            return _normalize_schema(properties[self.key])
+        return _normalize_schema(self.schema.get("additionalProperties", {}))
+
+
+class StreamingJsonValidator:
+    """
+    LLM の出力を feed() で少しずつ渡し、JSON として回復不能になったかを判定する。
+    出力前後の ```json ～ ``` のコードフェンスは許容します。
+    """
+
+    def __init__(self, schema: Optional[Dict[str, Any]] = None):
+        self.error: Optional[str] = None
+        self.done = False
+        self._stack: List[_Frame] = [_Frame("root", _normalize_schema(schema or {}), "value")]
+        self._state = "prefix"      # prefix: 値の前 / value: 値の途中 / suffix: ルートの値が閉じた後
+        self._affix = ""            # 値の前後のコードフェンスの読み込み途中の文字
+        self._in_string = False
+        self._string_chars: List[str] = []
+        self._string_is_key = False
+        self._string_schema: Dict[str, Any] = {}
+        self._escape = ""           # 読み込み途中のエスケープシーケンス
+        self._literal: Optional[List[str]] = None
+        self._literal_schema: Dict[str, Any] = {}
+        self.position = 0
+
+    # --- 公開API ---
+    def feed(self, text: str) -> bool:
+        """テキスト片を読み進め、まだ回復可能なら True、回復不能になったら False を返す"""
+        for ch in text:
+            if self.error is not None:
+                return False
+            self._feed_char(ch)
+            self.position += 1
+        return self.error is None
+
+    def finish(self) -> bool:
+        """出力の終端で呼び、ルートの値が完結していれば True を返す"""
+        if self.error is None and self._literal is not None:
+            self._finish_literal()
+        if self.error is None and not self.done:
+            self._fail("JSONが途中で終了しています")
+        return self.error is None
+
+    # --- 内部処理 ---
+    def _fail(self, message: str):
+        if self.error is None:
+            self.error = f"{message} (位置 {self.position})"
+
+    def _feed_char(self, ch: str):
+        if self._in_string:
+            self._string_char(ch)
+            return
+        if self._literal is not None:
+            if self._literal_continues(ch):
+                self._literal.append(ch)
+                self._check_word_prefix()
+                return
+            self._finish_literal()
+            if self.error is not None:
+                return
+
+        if self._state == "prefix":
+            if _CODE_FENCE_OPEN.startswith(self._affix + ch):
+                self._affix += ch
+                return
+            if ch in _WHITESPACE and self._affix in ("", _CODE_FENCE, _CODE_FENCE_OPEN):
+                return
+            if self._affix not in ("", _CODE_FENCE, _CODE_FENCE_OPEN):
+                self._fail("JSONの前に余分なテキストがあります")
+                return
+            self._state = "value"
+        elif self._state == "suffix":
+            if ch in _WHITESPACE and self._affix in ("", _CODE_FENCE):
+                return
+            if _CODE_FENCE.startswith(self._affix + ch):
+                self._affix += ch
+                return
+            self._fail("JSONの後に余分なテキストがあります")
+            return
+
+        if ch in _WHITESPACE:
+            return
+        frame = self._stack[-1]
+        expect = frame.expect
+
+        if expect in ("value", "value_or_end"):
+            if expect == "value_or_end" and ch == "]":
+                self._close_container(frame)
+                return
+            frame.expect = "comma_or_end"
+            self._start_value(ch, frame.child_schema())
+        elif expect in ("key", "key_or_end"):
+            if expect == "key_or_end" and ch == "}":
+                self._close_container(frame)
+            elif ch == '"':
+                self._start_string(is_key=True, schema={})
+            else:
+                self._fail(f"オブジェクトのキーが必要な位置に '{ch}' があります")
+        elif expect == "colon":
+            if ch == ":":
+                frame.expect = "value"
+            else:
+                self._fail(f"':' が必要な位置に '{ch}' があります")
+        elif expect == "comma_or_end":
+            closing = "}" if frame.kind == "object" else "]"
+            if ch == ",":
+                frame.expect = "key" if frame.kind == "object" else "value"
+            elif ch == closing:
+                self._close_container(frame)
+            else:
+                self._fail(f"',' または '{closing}' が必要な位置に '{ch}' があります")
+
+    def _start_value(self, ch: str, schema: Dict[str, Any]):
+        value_type = _VALUE_TYPES.get(ch)
+        if value_type is None and (ch == "-" or ch.isdigit()):
+            value_type = "number"
+        if value_type is None:
+            self._fail(f"値の開始として不正な文字 '{ch}' があります")
+            return
+
+        allowed = _allowed_types(schema)
+        if allowed is not None and value_type not in allowed and not (value_type == "number" and "integer" in allowed):
+            self._fail(f"型が一致しません (期待: {sorted(allowed)}, 出力: {value_type})")
+            return
+
+        if ch == "{":
+            self._stack.append(_Frame("object", schema, "key_or_end"))
+        elif ch == "[":
+            self._stack.append(_Frame("array", schema, "value_or_end"))
+        elif ch == '"':
+            self._start_string(is_key=False, schema=schema)
+        else:
+            self._literal = [ch]
+            self._literal_schema = schema
+            self._check_word_prefix()
+
+    def _value_completed(self):
+        """値が1つ閉じた。親が配列なら件数を数え、ルートなら検証完了とする"""
+        parent = self._stack[-1]
+        parent.count += 1
+        if parent.kind == "root":
+            self.done = True
+            self._state = "suffix"
+            self._affix = ""
+
+    def _close_container(self, frame: _Frame):
+        schema = frame.schema
+        if frame.kind == "object":
+            missing = [key for key in schema.get("required", []) if key not in frame.keys]
+            if missing:
+                self._fail(f"必須キーがありません: {', '.join(missing)}")
+                return
+        elif frame.count < schema.get("minItems", 0):
+            self._fail(f"配列の要素数が不足しています ({frame.count} < {schema['minItems']})")
+            return
+        self._stack.pop()
+        self._value_completed()
+
+    # --- 文字列 ---
+    def _start_string(self, is_key: bool, schema: Dict[str, Any]):
+        self._in_string = True
+        self._string_is_key = is_key
+        self._string_schema = schema
+        self._string_chars = []
+        self._escape = ""
+
+    def _string_char(self, ch: str):
+        if self._escape:
+            if self._escape == "\\":
+                if ch not in _STRING_ESCAPES:
+                    self._fail(f"不正なエスケープ '\\{ch}' があります")
+                    return
+                self._escape = "\\u" if ch == "u" else ""
+                if not self._escape:
+                    self._string_chars.append(ch)
+                return
+            if ch not in "0123456789abcdefABCDEF":
+                self._fail("不正な \\u エスケープがあります")
+                return
+            self._escape += ch
+            if len(self._escape) == 6:
+                self._string_chars.append(chr(int(self._escape[2:], 16)))
+                self._escape = ""
+            return
+        if ch == "\\":
+            self._escape = "\\"
+        elif ch == '"':
+            self._in_string = False
+            self._finish_string("".join(self._string_chars))
+        elif ch < " ":
+            self._fail("文字列の中に制御文字 (改行など) がそのまま含まれています")
+        else:
+            self._string_chars.append(ch)
+
+    def _finish_string(self, value: str):
+        if self._string_is_key:
+            frame = self._stack[-1]
+            properties = frame.schema.get("properties", {})
+            if frame.schema.get("additionalProperties") is False and value not in properties:
+                self._fail(f"スキーマに無いキー '{value}' があります")
+                return
+            frame.keys.add(value)
+            frame.key = value
+            frame.expect = "colon"
+            return
+
+        schema = self._string_schema
+        if len(value) < schema.get("minLength", 0):
+            self._fail(f"文字列が短すぎます (minLength {schema['minLength']})")
+            return
+        if "maxLength" in schema and len(value) > schema["maxLength"]:
+            self._fail(f"文字列が長すぎます (maxLength {schema['maxLength']})")
+            return
+        if "enum" in schema and value not in schema["enum"]:
+            self._fail(f"enum に無い値 '{value[:40]}' があります")
+            return
+        self._value_completed()
+
+    # --- 数値・true/false/null ---
+    def _literal_continues(self, ch: str) -> bool:
+        if self._literal[0] in "tfn":
+            return ch.isalpha()
+        return ch in _NUMBER_CHARS
+
+    def _check_word_prefix(self):
+        word = "".join(self._literal)
+        if word[0] in "tfn" and not any(literal.startswith(word) for literal in _WORD_LITERALS):
+            self._fail(f"不正なリテラル '{word}' があります")
+
+    def _finish_literal(self):
+        word = "".join(self._literal)
+        schema = self._literal_schema
+        self._literal = None
+        if word[0] in "tfn":
+            if word not in _WORD_LITERALS:
+                self._fail(f"不正なリテラル '{word}' があります")
+                return
+        else:
+            if not _NUMBER_PATTERN.fullmatch(word):
+                self._fail(f"不正な数値 '{word}' があります")
+                return
+            number = float(word)
+            allowed = _allowed_types(schema)
+            if allowed is not None and "number" not in allowed and not number.is_integer():
+                self._fail(f"整数が必要な位置に '{word}' があります")
+                return
+            if "minimum" in schema and number < schema["minimum"]:
+                self._fail(f"数値が小さすぎます ({word} < {schema['minimum']})")
+                return
+            if "maximum" in schema and number > schema["maximum"]:
+                self._fail(f"数値が大きすぎます ({word} > {schema['maximum']})")
+                return
+        self._value_completed()
+
+
+def build_validator(format: Any) -> Optional[StreamingJsonValidator]:
+    """
+    answer_question の format から検証器を作る。
+    "json" の場合は文法のみ、スキーマ (辞書) の場合はスキーマも検証し、それ以外は None を返す。
+    """
+    if format == "json":
+        return StreamingJsonValidator()
+    if isinstance(format, dict):
+        return StreamingJsonValidator(format)
+    return None
+
+def validate_json_text(text: str, schema: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """出力全体を検証し、問題があればエラー内容、無ければ None を返す。(純粋)"""
+    validator = StreamingJsonValidator(schema)
+    validator.feed(text)
+    validator.finish()
+    return validator.error
+
+
+# ====================================================================
+# JSON のイベント列 (逐次パーサー)
+# --------------------------------------------------------------------
+# バイト列 / テキストのストリームを少しずつ読み、木全体を作らずに
+# ("start_map" | "end_map" | "start_array" | "end_array" | "key" | "value", 値) のイベントを順に返す
+# ====================================================================
+
+STREAM_READ_SIZE = 64 * 1024
+_WHITESPACE_PATTERN = re.compile(r"[ \t\n\r]*")
+_SCALAR_CHARS_PATTERN = re.compile(r"[-+.0-9a-zA-Z]*")
+_LITERAL_VALUES = {"true": True, "false": False, "null": None}
+
+JsonSource = Union[str, bytes, BinaryIO, TextIO, Iterable[Union[str, bytes]]]
+
+def _iter_text_pieces(source: JsonSource, read_size: int = STREAM_READ_SIZE) -> Iterator[str]:
+    """ファイルオブジェクト・バイト列/文字列の反復可能オブジェクトを、テキスト片の列にする (UTF-8, BOM可)"""
+    if isinstance(source, (str, bytes)):
+        source = [source]
+    elif hasattr(source, "read"):
+        reader = source
+        source = iter(lambda: reader.read(read_size), reader.read(0))
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    for piece in source:
+        if isinstance(piece, (bytes, bytearray, memoryview)):
+            piece = decoder.decode(bytes(piece))
+        if piece:
+            yield piece
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+def iter_json_events(source: JsonSource, read_size: int = STREAM_READ_SIZE) -> Iterator[Tuple[str, Any]]:
+    """
+    JSON を逐次読み込み、イベントを1つずつ返す。
+    保持するのは読み込み途中のトークン (長い文字列など) と入れ子の種類だけで、全体の木は作りません。
+    不正な JSON の場合は json.JSONDecodeError を送出します。
+    """
+    pieces = _iter_text_pieces(source, read_size)
+    buffer = ""
+    pos = 0
+    eof = False
+    stack: List[str] = []           # 入れ子の種類 ("map" / "array")
+    expect = "value"                # value / value_or_end / key / key_or_end / colon / comma_or_end / done
+
+    def fill() -> bool:
+        """読み込み済みの部分を捨ててから次の片を追加する。終端なら False"""
+        nonlocal buffer, pos, eof
+        piece = None if eof else next(pieces, None)
+        if piece is None:
+            eof = True
+            return False
+        buffer = buffer[pos:] + piece
+        pos = 0
+        return True
+
+    def read_string() -> str:
+        """pos の '"' から始まる文字列を読む。片の境界で切れている場合は続きを読み込んでから解析する"""
+        nonlocal pos
+        while True:
+            try:
+                value, pos = scanstring(buffer, pos + 1, True)
+                return value
+            except json.JSONDecodeError as e:
+                incomplete = e.msg.startswith("Unterminated string") or e.pos >= len(buffer) - 6
+                if not incomplete or not fill():
+                    raise
+
+    def read_scalar() -> Any:
+        """数値・true/false/null を区切り文字まで読み込んでから解析する"""
+        nonlocal pos
+        while _SCALAR_CHARS_PATTERN.match(buffer, pos).end() >= len(buffer) and fill():
+            pass
+        match = NUMBER_RE.match(buffer, pos)
+        if match:
+            integer, fraction, exponent = match.groups()
+            pos = match.end()
+            if fraction or exponent:
+                return float(integer + (fraction or "") + (exponent or ""))
+            return int(integer)
+        for word, value in _LITERAL_VALUES.items():
+            if buffer.startswith(word, pos):
+                pos += len(word)
+                return value
+        raise json.JSONDecodeError("値が必要です", buffer, pos)
+
+    def close_container() -> Tuple[str, Any]:
+        nonlocal pos, expect
+        pos += 1
+        kind = stack.pop()
+        expect = "comma_or_end" if stack else "done"
+        return ("end_map" if kind == "map" else "end_array"), None
+
+    while True:
+        pos = _WHITESPACE_PATTERN.match(buffer, pos).end()
+        if pos >= len(buffer):
+            if fill():
+                continue
+            if expect != "done":
+                raise json.JSONDecodeError("JSONが途中で終了しています", buffer, pos)
+            return
+        ch = buffer[pos]
+
+        if expect == "done":
+            raise json.JSONDecodeError("JSONの後に余分なテキストがあります", buffer, pos)
+        elif expect == "colon":
+            if ch != ":":
+                raise json.JSONDecodeError("':' が必要です", buffer, pos)
+            pos += 1
+            expect = "value"
+        elif expect == "comma_or_end":
+            closing = "}" if stack[-1] == "map" else "]"
+            if ch == ",":
+                pos += 1
+                expect = "key" if stack[-1] == "map" else "value"
+            elif ch == closing:
+                yield close_container()
+            else:
+                raise json.JSONDecodeError(f"',' または '{closing}' が必要です", buffer, pos)
+        elif expect in ("key", "key_or_end"):
+            if expect == "key_or_end" and ch == "}":
+                yield close_container()
+            elif ch == '"':
+                yield "key", read_string()
+                expect = "colon"
+            else:
+                raise json.JSONDecodeError("オブジェクトのキーが必要です", buffer, pos)
+        elif expect == "value_or_end" and ch == "]":
+            yield close_container()
+        elif ch in "{[":
+            pos += 1
+            stack.append("map" if ch == "{" else "array")
+            yield ("start_map" if ch == "{" else "start_array"), None
+            expect = "key_or_end" if ch == "{" else "value_or_end"
+        else:
+            value = read_string() if ch == '"' else read_scalar()
+            yield "value", value
+            expect = "comma_or_end" if stack else "done"
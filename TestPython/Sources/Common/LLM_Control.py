@@ -6,10 +6,23 @@ import sys
 import os
 import re
 import string
+import io
+import codecs
+import mmap
+import unicodedata
+import hashlib
+import threading
+import weakref
+import asyncio
+import contextlib
+import contextvars
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from typing import Tuple, List, Dict, Any, Optional,Union
+from typing import Tuple, List, Dict, Any, Optional, Union, Iterator, Iterable, Callable, Awaitable
 import requests 
+from urllib3.util.retry import Retry
 import chardet
 import csv
 import tiktoken # トークン数を正確にカウントするために外部ライブラリを推奨
@@ -23,6 +36,10 @@ sys.path.insert(0, project_root)
 
 from Sources.Common import KeyManager 
 from Sources.Common import FileControl
+from Sources.Common import CacheControl
+from Sources.Common import JsonStreamControl
+from Sources.Common import LLM_Telemetry
+from Sources.Common import LLM_Trace
 
 # ====================================================================
 # I. グローバル設定とユーティリティ
@@ -137,25 +154,141 @@ def construct_rag_prompt(
         prompt = f"{context}\n\n質問: {question}"
     return prompt
 
+# モデルのメタデータ (client.show) から取得したコンテキスト長 (学習時の最大値)。モデル名 -> トークン数
+# num_ctx と KV キャッシュが過大にならないよう、_MODEL_CONTEXT_LIMITS の値を下げる方向にだけ使う
+_DISCOVERED_CONTEXT_LIMITS: Dict[str, int] = {}
+# チャンク分割の計画に使うコンテキスト長の上限 (None で無制限)。
+# CPU環境などで KV キャッシュのメモリを抑えたい場合に設定する
+CONTEXT_WINDOW_CAP: Optional[int] = None
+
 def get_context_window_size(model_name: str) -> int:
     """
     モデル名に基づいて、そのモデルの最大コンテキストウィンドウサイズ (トークン数) を取得します。
+    _MODEL_CONTEXT_LIMITS (無ければ default_model) の値を使い、discover_context_window_size で取得済みの
+    モデルのコンテキスト長がそれより小さい場合のみ、そちらに下げます (取得した値で枠を広げることはありません)。
     """
     limit = _MODEL_CONTEXT_LIMITS.get(model_name)
-    if limit is not None:
-        return limit
-    
-    default_limit = _MODEL_CONTEXT_LIMITS.get("default_model", 4096)
-    print(f"警告: モデル '{model_name}' のコンテキスト制限が見つかりません。デフォルト値 {default_limit} を使用します。", file=sys.stderr)
-    return default_limit
+    if limit is None:
+        limit = _MODEL_CONTEXT_LIMITS.get("default_model", 4096)
+        print(f"警告: モデル '{model_name}' のコンテキスト制限が見つかりません。デフォルト値 {limit} を使用します。", file=sys.stderr)
+    discovered = _DISCOVERED_CONTEXT_LIMITS.get(model_name)
+    if discovered:
+        limit = min(limit, discovered)
+    if CONTEXT_WINDOW_CAP is not None:
+        limit = min(limit, CONTEXT_WINDOW_CAP)
+    return limit
+
+# --- トークナイザー・レジストリ (プロセス共通) ---
+# モデル名 -> エンコーディング名、エンコーディング名 -> Encoding を一度だけ解決して再利用する
+TOKEN_COUNT_CACHE_SIZE = 4096      # トークン数LRUキャッシュの最大件数
+TOKEN_COUNT_CACHE_MIN_CHARS = 256  # これより短い文字列は直接エンコードする (ハッシュの方が高くつくため)
+
+_MODEL_ENCODING_NAMES: Dict[str, str] = {}
+_TOKENIZER_REGISTRY: Dict[str, Any] = {}
+_TOKEN_COUNT_CACHE: "OrderedDict[Tuple[str, bytes], int]" = OrderedDict()
+_TOKENIZER_LOCK = threading.Lock()
+
+def _resolve_encoding_name(model_name: str) -> str:
+    """モデル名から使用するtiktokenのエンコーディング名を決定する。(純粋)"""
+    if "qwen" in model_name.lower():
+        return "o200k_base"
+    return "cl100k_base"
+
+def get_tokenizer(model_name: str) -> Any:
+    """
+    モデル名に対応するtiktokenのEncodingを返します。
+    解決結果はプロセス内のレジストリに保持され、2回目以降は辞書参照のみで返ります。
+    """
+    encoding_name = _MODEL_ENCODING_NAMES.get(model_name)
+    if encoding_name is None:
+        encoding_name = _resolve_encoding_name(model_name)
+        _MODEL_ENCODING_NAMES[model_name] = encoding_name
+
+    encoding = _TOKENIZER_REGISTRY.get(encoding_name)
+    if encoding is None:
+        with _TOKENIZER_LOCK:
+            encoding = _TOKENIZER_REGISTRY.get(encoding_name)
+            if encoding is None:
+                encoding = tiktoken.get_encoding(encoding_name)
+                _TOKENIZER_REGISTRY[encoding_name] = encoding
+    return encoding
+
+def register_tokenizer(encoding_name: str, encoding: Any):
+    """
+    エンコーディング名に対応するトークナイザーを登録します (tiktoken の語彙を取得できない環境やテスト用)。
+    encoding は encode / decode を持つオブジェクト (tiktoken.Encoding 互換)。登録済みのトークン数キャッシュは破棄します。
+    """
+    with _TOKENIZER_LOCK:
+        _TOKENIZER_REGISTRY[encoding_name] = encoding
+        _TOKEN_COUNT_CACHE.clear()
+
+def _token_cache_key(encoding_name: str, text: str) -> Tuple[str, bytes]:
+    """本文のハッシュをキーにする (長文をそのまま辞書キーとして保持しないため)"""
+    digest = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    return encoding_name, digest
+
+def _get_cached_token_count(key: Tuple[str, bytes]) -> Optional[int]:
+    with _TOKENIZER_LOCK:
+        count = _TOKEN_COUNT_CACHE.get(key)
+        if count is not None:
+            _TOKEN_COUNT_CACHE.move_to_end(key)
+        return count
+
+def _set_cached_token_count(key: Tuple[str, bytes], count: int):
+    with _TOKENIZER_LOCK:
+        _TOKEN_COUNT_CACHE[key] = count
+        _TOKEN_COUNT_CACHE.move_to_end(key)
+        while len(_TOKEN_COUNT_CACHE) > TOKEN_COUNT_CACHE_SIZE:
+            _TOKEN_COUNT_CACHE.popitem(last=False)
+
+def clear_token_count_cache():
+    """トークン数キャッシュを破棄します。(計測や検証用)"""
+    with _TOKENIZER_LOCK:
+        _TOKEN_COUNT_CACHE.clear()
 
 def count_tokens(text: str, model_name: str) -> int:
-    if "qwen" in model_name.lower():
-        encoding = tiktoken.get_encoding("o200k_base")
-    else:
-        encoding = tiktoken.get_encoding("cl100k_base")
-        
-    return len(encoding.encode(text))
+    """
+    テキストのトークン数を返します。
+    一定以上の長さのテキストは本文ハッシュをキーとしたLRUキャッシュで再計算を避けます。
+    """
+    encoding = get_tokenizer(model_name)
+    if len(text) < TOKEN_COUNT_CACHE_MIN_CHARS:
+        return len(encoding.encode(text))
+
+    key = _token_cache_key(encoding.name, text)
+    count = _get_cached_token_count(key)
+    if count is None:
+        count = len(encoding.encode(text))
+        _set_cached_token_count(key, count)
+    return count
+
+def count_tokens_batch(texts: List[str], model_name: str, num_threads: int = 8) -> List[int]:
+    """
+    複数テキストのトークン数をまとめて返します。
+    キャッシュに無いものだけを encode_batch で一括エンコードします (入力順を保持)。
+    """
+    encoding = get_tokenizer(model_name)
+    counts: List[Optional[int]] = [None] * len(texts)
+    miss_indexes: List[int] = []
+    miss_keys: List[Optional[Tuple[str, bytes]]] = []
+
+    for i, text in enumerate(texts):
+        key = None
+        if len(text) >= TOKEN_COUNT_CACHE_MIN_CHARS:
+            key = _token_cache_key(encoding.name, text)
+            counts[i] = _get_cached_token_count(key)
+        if counts[i] is None:
+            miss_indexes.append(i)
+            miss_keys.append(key)
+
+    if miss_indexes:
+        encoded_list = encoding.encode_batch([texts[i] for i in miss_indexes], num_threads=num_threads)
+        for i, key, tokens in zip(miss_indexes, miss_keys, encoded_list):
+            counts[i] = len(tokens)
+            if key is not None:
+                _set_cached_token_count(key, counts[i])
+
+    return counts
 
 def _clean_text_output(text: str) -> str:
     """
@@ -185,15 +318,71 @@ def _clean_text_output(text: str) -> str:
 # IV. I/O およびサーバー制御関数 (副作用あり)
 # ====================================================================
 
+# --- サーバー死活確認・モデル一覧のキャッシュ ---
+# subprocess (ollama list / ollama show) を毎回起動せず、共有HTTPセッションでAPIに問い合わせる
+MODEL_CACHE_TTL_SEC = 300  # /api/tags の結果を再利用する秒数
+
+_HTTP_SESSION: Optional[requests.Session] = None
+_HTTP_SESSION_LOCK = threading.Lock()
+_MODEL_AVAILABILITY_CACHE: Dict[str, Tuple[float, set]] = {}  # 接続先URL -> (取得時刻, モデル名の集合)
+
+def _get_http_session() -> requests.Session:
+    """Ollama API 用の keep-alive セッション (コネクションプール) を返す"""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        with _HTTP_SESSION_LOCK:
+            if _HTTP_SESSION is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _HTTP_SESSION = session
+    return _HTTP_SESSION
+
+def _normalize_model_name(model_name: str) -> str:
+    """タグ省略時は ':latest' を補う (Ollamaの表記に合わせる)。(純粋)"""
+    return model_name if ":" in model_name else f"{model_name}:latest"
+
+def is_ollama_alive(host_url: str = OLLAMA_SERVER_URL, timeout: float = 2) -> bool:
+    """Ollamaサーバーが生存確認エンドポイントに応答するかを返す"""
+    try:
+        response = _get_http_session().get(host_url, timeout=timeout)
+        return response.status_code == 200 and "Ollama is running" in response.text
+    except requests.exceptions.RequestException:
+        return False
+
+def list_available_models(host_url: str = OLLAMA_SERVER_URL, refresh: bool = False) -> set:
+    """
+    /api/tags からローカルに存在するモデル名の集合を取得します。
+    結果は MODEL_CACHE_TTL_SEC 秒間キャッシュされます。取得に失敗した場合は例外を送出します。
+    """
+    host_url = host_url.rstrip("/")
+    cached = _MODEL_AVAILABILITY_CACHE.get(host_url)
+    if cached and not refresh and time.time() - cached[0] < MODEL_CACHE_TTL_SEC:
+        return cached[1]
+
+    response = _get_http_session().get(f"{host_url}/api/tags", timeout=5)
+    response.raise_for_status()
+    names = set()
+    for model in response.json().get("models", []):
+        for key in ("name", "model"):
+            if model.get(key):
+                names.add(_normalize_model_name(model[key]))
+    _MODEL_AVAILABILITY_CACHE[host_url] = (time.time(), names)
+    return names
+
+def invalidate_model_cache(host_url: Optional[str] = None):
+    """モデル一覧のキャッシュを破棄する (プル後など)。host_url 省略時は全接続先。"""
+    if host_url is None:
+        _MODEL_AVAILABILITY_CACHE.clear()
+    else:
+        _MODEL_AVAILABILITY_CACHE.pop(host_url.rstrip("/"), None)
+
 def _wait_for_ollama_ready(host_url: str = OLLAMA_SERVER_URL, max_retries: int = 10, initial_delay: int = 2):
     """Ollamaサーバーが生存確認エンドポイントに応答するまで待機する (指数関数的バックオフ使用)"""
     for attempt in range(max_retries):
-        try:
-            response = requests.get(host_url, timeout=5)
-            if response.status_code == 200 and "Ollama is running" in response.text:
-                return True
-        except requests.exceptions.RequestException:
-            pass
+        if is_ollama_alive(host_url, timeout=5):
+            return True
 
         wait_time = initial_delay * (2 ** attempt)
         print(f"Ollama応答待ち ({host_url}). {wait_time}秒後に再試行します...", file=sys.stderr)
@@ -202,26 +391,26 @@ def _wait_for_ollama_ready(host_url: str = OLLAMA_SERVER_URL, max_retries: int =
     raise ConnectionError("最大リトライ回数を超過してもOllamaサービスに接続できませんでした。")
 
 
-def _start_ollama_server():
+def _start_ollama_server(host_url: str = OLLAMA_SERVER_URL):
     """Ollamaサーバーが起動していない場合、subprocessで起動を試みます。"""
-    try:
-        subprocess.run(['ollama', 'list'], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if is_ollama_alive(host_url):
         print("Ollamaサーバーは既に起動しています。", file=sys.stderr)
-    except subprocess.CalledProcessError:
-        try:
-            subprocess.Popen(['ollama', 'serve'], start_new_session=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            _wait_for_ollama_ready(OLLAMA_SERVER_URL)
-            print("Ollamaサーバーを起動し、準備完了を確認しました。", file=sys.stderr)
-        except FileNotFoundError:
-            print("エラー: 'ollama' コマンドが見つかりません。", file=sys.stderr)
-            sys.exit(1)
-        except Exception as e:
-            print(f"Ollamaサーバーの起動中に予期せぬエラーが発生しました: {e}", file=sys.stderr)
-            sys.exit(1)
+        return
+
+    try:
+        subprocess.Popen(['ollama', 'serve'], start_new_session=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _wait_for_ollama_ready(host_url)
+        print("Ollamaサーバーを起動し、準備完了を確認しました。", file=sys.stderr)
+    except FileNotFoundError:
+        print("エラー: 'ollama' コマンドが見つかりません。", file=sys.stderr)
+        sys.exit(1)
+    except Exception as e:
+        print(f"Ollamaサーバーの起動中に予期せぬエラーが発生しました: {e}", file=sys.stderr)
+        sys.exit(1)
 
 def initialize_ollama_client(url: str = OLLAMA_SERVER_URL):
     """Ollamaクライアントを初期化し、サーバーが利用可能であることを確認する (外部関数の代替)"""
-    _start_ollama_server()
+    _start_ollama_server(url)
     try:
         client = ollama.Client(host=url)
         print(f"Ollamaクライアントを {url} で初期化しました。", file=sys.stderr)
@@ -229,59 +418,158 @@ def initialize_ollama_client(url: str = OLLAMA_SERVER_URL):
     except Exception as e:
         raise ConnectionError(f"Ollama接続失敗 {e}")
     
-def _pull_model_if_not_exists(model_name: str, client: Any) -> bool:
+def initialize_ollama_async_client(url: str = OLLAMA_SERVER_URL):
+    """ollama.AsyncClient を初期化する (非同期パイプライン用)"""
+    _start_ollama_server(url)
+    try:
+        client = ollama.AsyncClient(host=url)
+        print(f"Ollama非同期クライアントを {url} で初期化しました。", file=sys.stderr)
+        return client
+    except Exception as e:
+        raise ConnectionError(f"Ollama接続失敗 {e}")
+
+def _client_endpoint(client: Any) -> str:
+    """クライアントの接続先URLを返す (同時実行数の制御単位に使用)"""
+    base_url = getattr(getattr(client, "_client", None), "base_url", None)
+    return str(base_url).rstrip("/") if base_url else OLLAMA_SERVER_URL
+
+def _model_exists_locally(model_name: str, host_url: str = OLLAMA_SERVER_URL) -> bool:
     """
-    モデルの存在を検証し、数値のNoneチェックを行いながらプログレスバーを表示してプルします。
+    モデルがローカルに存在するかを、キャッシュしたモデル一覧 (/api/tags) で確認する。
+    APIに問い合わせできない場合のみ ollama show で確認する。
     """
+    try:
+        return _normalize_model_name(model_name) in list_available_models(host_url)
+    except Exception as e:
+        print(f"モデル一覧の取得に失敗したため ollama show で確認します: {e}", file=sys.stderr)
+
     try:
         # 存在確認
         result = subprocess.run(
             ["ollama", "show", model_name],
             capture_output=True, text=True, check=False
         )
-        if result.returncode == 0:
-            print(f"✅ モデル '{model_name}' は既にローカルに存在します。", file=sys.stderr)
-            return True
+        return result.returncode == 0
     except Exception as e:
         print(f"モデル検証中にエラーが発生しました: {e}", file=sys.stderr)
+        return False
+
+def _print_pull_progress(part: Any, current_digest: str) -> str:
+    """プルの進捗1件を表示し、表示済みのステータスを返す"""
+    status = part.get('status', '')
+    total = part.get('total')      # Noneの可能性がある
+    completed = part.get('completed') # Noneの可能性がある
+    
+    # 数値が有効(Noneでない)かつ、ダウンロード中であるかチェック
+    if total is not None and completed is not None and total > 0:
+        percent = int(completed / total * 100)
+        bar_length = 40
+        filled_length = int(bar_length * completed // total)
+        bar = '█' * filled_length + '-' * (bar_length - filled_length)
+        
+        completed_gb = completed / (1024**3)
+        total_gb = total / (1024**3)
+        
+        # \r で同じ行を上書き
+        sys.stdout.write(f"\r|{bar}| {percent}% ({completed_gb:.2f}/{total_gb:.2f} GB) {status}")
+        sys.stdout.flush()
+    else:
+        # 数値が取れない場合や、ステータスが変わった場合はテキストのみ表示
+        if status != current_digest:
+            # 前のバーの残りを消すために空白を入れてから出力
+            sys.stdout.write(f"\r{' ' * 80}\r") 
+            print(f"{status}", file=sys.stderr)
+            current_digest = status
+    return current_digest
+
+def _pull_model_if_not_exists(model_name: str, client: Any) -> bool:
+    """
+    モデルの存在を検証し、数値のNoneチェックを行いながらプログレスバーを表示してプルします。
+    """
+    host_url = _client_endpoint(client)
+    if _model_exists_locally(model_name, host_url):
+        print(f"✅ モデル '{model_name}' は既にローカルに存在します。", file=sys.stderr)
+        discover_context_window_size(model_name, client)
+        return True
 
     print(f"📥 モデル '{model_name}' が見つかりません。ダウンロードを開始します...", file=sys.stderr)
     
     try:
         current_digest = ""
         for part in client.pull(model=model_name, stream=True):
-            status = part.get('status', '')
-            total = part.get('total')      # Noneの可能性がある
-            completed = part.get('completed') # Noneの可能性がある
-            
-            # 数値が有効(Noneでない)かつ、ダウンロード中であるかチェック
-            if total is not None and completed is not None and total > 0:
-                percent = int(completed / total * 100)
-                bar_length = 40
-                filled_length = int(bar_length * completed // total)
-                bar = '█' * filled_length + '-' * (bar_length - filled_length)
-                
-                completed_gb = completed / (1024**3)
-                total_gb = total / (1024**3)
-                
-                # \r で同じ行を上書き
-                sys.stdout.write(f"\r|{bar}| {percent}% ({completed_gb:.2f}/{total_gb:.2f} GB) {status}")
-                sys.stdout.flush()
-            else:
-                # 数値が取れない場合や、ステータスが変わった場合はテキストのみ表示
-                if status != current_digest:
-                    # 前のバーの残りを消すために空白を入れてから出力
-                    sys.stdout.write(f"\r{' ' * 80}\r") 
-                    print(f"{status}", file=sys.stderr)
-                    current_digest = status
+            current_digest = _print_pull_progress(part, current_digest)
+
+        invalidate_model_cache(host_url)
+        print(f"\n✅ モデル '{model_name}' の取得が完了しました。", file=sys.stderr)
+        discover_context_window_size(model_name, client, refresh=True)
+        return True
+
+    except Exception as e:
+        print(f"\n❌ モデルの取得中にエラーが発生しました: {e}", file=sys.stderr)
+        return False
+
+async def _pull_model_if_not_exists_async(model_name: str, client: Any) -> bool:
+    """_pull_model_if_not_exists の ollama.AsyncClient 版"""
+    host_url = _client_endpoint(client)
+    if await asyncio.to_thread(_model_exists_locally, model_name, host_url):
+        print(f"✅ モデル '{model_name}' は既にローカルに存在します。", file=sys.stderr)
+        await discover_context_window_size_async(model_name, client)
+        return True
+
+    print(f"📥 モデル '{model_name}' が見つかりません。ダウンロードを開始します...", file=sys.stderr)
+    try:
+        current_digest = ""
+        async for part in await client.pull(model=model_name, stream=True):
+            current_digest = _print_pull_progress(part, current_digest)
 
+        invalidate_model_cache(host_url)
         print(f"\n✅ モデル '{model_name}' の取得が完了しました。", file=sys.stderr)
+        await discover_context_window_size_async(model_name, client, refresh=True)
         return True
 
     except Exception as e:
         print(f"\n❌ モデルの取得中にエラーが発生しました: {e}", file=sys.stderr)
         return False
 
+# --- コンテキスト長の取得 (client.show) ---
+def _context_length_from_show(response: Any) -> Optional[int]:
+    """client.show の応答 (model_info の "<アーキテクチャ>.context_length") から学習時のコンテキスト長を取り出す。(純粋)"""
+    model_info = response.get("modelinfo") or response.get("model_info") or {}
+    for key, value in dict(model_info).items():
+        if key.endswith(".context_length") and isinstance(value, int) and value > 0:
+            return value
+    return None
+
+def _remember_context_length(model_name: str, response: Any) -> Optional[int]:
+    context_length = _context_length_from_show(response)
+    if context_length:
+        _DISCOVERED_CONTEXT_LIMITS[model_name] = context_length
+        print(f"モデル '{model_name}' のコンテキスト長: {context_length} tokens", file=sys.stderr)
+    return context_length
+
+def discover_context_window_size(model_name: str, client: Any, refresh: bool = False) -> Optional[int]:
+    """
+    モデルのメタデータからコンテキスト長を取得して記録し、以降の get_context_window_size で上限として使います。
+    取得済みの場合は問い合わせません。取得できなかった場合は None を返します。
+    """
+    if not refresh and model_name in _DISCOVERED_CONTEXT_LIMITS:
+        return _DISCOVERED_CONTEXT_LIMITS[model_name]
+    try:
+        return _remember_context_length(model_name, client.show(model_name))
+    except Exception as e:
+        print(f"モデル '{model_name}' のメタデータ取得に失敗しました: {e}", file=sys.stderr)
+        return None
+
+async def discover_context_window_size_async(model_name: str, client: Any, refresh: bool = False) -> Optional[int]:
+    """discover_context_window_size の ollama.AsyncClient 版"""
+    if not refresh and model_name in _DISCOVERED_CONTEXT_LIMITS:
+        return _DISCOVERED_CONTEXT_LIMITS[model_name]
+    try:
+        return _remember_context_length(model_name, await client.show(model_name))
+    except Exception as e:
+        print(f"モデル '{model_name}' のメタデータ取得に失敗しました: {e}", file=sys.stderr)
+        return None
+
 def _write_result_to_file(file_path: str, content: str,add_mode:bool = False):
     """結果を指定されたファイルに保存します。"""
     if not content:
@@ -318,36 +606,210 @@ def read_previous_output(file_path: str) -> str:
         print(f"エラー: ファイルの読み込み中に予期せぬエラーが発生しました: {e}", file=sys.stderr)
         return ""
     
-def read_text_with_auto_encoding(file_path: str):
-    # 1. ファイルをバイナリモードで読み込む
-    raw_data = None
-    with open(file_path, 'rb') as f:
-        raw_data = f.read(10000) 
-
-    # 2. chardetでエンコーディングを推定
-    result = chardet.detect(raw_data)
-    detected_encoding = result['encoding']
-    confidence = result['confidence']
-    
-    # 3. 推定されたエンコーディングでファイルを読み込む
-    if confidence > 0.8 and detected_encoding:
-        print(f"{file_path}のエンコーディングを {detected_encoding} ({confidence:.2f}) と推定しました。", file=sys.stderr)
+# --- エンコーディング判定 ---
+# BOM → UTF-8 (厳密) → CP932 の順に安価な判定を行い、chardet は最後の手段とする。
+# 判定結果は (パス, サイズ, 更新時刻) をキーにキャッシュし、同じファイルを再判定しない
+# 先頭サンプルだけから得た判定は「部分判定」として保存し、ファイル全体をデコードする読み込みには使わない
+ENCODING_CACHE_FILE = "./DocumentAuto/encoding_cache.sqlite3"
+ENCODING_DETECT_SAMPLE_SIZE = 100000  # chardet に渡す最大バイト数
+
+_BOM_ENCODINGS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),  # UTF-16LE の BOM を含むため先に判定する
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+_ENCODING_CACHE: Optional[CacheControl.SQLiteCache] = None
+
+def _get_encoding_cache() -> Optional[CacheControl.SQLiteCache]:
+    global _ENCODING_CACHE
+    if _ENCODING_CACHE is None:
         try:
-            with open(file_path, 'r', encoding=detected_encoding, errors='ignore') as f:
-                content = f.read()
-            return content
+            _ENCODING_CACHE = CacheControl.SQLiteCache(
+                ENCODING_CACHE_FILE, namespace="file_encoding", max_entries=100000, memory_items=4096
+            )
         except Exception as e:
-            print(f"エラー: 推定されたエンコーディングでの読み込みに失敗しました: {e}", file=sys.stderr)
+            print(f"警告: エンコーディングキャッシュを開けませんでした: {e}", file=sys.stderr)
             return None
-    else:
-        print("警告: エンコーディングの判別に失敗しました。デフォルトのUTF-8で試行します。", file=sys.stderr)
+    return _ENCODING_CACHE
+
+def _encoding_cache_key(file_path: Union[str, Path]) -> str:
+    stat = os.stat(file_path)
+    return f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+def _decodes_strictly(raw_data: bytes, encoding: str, is_complete: bool) -> Optional[str]:
+    """raw_data を厳密にデコードできれば文字列を返す。サンプル末尾で途切れた文字は許容する。(純粋)"""
+    try:
+        return codecs.getincrementaldecoder(encoding)(errors="strict").decode(raw_data, final=is_complete)
+    except UnicodeDecodeError:
+        return None
+
+def _detect_encoding_from_bytes(raw_data: bytes, is_complete: bool = True) -> Tuple[str, float, str]:
+    """
+    バイト列からエンコーディングを推定し、(エンコーディング, 信頼度, 判定方法) を返す。(純粋)
+    is_complete=False の場合、raw_data はファイル先頭のサンプルとして扱います。
+    """
+    # 1. BOM
+    for bom, encoding in _BOM_ENCODINGS:
+        if raw_data.startswith(bom):
+            return encoding, 1.0, "bom"
+
+    # 2. UTF-8 (ASCII のみのファイルもここで確定する)
+    if _decodes_strictly(raw_data, "utf-8", is_complete) is not None:
+        return "utf-8", 1.0, "utf-8"
+
+    # 3. Shift-JIS (CP932)
+    # EUC-JP などが偶然デコードできた場合は半角カナばかりになるため、その場合は chardet に回す
+    decoded = _decodes_strictly(raw_data, "cp932", is_complete)
+    if decoded is not None:
+        non_ascii = [c for c in decoded if ord(c) > 0x7F]
+        halfwidth_kana = sum(1 for c in non_ascii if "\uff61" <= c <= "\uff9f")
+        if non_ascii and halfwidth_kana / len(non_ascii) < 0.5:
+            return "cp932", 0.95, "cp932"
+
+    # 4. chardet (最後の手段)
+    result = chardet.detect(raw_data[:ENCODING_DETECT_SAMPLE_SIZE])
+    detected_encoding = result['encoding']
+    confidence = result['confidence'] or 0.0
+    if detected_encoding and confidence > 0.8:
+        return detected_encoding, confidence, "chardet"
+    return "utf-8-sig", confidence, "default"
+
+def _get_cached_encoding(file_path: Union[str, Path], is_complete: bool) -> Optional[Tuple[str, float, str]]:
+    """
+    キャッシュ済みの判定結果を返す (無ければ None)。
+    ファイル全体 (is_complete=True) の判定には、ファイル全体から得たキャッシュだけを使います。
+    """
+    cache = _get_encoding_cache()
+    if cache is None:
+        return None
+    try:
+        cached = cache.get(_encoding_cache_key(file_path))
+    except Exception as e:
+        print(f"警告: エンコーディングキャッシュの参照に失敗しました: {e}", file=sys.stderr)
+        return None
+    # [エンコーディング, 信頼度, ファイル全体から判定したか]
+    if cached and (len(cached) > 2 and cached[2] or not is_complete):
+        return cached[0], cached[1], "cache"
+    return None
+
+def _set_cached_encoding(file_path: Union[str, Path], encoding: str, confidence: float, is_complete: bool):
+    cache = _get_encoding_cache()
+    if cache is None:
+        return
+    try:
+        cache.set(_encoding_cache_key(file_path), [encoding, confidence, is_complete])
+    except Exception as e:
+        print(f"警告: エンコーディングキャッシュの保存に失敗しました: {e}", file=sys.stderr)
+
+def _detect_and_cache_encoding(file_path: Union[str, Path], raw_data: bytes, is_complete: bool) -> Tuple[str, float, str]:
+    """キャッシュに判定結果があればそれを返し、無ければ raw_data から判定して保存する"""
+    cached = _get_cached_encoding(file_path, is_complete)
+    if cached is not None:
+        return cached
+
+    encoding, confidence, method = _detect_encoding_from_bytes(raw_data, is_complete)
+    _set_cached_encoding(file_path, encoding, confidence, is_complete)
+    return encoding, confidence, method
+
+ENCODING_VERIFY_BLOCK_SIZE = 1024 * 1024  # ファイル全体の検証で一度にデコードするバイト数
+
+def _find_decode_error(data: Any, encoding: str, block_size: int = ENCODING_VERIFY_BLOCK_SIZE) -> Optional[int]:
+    """
+    data (bytes / mmap) を encoding で先頭から厳密にデコードし、失敗した位置のバイトオフセットを返す (成功時は None)。
+    ブロックごとにデコードするため、デコード結果全体を保持することはありません。
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="strict")
+    size = len(data)
+    for offset in range(0, max(size, 1), block_size):
+        pending = len(decoder.getstate()[0])
         try:
-            with open(file_path, 'r', encoding='utf-8-sig', errors='ignore') as f:
-                content = f.read()
-            return content
-        except:
-            print("警告: エンコーディングの判別に失敗しました。", file=sys.stderr)
-            return None 
+            decoder.decode(data[offset:offset + block_size], final=offset + block_size >= size)
+        except UnicodeDecodeError as e:
+            return max(0, offset - pending + e.start)
+    return None
+
+def _detect_encoding_from_file(file_path: Union[str, Path]) -> Tuple[str, float, str, bool]:
+    """
+    ファイル全体を読み込まずに、全体を厳密にデコードできるエンコーディングを推定し、
+    (エンコーディング, 信頼度, 判定方法, 全体を厳密にデコードできるか) を返します。
+    先頭サンプルからの推定を全体の逐次デコードで確かめ、途中で失敗した場合は失敗した行以降のサンプルから推定し直します。
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return "utf-8", 1.0, "empty", True
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            size = len(mapped)
+            encoding, confidence, method = _detect_encoding_from_bytes(
+                mapped[:ENCODING_DETECT_SAMPLE_SIZE], size <= ENCODING_DETECT_SAMPLE_SIZE
+            )
+            tried = set()
+            while True:
+                error_at = _find_decode_error(mapped, encoding)
+                if error_at is None:
+                    return encoding, confidence, method, True
+                tried.add(encoding)
+                # 失敗した位置を含む行の先頭 (近くに改行が無ければ失敗した位置) から推定し直す
+                newline_at = mapped.rfind(b"\n", max(0, error_at - 4096), error_at)
+                line_start = newline_at + 1 if newline_at >= 0 else error_at
+                retry = _detect_encoding_from_bytes(mapped[line_start:line_start + ENCODING_DETECT_SAMPLE_SIZE], False)
+                if retry[0] in tried:
+                    print(
+                        f"警告: {file_path} は1つのエンコーディングでデコードできません ({encoding}, 位置 {error_at})。"
+                        f"デコードできないバイトは置換文字になります。", file=sys.stderr
+                    )
+                    return encoding, confidence, method, False
+                encoding, confidence, method = retry
+
+def detect_full_file_encoding(file_path: Union[str, Path]) -> str:
+    """
+    ファイル全体をデコードできるエンコーディングを返します (大きなファイルの逐次読み込み用)。
+    detect_file_encoding と違い、先頭サンプルだけで判定を確定しません。結果はファイル全体の判定としてキャッシュします。
+    """
+    cached = _get_cached_encoding(file_path, True)
+    if cached is not None:
+        return cached[0]
+    encoding, confidence, _, strict = _detect_encoding_from_file(file_path)
+    if strict:
+        _set_cached_encoding(file_path, encoding, confidence, True)
+    return encoding
+
+def detect_file_encoding(file_path: Union[str, Path], sample_size: int = 10000) -> str:
+    """
+    ファイル先頭のサンプルからエンコーディングを推定します。
+    推定できない場合は utf-8-sig を返します。
+    """
+    with open(file_path, 'rb') as f:
+        raw_data = f.read(sample_size)
+        is_complete = not f.read(1)
+
+    encoding, _, _ = _detect_and_cache_encoding(file_path, raw_data, is_complete)
+    return encoding
+
+def _read_text_bytes(file_path: str) -> Tuple[str, str, float, str]:
+    """ファイルを1回だけ読み込み、判定したエンコーディングでデコードして (本文, エンコーディング, 信頼度, 判定方法) を返す"""
+    with open(file_path, 'rb') as f:
+        raw_data = f.read()
+    encoding, confidence, method = _detect_and_cache_encoding(file_path, raw_data, True)
+    return raw_data.decode(encoding, errors='ignore'), encoding, confidence, method
+
+def read_text_with_auto_encoding(file_path: str):
+    try:
+        content, encoding, confidence, method = _read_text_bytes(file_path)
+    except FileNotFoundError:
+        raise
+    except Exception as e:
+        print(f"エラー: 推定されたエンコーディングでの読み込みに失敗しました: {e}", file=sys.stderr)
+        return None
+
+    if method == "default":
+        print("警告: エンコーディングの判別に失敗しました。デフォルトのUTF-8で読み込みました。", file=sys.stderr)
+    else:
+        print(f"{file_path}のエンコーディングを {encoding} ({confidence:.2f}, {method}) と推定しました。", file=sys.stderr)
+    # テキストモードで開いた場合と同じく改行を \n に揃える
+    return content.replace('\r\n', '\n').replace('\r', '\n')
 
 def read_csv_with_auto_encoding(file_path: str):
     if not os.path.exists(file_path):
@@ -355,19 +817,8 @@ def read_csv_with_auto_encoding(file_path: str):
         return None
 
     try:
-        with open(file_path, 'rb') as f:
-            raw_data = f.read(100000) 
-
-        result = chardet.detect(raw_data)
-        detected_encoding = result['encoding']
-        confidence = result['confidence']
-        
-        if detected_encoding and confidence > 0.8:
-            encoding_to_use = detected_encoding
-        else:
-            encoding_to_use = 'utf-8-sig'
-        
-        print(f"{file_path}のエンコーディングを '{encoding_to_use}' (信頼度: {confidence:.2f}) と推定して読み込みます。", file=sys.stderr)
+        content, encoding_to_use, confidence, method = _read_text_bytes(file_path)
+        print(f"{file_path}のエンコーディングを '{encoding_to_use}' (信頼度: {confidence:.2f}, {method}) と推定して読み込みます。", file=sys.stderr)
 
     except Exception as e:
         print(f"エラー: エンコーディングの自動判別に失敗しました: {e}", file=sys.stderr)
@@ -375,10 +826,10 @@ def read_csv_with_auto_encoding(file_path: str):
 
     csv_data = []
     try:
-        with open(file_path, 'r', encoding=encoding_to_use, newline='', errors='ignore') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                csv_data.append(row)
+        # 読み込み済みのバイト列からデコードした文字列をそのまま解析する (ファイルを開き直さない)
+        reader = csv.reader(io.StringIO(content, newline=''))
+        for row in reader:
+            csv_data.append(row)
         
         # CSVデータをテキスト形式に変換して返す（プロンプトに含めるため）
         csv_text = "\n".join([",".join(map(str, row)) for row in csv_data])
@@ -455,56 +906,114 @@ def save_search_cache(cache_file_path: str, cache_data: Dict[str, str]):
     except Exception as e:
         print(f"エラー: 検索キャッシュの保存に失敗しました: {e}", file=sys.stderr)
 
+# --- 検索キャッシュ (キー付きストア) ---
+# JSONファイル全体の読み込み/書き直しをやめ、SQLiteファイルに1件ずつ追記・参照する
+SEARCH_CACHE_TTL_SEC: Optional[float] = 30 * 24 * 3600  # 検索結果を再利用する期間 (None で無期限)
+SEARCH_CACHE_MEMORY_ITEMS = 256  # プロセス内に保持する直近の検索結果の件数
 
-def get_or_fetch_search_context(question: str, encrypted_secrets_path: str, internet_search_cash_file_path: str) -> str:
+_SEARCH_CACHES: Dict[str, CacheControl.SQLiteCache] = {}
+_SEARCH_CACHES_LOCK = threading.Lock()
+
+def _search_cache_db_path(cache_file_path: str) -> str:
+    """従来の JSON キャッシュのパスから SQLite ファイルのパスを決める。(純粋)"""
+    root, extension = os.path.splitext(cache_file_path)
+    return cache_file_path if extension in (".sqlite3", ".db") else root + ".sqlite3"
+
+def get_search_cache(cache_file_path: str = INTERNET_CACHE_FILE) -> CacheControl.SQLiteCache:
     """
-    キャッシュをチェックし、存在しなければTavily検索を実行して結果を取得・キャッシュします。（I/O）
+    検索キャッシュのストアを返す (パスごとに1度だけ開く)。
+    SQLite ファイルを新規作成する際、従来の JSON キャッシュがあれば一度だけ取り込みます。
+    """
+    db_path = _search_cache_db_path(cache_file_path)
+    with _SEARCH_CACHES_LOCK:
+        cache = _SEARCH_CACHES.get(db_path)
+        if cache is not None:
+            return cache
+
+        is_new = not os.path.exists(db_path)
+        cache = CacheControl.SQLiteCache(
+            db_path, namespace="tavily_search", ttl_sec=SEARCH_CACHE_TTL_SEC, memory_items=SEARCH_CACHE_MEMORY_ITEMS
+        )
+        if is_new and db_path != cache_file_path and os.path.exists(cache_file_path):
+            legacy_cache = load_search_cache(cache_file_path)
+            if legacy_cache:
+                cache.set_many({normalize_search_query(q): context for q, context in legacy_cache.items()})
+                print(f"従来の検索キャッシュ {len(legacy_cache)} 件を {db_path} に取り込みました。", file=sys.stderr)
+        _SEARCH_CACHES[db_path] = cache
+        return cache
+
+def normalize_search_query(query: str) -> str:
+    """
+    検索クエリを正規化する (全角/半角の統一、前後空白の除去、連続空白の圧縮)。(純粋)
+    表記揺れだけが異なる同じ質問を1回の検索・1つのキャッシュキーにまとめるために使います。
     """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", query or "")).strip()
+
+def _format_search_results(search_results: Dict[str, Any]) -> str:
+    """Tavily の検索結果を参照用テキストに整形する。(純粋)"""
+    context_parts = []
+
+    for i, result in enumerate(search_results.get('results', []), 1):
+        context_parts.append(
+            f"--- 検索結果 {i} ({result.get('title', 'N/A')}) ---\n"
+            f"URL: {result.get('url', 'N/A')}\n"
+            f"内容: {result.get('summary', 'N/A')}\n"
+        )
+
+    final_answer = search_results.get('answer')
+    if final_answer:
+        context_parts.insert(0, f"--- Tavilyによる要約回答 ---\n{final_answer}\n---")
+    return "\n".join(context_parts)
+
+def _resolve_search_client(encrypted_secrets_path: str, search_client: Any = None) -> Any:
+    """search_client が渡されていればそれを (オフライン検証用の代替クライアントなど)、無ければ Tavily を使う"""
     global TAVILY_CLIENT
-    
-    # 1. キャッシュのロード
-    cache = load_search_cache(internet_search_cash_file_path)
-    if question in cache:
+    if search_client is not None:
+        return search_client
+    TAVILY_CLIENT = lazy_load_tavily_client(encrypted_secrets_path)
+    return TAVILY_CLIENT
+
+def _fetch_search_context(search_client: Any, query: str) -> str:
+    """検索を1回実行し、整形済みのコンテキストを返す (結果が無い場合は空文字)"""
+    search_results = search_client.search(
+        query=query,
+        search_depth="advanced", 
+        max_results=5 
+    )
+    return _format_search_results(search_results)
+
+def get_or_fetch_search_context(
+    question: str,
+    encrypted_secrets_path: str,
+    internet_search_cash_file_path: str,
+    search_client: Any = None
+) -> str:
+    """
+    キャッシュをチェックし、存在しなければTavily検索を実行して結果を取得・キャッシュします。（I/O）
+    search_client には .search(query=..., search_depth=..., max_results=...) を持つ代替クライアントを渡せます。
+    """
+    # 1. キャッシュの参照 (該当クエリ1件のみ)
+    cache = get_search_cache(internet_search_cash_file_path)
+    cache_key = normalize_search_query(question)
+    cached_context = cache.get(cache_key)
+    if cached_context is not None:
         print("✅ キャッシュから検索コンテキストを取得しました。", file=sys.stderr)
-        return cache[question] # ヘッダー/フッターは呼び出し元で追加
+        return cached_context # ヘッダー/フッターは呼び出し元で追加
     
-    # 2. Tavilyクライアントを遅延ロード
-    TAVILY_CLIENT = lazy_load_tavily_client(encrypted_secrets_path)
-    if TAVILY_CLIENT is None:
+    # 2. 検索クライアントを遅延ロード
+    client = _resolve_search_client(encrypted_secrets_path, search_client)
+    if client is None:
         print("警告: Tavilyクライアントの初期化に失敗したため、インターネット検索をスキップします。", file=sys.stderr)
         return ""
     
-    # 3. Tavily検索の実行
+    # 3. 検索の実行
     print("インターネット検索 (Tavily) を実行中...", file=sys.stderr)
     try:
-        search_results = TAVILY_CLIENT.search(
-            query=question,
-            search_depth="advanced", 
-            max_results=5 
-        )
-        
-        context_parts = []
-        
-        for i, result in enumerate(search_results.get('results', []), 1):
-            context_parts.append(
-                f"--- 検索結果 {i} ({result.get('title', 'N/A')}) ---\n"
-                f"URL: {result.get('url', 'N/A')}\n"
-                f"内容: {result.get('summary', 'N/A')}\n"
-            )
-
-        final_answer = search_results.get('answer')
-        if final_answer:
-            context_parts.insert(0, f"--- Tavilyによる要約回答 ---\n{final_answer}\n---")
-            
-        
-        if context_parts:
-            context = "\n".join(context_parts)
+        context = _fetch_search_context(client, question)
+        if context:
             print("インターネット検索コンテキストを取得しました。", file=sys.stderr)
-            
-            # 4. キャッシュに保存
-            cache[question] = context
-            save_search_cache(internet_search_cash_file_path, cache)
-            
+            # 4. キャッシュに追記
+            cache.set(cache_key, context)
             return context
         else:
             print("インターネット検索結果は得られませんでした。", file=sys.stderr)
@@ -514,142 +1023,662 @@ def get_or_fetch_search_context(question: str, encrypted_secrets_path: str, inte
         print(f"エラー: Tavily Searchの実行中にエラーが発生しました: {e}", file=sys.stderr)
         return ""
 
+def _build_rate_limiter(requests_per_sec: Optional[float]) -> Callable[[], None]:
+    """呼び出し間隔が 1/requests_per_sec 秒以上になるよう待機する関数を返す (スレッド間で共有)"""
+    lock = threading.Lock()
+    next_slot = [0.0]
+
+    def wait():
+        if not requests_per_sec or requests_per_sec <= 0:
+            return
+        with lock:
+            now = time.monotonic()
+            slot = max(now, next_slot[0])
+            next_slot[0] = slot + 1.0 / requests_per_sec
+        if slot > now:
+            time.sleep(slot - now)
+    return wait
+
+def prefetch_search_contexts(
+    questions: Iterable[str],
+    encrypted_secrets_path: str,
+    internet_search_cash_file_path: str = INTERNET_CACHE_FILE,
+    search_client: Any = None,
+    max_workers: int = 4,
+    requests_per_sec: Optional[float] = 2.0
+) -> Dict[str, str]:
+    """
+    複数の検索クエリを正規化・重複排除し、キャッシュに無いものだけをレート制限付きで並列に検索します。
+    戻り値は 正規化クエリ -> コンテキスト の辞書です (検索結果が無いクエリは空文字)。
+    """
+    unique_queries: Dict[str, str] = {}  # 正規化クエリ -> 検索に使う元のクエリ (最初の出現)
+    for question in questions:
+        key = normalize_search_query(question)
+        if key and key not in unique_queries:
+            unique_queries[key] = question
+
+    cache = get_search_cache(internet_search_cash_file_path)
+    contexts: Dict[str, str] = {}
+    misses: List[str] = []
+    for key in unique_queries:
+        cached_context = cache.get(key)
+        if cached_context is not None:
+            contexts[key] = cached_context
+        else:
+            misses.append(key)
+    print(f"検索プリフェッチ: {len(unique_queries)} 件 (キャッシュ {len(contexts)} 件 / 検索 {len(misses)} 件)", file=sys.stderr)
+    if not misses:
+        return contexts
+
+    client = _resolve_search_client(encrypted_secrets_path, search_client)
+    if client is None:
+        print("警告: Tavilyクライアントの初期化に失敗したため、インターネット検索をスキップします。", file=sys.stderr)
+        contexts.update({key: "" for key in misses})
+        return contexts
+
+    wait_for_slot = _build_rate_limiter(requests_per_sec)
+
+    def fetch(key: str) -> str:
+        wait_for_slot()
+        try:
+            context = _fetch_search_context(client, unique_queries[key])
+        except Exception as e:
+            print(f"エラー: 検索に失敗しました ({key[:40]}): {e}", file=sys.stderr)
+            return ""
+        if context:
+            cache.set(key, context)
+        return context
+
+    for key, context in zip(misses, _run_bounded_parallel(fetch, misses, max_workers)):
+        contexts[key] = context
+    return contexts
+
 # ====================================================================
 # RAGサーバー クライアント関数 (変更なし)
 # ====================================================================
 
-def rag_server_register(path_list: Union[str,List[str]], rag_server_url: str) -> bool:
-    """FastAPIサーバーの /register エンドポイントを呼び出し、ファイルを登録します。"""
-    files_to_upload =[]
-
-    file_paths = FileControl.get_file_path_list(path_list, recursive = True)
+# --- RAG登録 (差分・分割アップロード) ---
+RAG_REGISTRY_FILE = "./DocumentAuto/rag_registry.sqlite3"  # 登録済みファイルのハッシュ記録
+RAG_UPLOAD_BATCH_BYTES = 32 * 1024 * 1024  # 1回の POST に含める最大バイト数
+RAG_UPLOAD_BATCH_FILES = 64                # 1回の POST に含める最大ファイル数 (= 同時に開くファイル数の上限)
+RAG_UPLOAD_PARALLELISM = 2                 # 同時に送信するバッチ数
+RAG_UPLOAD_TIMEOUT_SEC = 300               # バッチ1件あたりの応答待ち時間
+RAG_INDEX_PROBE_BYTES = 2000               # 索引の確認に使う、登録済みファイル先頭のバイト数
+
+_RAG_REGISTRY: Optional[CacheControl.SQLiteCache] = None
+
+def _get_rag_registry() -> CacheControl.SQLiteCache:
+    global _RAG_REGISTRY
+    if _RAG_REGISTRY is None:
+        _RAG_REGISTRY = CacheControl.SQLiteCache(RAG_REGISTRY_FILE, namespace="rag_registry")
+    return _RAG_REGISTRY
+
+def _hash_file(path: str, block_size: int = 1024 * 1024) -> str:
+    """ファイル内容のハッシュを、全体をメモリに載せずに計算する"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _collect_rag_upload_targets(
+    file_paths: List[str], rag_server_url: str, force: bool
+) -> Tuple[List[Tuple[str, int, Dict[str, Any]]], List[str]]:
+    """
+    登録が必要なファイルを ([(パス, サイズ, 記録する情報)], 変更なしでスキップしたパス) で返す。
+    サイズと更新時刻が前回と同じファイルはハッシュ計算も省略します。
+    """
+    registry = _get_rag_registry()
+    targets: List[Tuple[str, int, Dict[str, Any]]] = []
+    unchanged: List[str] = []
     for path in file_paths:
         try:
-            files_to_upload.append(('files', (os.path.basename(path), open(path, 'rb'))))
+            stat = os.stat(path)
         except FileNotFoundError:
             print(f"RAG: 警告: ファイル {path} が見つかりません。アップロードをスキップします。", file=sys.stderr)
             continue
-        except Exception as e:
+        except OSError as e:
             print(f"RAG: 警告: ファイル {path} の準備中にエラーが発生しました: {e}", file=sys.stderr)
             continue
 
-    if not files_to_upload:
-        print("RAG: 警告: アップロードする有効なファイルがありません。RAGをスキップします。", file=sys.stderr)
-        return False
+        registry_key = f"{rag_server_url}|{os.path.abspath(path)}"
+        record = registry.get(registry_key) if not force else None
+        if record and record.get("size") == stat.st_size and record.get("mtime") == stat.st_mtime:
+            unchanged.append(path)
+            continue
 
-    print(f"RAG: サーバー ({rag_server_url}) に {len(files_to_upload)} 個のファイルを登録中...", file=sys.stderr)
-    try:
-        url = f"{rag_server_url}/register"
-        response = requests.post(url, files=files_to_upload, timeout=60)
-        
-        for _, (_, f) in files_to_upload:
-            f.close()
-            
         try:
-            result = response.json()
-        except requests.exceptions.JSONDecodeError:
-            print(f"RAG: サーバー応答エラー (非JSON形式): HTTP {response.status_code}", file=sys.stderr)
-            print(f"RAG: 応答本文: {response.text[:500]}", file=sys.stderr) 
-            response.raise_for_status() 
-            return False
+            file_hash = _hash_file(path)
+        except OSError as e:
+            print(f"RAG: 警告: ファイル {path} の読み込みに失敗しました: {e}", file=sys.stderr)
+            continue
+        new_record = {"hash": file_hash, "size": stat.st_size, "mtime": stat.st_mtime}
+        if record and record.get("hash") == file_hash:
+            # 内容が同じ (更新時刻のみ変化): 記録だけ更新して再登録しない
+            registry.set(registry_key, new_record)
+            unchanged.append(path)
+            continue
+        targets.append((path, stat.st_size, new_record))
+    return targets, unchanged
+
+def _split_upload_batches(
+    targets: List[Tuple[str, int, Dict[str, Any]]], max_bytes: int, max_files: int
+) -> List[List[Tuple[str, int, Dict[str, Any]]]]:
+    """ファイル数とバイト数の上限でバッチに分ける (上限を超える1ファイルは単独のバッチ)。(純粋)"""
+    batches: List[List[Tuple[str, int, Dict[str, Any]]]] = []
+    current: List[Tuple[str, int, Dict[str, Any]]] = []
+    current_bytes = 0
+    for target in targets:
+        if current and (len(current) >= max_files or current_bytes + target[1] > max_bytes):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(target)
+        current_bytes += target[1]
+    if current:
+        batches.append(current)
+    return batches
+
+def _parse_rag_register_response(response: requests.Response, expected_files: Optional[int] = None) -> bool:
+    """/register の応答を解釈し、登録に成功したかを返す (expected_files 件のうち一部だけ受け付けられた場合も失敗)"""
+    try:
+        result = response.json()
+    except requests.exceptions.JSONDecodeError:
+        print(f"RAG: サーバー応答エラー (非JSON形式): HTTP {response.status_code}", file=sys.stderr)
+        print(f"RAG: 応答本文: {response.text[:500]}", file=sys.stderr) 
+        response.raise_for_status() 
+        return False
 
-        if result.get("status") in ["ok","success", "accepted"]:
-            chunks_registered = result.get('chunks',result.get('files',0))
-            print(f"RAG: サーバー登録結果: {json.dumps(result, ensure_ascii=False)}", file=sys.stderr)
-            if chunks_registered == 0:
-                print("RAG: 警告: 登録チャンク数がゼロのため、RAGは無効です。", file=sys.stderr)
-                return False 
-            return True
-        
-        elif result.get("status") == "error":
-            print(f"RAG: サーバー登録エラー (status=error):", file=sys.stderr)
-            print(f"RAG: 応答メッセージ: {result.get('message', 'メッセージなし')}", file=sys.stderr)
+    if result.get("status") in ["ok","success", "accepted"]:
+        chunks_registered = result.get('chunks',result.get('files',0))
+        print(f"RAG: サーバー登録結果: {json.dumps(result, ensure_ascii=False)}", file=sys.stderr)
+        if chunks_registered == 0:
+            print("RAG: 警告: 登録チャンク数がゼロのため、RAGは無効です。", file=sys.stderr)
+            return False 
+        accepted_files = result.get("files")
+        if expected_files is not None and isinstance(accepted_files, int) and accepted_files < expected_files:
+            print(f"RAG: 警告: {expected_files} 個中 {accepted_files} 個のファイルしか登録されませんでした。", file=sys.stderr)
             return False
+        return True
+    
+    elif result.get("status") == "error":
+        print(f"RAG: サーバー登録エラー (status=error):", file=sys.stderr)
+        print(f"RAG: 応答メッセージ: {result.get('message', 'メッセージなし')}", file=sys.stderr)
+        return False
 
-        else:
-            print(f"RAG: サーバー応答エラー (予期しないステータス): {json.dumps(result, ensure_ascii=False)}", file=sys.stderr)
-            return False
+    else:
+        print(f"RAG: サーバー応答エラー (予期しないステータス): {json.dumps(result, ensure_ascii=False)}", file=sys.stderr)
+        return False
 
+def _upload_rag_batch(batch: List[Tuple[str, int, Dict[str, Any]]], url: str, session: requests.Session) -> bool:
+    """1バッチ分のファイルを開いて POST し、送信後すぐに閉じる"""
+    with contextlib.ExitStack() as stack:
+        files_to_upload = [
+            ('files', (os.path.basename(path), stack.enter_context(open(path, 'rb'))))
+            for path, _, _ in batch
+        ]
+        response = session.post(url, files=files_to_upload, timeout=(10, RAG_UPLOAD_TIMEOUT_SEC))
+    try:
+        return _parse_rag_register_response(response, len(batch))
     except requests.exceptions.HTTPError as e:
         print(f"RAG: サーバー接続エラー (HTTP Error): {e}", file=sys.stderr)
         print(f"RAG: エラー応答本文: {response.text[:500]}", file=sys.stderr)
         return False
 
-    except requests.exceptions.RequestException as e:
-        print(f"RAG: サーバー接続または処理中にエラーが発生しました (ネットワーク/接続): {e}", file=sys.stderr)
+def rag_server_register(
+    path_list: Union[str,List[str]],
+    rag_server_url: str,
+    force: bool = False,
+    rag_client: Optional["RAGClient"] = None
+) -> bool:
+    """
+    FastAPIサーバーの /register エンドポイントを呼び出し、ファイルを登録します。
+    前回登録時から内容が変わっていないファイルは送信しません (force=True で全件再登録)。
+    ただし、サーバーの索引が失われている (登録済みのファイルが検索で見つからない) 場合は全件を再登録します。
+    送信はファイル数・バイト数で区切ったバッチ単位で、RAG_UPLOAD_PARALLELISM 件ずつ並行して行います。
+    1バッチでも登録に失敗した場合は False を返します (失敗したファイルは次回再送されます)。
+    """
+    client = rag_client or get_rag_client(rag_server_url)
+    file_paths = FileControl.get_file_path_list(path_list, recursive = True)
+    targets, unchanged = _collect_rag_upload_targets(file_paths, rag_server_url, force)
+    if unchanged and client.has_indexed(unchanged[0]) is False:
+        print("RAG: 警告: 登録済みのファイルがサーバーの索引に見つかりません。全件を再登録します。", file=sys.stderr)
+        targets, unchanged = _collect_rag_upload_targets(file_paths, rag_server_url, True)
+
+    if not targets:
+        if unchanged:
+            print(f"RAG: {len(unchanged)} 個のファイルは登録済み (変更なし) のため、登録をスキップします。", file=sys.stderr)
+            return True
+        print("RAG: 警告: アップロードする有効なファイルがありません。RAGをスキップします。", file=sys.stderr)
+        return False
+
+    batches = _split_upload_batches(targets, RAG_UPLOAD_BATCH_BYTES, RAG_UPLOAD_BATCH_FILES)
+    total_bytes = sum(size for _, size, _ in targets)
+    print(
+        f"RAG: サーバー ({rag_server_url}) に {len(targets)} 個のファイル ({total_bytes / (1024 ** 2):.1f}MB) を "
+        f"{len(batches)} バッチで登録中... (変更なし: {len(unchanged)} 個)", file=sys.stderr
+    )
+
+    url = f"{rag_server_url}/register"
+    registry = _get_rag_registry()
+    session = client.session
+
+    def upload(indexed_batch: Tuple[int, List[Tuple[str, int, Dict[str, Any]]]]) -> bool:
+        batch_no, batch = indexed_batch
+        start_time = time.perf_counter()
+        try:
+            ok = _upload_rag_batch(batch, url, session)
+        except requests.exceptions.RequestException as e:
+            print(f"RAG: サーバー接続または処理中にエラーが発生しました (ネットワーク/接続): {e}", file=sys.stderr)
+            ok = False
+        except OSError as e:
+            print(f"RAG: 警告: バッチ {batch_no} のファイルを開けませんでした: {e}", file=sys.stderr)
+            ok = False
+        if ok:
+            # 成功したバッチのみ登録済みとして記録する (失敗分は次回再送)
+            registry.set_many({f"{rag_server_url}|{os.path.abspath(path)}": record for path, _, record in batch})
+        batch_bytes = sum(size for _, size, _ in batch)
+        print(
+            f"RAG: バッチ {batch_no}/{len(batches)} {'完了' if ok else '失敗'} "
+            f"({len(batch)} 個 / {batch_bytes / (1024 ** 2):.1f}MB / {time.perf_counter() - start_time:.1f}秒)",
+            file=sys.stderr
+        )
+        return ok
+
+    results = _run_bounded_parallel(upload, enumerate(batches, start=1), RAG_UPLOAD_PARALLELISM)
+    succeeded = sum(1 for ok in results if ok)
+    if succeeded < len(batches):
+        print(f"RAG: 警告: {len(batches) - succeeded}/{len(batches)} バッチの登録に失敗しました。", file=sys.stderr)
         return False
+    return True
     
-def rag_server_query_context(
-    query: str,
-    rag_server_url: str,
-    top_k: Optional[int] = None,
-    score_threshold: Optional[float] = None
-) -> str:
-    if not query.strip():
+def _join_rag_contexts(result: Dict[str, Any], score_threshold: Optional[float]) -> str:
+    """/query の応答 (1クエリ分) を参照テキストに変換する"""
+    count = result.get("count", result.get("hit_count", 0))
+    contexts = result.get("contexts", [])
+    if count == 0:
+        print(f"RAG: 関連コンテキストなし{result}", file=sys.stderr)
         return ""
 
-    print(f"RAG: サーバー ({rag_server_url}) でクエリを実行中...", file=sys.stderr)
-    try:
-        url = f"{rag_server_url}/query"
+    print(f"RAG: {count} 件取得（threshold={score_threshold}）", file=sys.stderr)
+    return "\n\n".join(c["text"] for c in contexts if "text" in c)
+
+class RAGClient:
+    """
+    RAGサーバー (FastAPI) のクライアント。
+    keep-alive のセッションを使い回し、接続エラーや 502/503/504 は指定回数まで自動で再試行します。
+    """
+
+    def __init__(
+        self,
+        base_url: str = RAG_SERVER_URL,
+        pool_size: int = 8,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        timeout: float = 30
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._batch_supported: Optional[bool] = None  # /query_batch の有無 (初回呼び出しで判定)
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=None,  # POST も再試行する (登録・検索は同じ内容の再送で問題ない)
+            raise_on_status=False
+        )
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
-        payload = {"query": query}
+    def _query_payload(self, top_k: Optional[int], score_threshold: Optional[float]) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {}
         if top_k is not None:
             payload["top_k"] = top_k
         if score_threshold is not None:
             payload["score_threshold"] = score_threshold
+        return payload
 
-        response = requests.post(url, json=payload, timeout=30)
-        response.raise_for_status()
-        result = response.json()
+    def query(self, query: str, top_k: Optional[int] = None, score_threshold: Optional[float] = None) -> str:
+        """1件のクエリを実行し、参照テキストを返す (失敗時は空文字)"""
+        if not query.strip():
+            return ""
+
+        print(f"RAG: サーバー ({self.base_url}) でクエリを実行中...", file=sys.stderr)
+        try:
+            payload = {"query": query, **self._query_payload(top_k, score_threshold)}
+            response = self.session.post(f"{self.base_url}/query", json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            return _join_rag_contexts(response.json(), score_threshold)
 
-        count = result.get("count", result.get("hit_count", 0))
-        contexts = result.get("contexts", [])
-        if count == 0:
-            print(f"RAG: 関連コンテキストなし{result}", file=sys.stderr)
+        except requests.exceptions.RequestException as e:
+            print(f"RAG: エラー: {e}", file=sys.stderr)
             return ""
 
-        print(f"RAG: {count} 件取得（threshold={score_threshold}）", file=sys.stderr)
-        joined = "\n\n".join(c["text"] for c in contexts if "text" in c)
-        return joined
-    
-    except requests.exceptions.RequestException as e:
-        print(f"RAG: エラー: {e}", file=sys.stderr)
-        return ""
+    def query_batch(
+        self,
+        queries: List[str],
+        top_k: Optional[int] = None,
+        score_threshold: Optional[float] = None,
+        max_workers: int = 4
+    ) -> List[str]:
+        """
+        複数のクエリを /query_batch で1往復にまとめて実行し、入力順の参照テキストを返す。
+        サーバーに /query_batch が無い場合は、単発の /query を max_workers 並列で実行します。
+        """
+        if not queries:
+            return []
+        if self._batch_supported is not False:
+            print(f"RAG: サーバー ({self.base_url}) で {len(queries)} 件のクエリを一括実行中...", file=sys.stderr)
+            try:
+                payload = {"queries": list(queries), **self._query_payload(top_k, score_threshold)}
+                response = self.session.post(f"{self.base_url}/query_batch", json=payload, timeout=self.timeout)
+                if response.status_code in (404, 405, 501):
+                    print("RAG: /query_batch が無いため、単発クエリの並列実行に切り替えます。", file=sys.stderr)
+                    self._batch_supported = False
+                else:
+                    response.raise_for_status()
+                    results = response.json().get("results", [])
+                    if len(results) == len(queries):
+                        self._batch_supported = True
+                        return [_join_rag_contexts(result, score_threshold) for result in results]
+                    print(f"RAG: 一括応答の件数が一致しません ({len(results)}/{len(queries)})。単発で再実行します。", file=sys.stderr)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"RAG: 一括クエリに失敗したため単発で実行します: {e}", file=sys.stderr)
+
+        return _run_bounded_parallel(lambda q: self.query(q, top_k, score_threshold), queries, max_workers)
+
+    def has_indexed(self, path: str) -> Optional[bool]:
+        """
+        登録済みのファイルがサーバーの索引に残っているかを、ファイル先頭のテキストで検索して確かめる。
+        1件もヒットしなければ False (再起動などで索引が失われた)、確認できなかった場合は None を返します。
+        """
+        try:
+            with open(path, "rb") as f:
+                raw_data = f.read(RAG_INDEX_PROBE_BYTES)
+            encoding = _detect_encoding_from_bytes(raw_data, is_complete=False)[0]
+            probe = raw_data.decode(encoding, errors="ignore").strip()
+            if not probe:
+                return None
+            response = self.session.post(f"{self.base_url}/query", json={"query": probe, "top_k": 1}, timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+        except (OSError, LookupError, requests.exceptions.RequestException, ValueError) as e:
+            print(f"RAG: 索引の確認に失敗しました (登録済みの記録を使います): {e}", file=sys.stderr)
+            return None
+        return result.get("count", result.get("hit_count", len(result.get("contexts", [])))) > 0
+
+    def register(self, path_list: Union[str, List[str]], force: bool = False) -> bool:
+        """rag_server_register をこのクライアントのセッションで実行する"""
+        return rag_server_register(path_list, self.base_url, force=force, rag_client=self)
+
+    def close(self):
+        self.session.close()
+
+_RAG_CLIENTS: Dict[str, RAGClient] = {}
+_RAG_CLIENTS_LOCK = threading.Lock()
+
+def get_rag_client(rag_server_url: str = RAG_SERVER_URL) -> RAGClient:
+    """接続先URLごとに RAGClient を1つだけ作り、使い回す"""
+    key = rag_server_url.rstrip("/")
+    with _RAG_CLIENTS_LOCK:
+        client = _RAG_CLIENTS.get(key)
+        if client is None:
+            client = RAGClient(key)
+            _RAG_CLIENTS[key] = client
+        return client
+
+def rag_server_query_context(
+    query: str,
+    rag_server_url: str,
+    top_k: Optional[int] = None,
+    score_threshold: Optional[float] = None
+) -> str:
+    return get_rag_client(rag_server_url).query(query, top_k, score_threshold)
+
+def rag_server_query_contexts(
+    queries: List[str],
+    rag_server_url: str,
+    top_k: Optional[int] = None,
+    score_threshold: Optional[float] = None
+) -> List[str]:
+    """複数のクエリをまとめて実行し、入力順の参照テキストを返す"""
+    return get_rag_client(rag_server_url).query_batch(queries, top_k, score_threshold)
 
 # ====================================================================
 # VI. マルチソース分析オーケストレーション関数
 # ====================================================================
 
+INHERITANCE_TRUNCATED_MARK = "...(Truncated)...\n"
+
+def _truncate_head_to_tokens(text: str, max_tokens: int, model_name: str) -> str:
+    """text が max_tokens を超える場合、先頭を切り詰めて印を付け、印を含めて max_tokens 以内に収める"""
+    if count_tokens(text, model_name) <= max_tokens:
+        return text
+    keep_tokens = max_tokens - count_tokens(INHERITANCE_TRUNCATED_MARK, model_name)
+    if keep_tokens <= 0:
+        return ""
+    return INHERITANCE_TRUNCATED_MARK + get_last_n_tokens_text(text, keep_tokens, model_name)
+
 def _get_safe_inheritance_data(ctx_data: Any, model_name: str, max_tokens: int) -> str:
-    """継承データを文字列化し、トークン制限を超えた場合に先頭を切り詰める"""
+    """継承データを文字列化し、トークン制限を超えた場合に先頭を切り詰める (トークン境界で正確に切る)"""
     if not ctx_data:
         return ""
     
     data_str = ctx_data if isinstance(ctx_data, str) else json.dumps(ctx_data, ensure_ascii=False)
-    current_tokens = count_tokens(data_str, model_name)
-    
-    if current_tokens > max_tokens:
+    truncated = _truncate_head_to_tokens(data_str, max_tokens, model_name)
+    if truncated != data_str:
         print(f"DEBUG: 継承データが制限({max_tokens})を超えたため切り詰めます。", file=sys.stderr)
-        ratio = max_tokens / current_tokens
-        cut_index = int(len(data_str) * (1 - ratio))
-        return "...(Truncated)...\n" + data_str[cut_index:]
-    
-    return data_str
+    return truncated
+
+def _complete_char_count(encoding: Any, tokens: List[int]) -> int:
+    """
+    トークン列に完全に含まれる文字数を返します。
+    先頭・末尾でマルチバイト文字の途中から/途中までしか含まない文字は数えません。
+    """
+    return len(encoding.decode_bytes(tokens).decode("utf-8", errors="ignore"))
 
 def _find_token_boundary_index(text: str, limit: int, model_name: str, from_end: bool = False) -> int:
-    """指定トークン数に収まる文字数のインデックスを二分探索で返す"""
-    low, high = 0, len(text)
-    best_idx = 0 if from_end else 0
-    
-    while low <= high:
-        mid = (low + high) // 2
-        test_chunk = text[-mid:] if from_end else text[:mid]
-        if count_tokens(test_chunk, model_name) <= limit:
-            best_idx = mid
-            low = mid + 1
-        else:
-            high = mid - 1
-    return best_idx
+    """指定トークン数に収まる文字数を、一度のエンコード結果から返す"""
+    encoding = get_tokenizer(model_name)
+    tokens = encoding.encode(text)
+    total = len(tokens)
+    if total <= limit:
+        return len(text)
+    if limit <= 0:
+        return 0
+
+    # 境界に必要な範囲のトークンだけをバイト列に戻して文字数を数える
+    if from_end:
+        return _complete_char_count(encoding, tokens[total - limit:])
+    return _complete_char_count(encoding, tokens[:limit])
+
+def _iter_windowed_chunks(
+    read_chars: Callable[[int], str],
+    limit: int,
+    model_name: str,
+    overlap_tokens: int = 0,
+    initial_chars_per_token: float = 4.0
+) -> Iterator[str]:
+    """
+    read_chars(n) で少しずつ供給される文字列を、limit トークンずつのチャンクにして順に返します。
+    保持するのは「次のチャンク + 読み足し分」だけで、文書全体を持つことはありません。
+    読み足す文字数は直前のエンコード結果から推定した文字/トークン比で決めます。
+    読み足しの間はトークン数を文字/トークン比で見積もり、エンコードはチャンクを切り出す時に
+    バッファ全体を1回だけ行います (持ち越した重なり・読み足し分は次のチャンクで再度エンコードされます)。
+    """
+    encoding = get_tokenizer(model_name)
+    buffer = ""
+    eof = False
+    chars_per_token = initial_chars_per_token
+    estimated_tokens = 0.0  # buffer のトークン数の見積もり
+
+    while True:
+        # limit を超えると見込めるまで読み足す
+        while not eof and estimated_tokens <= limit:
+            need_tokens = limit - estimated_tokens + max(1, overlap_tokens)
+            piece = read_chars(max(1024, int(need_tokens * chars_per_token * 1.1)))
+            if not piece:
+                eof = True
+                break
+            buffer += piece
+            estimated_tokens += len(piece) / chars_per_token
+
+        # チャンク境界はバッファ全体のエンコード結果で決める
+        tokens = encoding.encode(buffer)
+        total = len(tokens)
+        if total:
+            chars_per_token = max(0.1, len(buffer) / total)
+        if not eof and total <= limit:
+            # 見積もりより少なかった場合は読み足しを続ける
+            estimated_tokens = total
+            continue
+        if total == 0:
+            return
+
+        end = min(total, limit)
+        chunk = buffer[:_complete_char_count(encoding, tokens[:end])] if end < total else buffer
+        if not chunk:
+            # 1文字で limit を超える場合は、その1文字だけを超過したチャンクとして返す
+            chunk = buffer[:1]
+        yield chunk
+        if eof and end >= total:
+            return
+
+        # 重なり分を戻しても必ず1文字以上は前進させる
+        # (next_start までのトークンがマルチバイト文字の途中までしか含まない場合、完全な文字数は 0 になる)
+        next_start = max(1, end - overlap_tokens)
+        advance = max(1, _complete_char_count(encoding, tokens[:next_start]))
+        buffer = buffer[advance:]
+        estimated_tokens = total - next_start
+
+def iter_text_chunks(text: str, limit: int, model_name: str, overlap_tokens: int = 0) -> Iterator[str]:
+    """
+    文字列を limit トークンずつのチャンクとして遅延生成します。
+    元の文字列はオフセットで参照するだけで、残り全体のコピーは作りません。
+    """
+    position = 0
+
+    def read_chars(size: int) -> str:
+        nonlocal position
+        piece = text[position:position + size]
+        position += len(piece)
+        return piece
+
+    return _iter_windowed_chunks(read_chars, limit, model_name, overlap_tokens)
+
+# ファイルサイズがこれ以上のソースは、全体を読み込まずメモリマップから逐次チャンク化する
+LARGE_FILE_THRESHOLD_BYTES = 8 * 1024 * 1024
+MMAP_RELEASE_BYTES = 16 * 1024 * 1024  # 読み終えたページをこの単位で解放する
+
+def _build_incremental_char_reader(
+    read_bytes: Callable[[int], bytes],
+    encoding: str,
+    bytes_per_char: float = 3.0,
+    errors: str = "strict"
+) -> Callable[[int], str]:
+    """
+    バイト列の供給元から、文字境界を保って少しずつデコードする read_chars(n) を作ります。
+    改行はテキストモードで開いた場合と同じく \\n に揃えます (ブロック境界をまたぐ \\r\\n も考慮)。
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+    pending = ""
+    eof = False
+
+    def read_chars(size: int) -> str:
+        nonlocal pending, eof
+        while len(pending) < size and not eof:
+            block = read_bytes(max(4096, int((size - len(pending)) * bytes_per_char)))
+            eof = not block
+            pending += decoder.decode(block, final=eof)
+            if not eof and pending.endswith("\r"):
+                # 次のブロックの先頭が \n の可能性があるため、\r は次回まで保留する
+                held = "\r"
+                pending = pending[:-1]
+            else:
+                held = ""
+            pending = pending.replace("\r\n", "\n").replace("\r", "\n") + held
+        if eof:
+            pending = pending.replace("\r", "\n")
+        piece, pending = pending[:size], pending[size:]
+        if not eof and piece.endswith("\r") and len(piece) > 1:
+            piece, pending = piece[:-1], "\r" + pending
+        return piece
+
+    return read_chars
+
+def iter_file_chunks(
+    file_path: Union[str, Path],
+    limit: int,
+    model_name: str,
+    overlap_tokens: int = 0,
+    encoding: Optional[str] = None
+) -> Iterator[str]:
+    """
+    テキストファイルを先頭から少しずつ読み込み、limit トークンずつのチャンクとして遅延生成します。
+    ファイルはメモリマップで開き、必要な範囲だけをインクリメンタルにデコードするため、
+    ファイル全体をメモリに読み込むことはありません (RSS はファイルサイズに依存しません)。
+    encoding を省略した場合はファイル全体を厳密にデコードできるエンコーディングを推定し (detect_full_file_encoding)、
+    デコードできないバイトは黙って捨てずに置換文字にします。
+    """
+    if encoding:
+        encoding_to_use, errors = encoding, "strict"
+    else:
+        encoding_to_use = detect_full_file_encoding(file_path)
+        errors = "replace"
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            can_advise = hasattr(mapped, "madvise")
+            if can_advise and hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            released = 0
+
+            def read_bytes(size: int) -> bytes:
+                nonlocal released
+                block = mapped.read(size)
+                # 読み終えた範囲のページを手放し、RSS がファイルサイズに比例して増えないようにする
+                position = mapped.tell() - mapped.tell() % mmap.ALLOCATIONGRANULARITY
+                if can_advise and hasattr(mmap, "MADV_DONTNEED") and position - released >= MMAP_RELEASE_BYTES:
+                    mapped.madvise(mmap.MADV_DONTNEED, 0, position)
+                    released = position
+                return block
+
+            read_chars = _build_incremental_char_reader(read_bytes, encoding_to_use, errors=errors)
+            yield from _iter_windowed_chunks(read_chars, limit, model_name, overlap_tokens)
+
+def open_text_source(file_path: Union[str, Path], large_file_threshold: int = LARGE_FILE_THRESHOLD_BYTES) -> Union[str, Path]:
+    """
+    answer_question に渡すファイルソースを用意します。
+    大きなファイルは Path のまま返し (answer_question 側でメモリマップから逐次チャンク化)、
+    小さなファイルは従来どおり文字列として読み込みます。
+    """
+    if os.path.getsize(file_path) >= large_file_threshold:
+        print(f"{file_path} は大きいため、メモリマップで逐次読み込みます。", file=sys.stderr)
+        return Path(file_path)
+    return read_previous_output(str(file_path))
+
+def _iter_source_chunks(
+    data_source: Union[str, Path, Iterable[str]],
+    limit: int,
+    model_name: str,
+    overlap_tokens: int = 0
+) -> Iterator[str]:
+    """
+    answer_question に渡されたデータソースの種類に応じてチャンクを遅延生成します。
+    - str: メモリ上のテキスト
+    - Path: ファイル (逐次読み込み)
+    - その他の Iterable[str]: 呼び出し側が用意した断片 (limit を超える断片はさらに分割)
+    """
+    if isinstance(data_source, str):
+        yield from iter_text_chunks(data_source, limit, model_name, overlap_tokens)
+    elif isinstance(data_source, os.PathLike):
+        yield from iter_file_chunks(data_source, limit, model_name, overlap_tokens)
+    else:
+        for piece in data_source:
+            yield from iter_text_chunks(str(piece), limit, model_name, overlap_tokens)
 
 def get_chunk_by_token_limit(text: str, limit: int, model_name: str) -> Tuple[str, str]:
     idx = _find_token_boundary_index(text, limit, model_name)
@@ -659,6 +1688,84 @@ def get_last_n_tokens_text(text: str, n: int, model_name: str) -> str:
     idx = _find_token_boundary_index(text, n, model_name, from_end=True)
     return text[-idx:] if idx > 0 else ""
 
+# --- 小さなソースのパッキング (複数ソースを1リクエストにまとめる) ---
+PACKED_SOURCE_BEGIN_TAG = '<<<SOURCE id="{source_id}" name="{name}">>>'
+PACKED_SOURCE_END_TAG = '<<<END SOURCE id="{source_id}">>>'
+_PACKED_SOURCE_PATTERN = re.compile(
+    r'<<<SOURCE id="(?P<source_id>[^"]+)"[^>]*>>>(?P<body>.*?)<<<END SOURCE id="(?P=source_id)">>>',
+    re.DOTALL
+)
+
+PACKED_SOURCE_PROMPT = """・[参照データ]には複数のソースが含まれており、各ソースは <<<SOURCE id="番号" name="名前">>> と <<<END SOURCE id="番号">>> のタグで囲まれています。
+・ソースごとに独立して回答を生成してください。ソース間で内容を混ぜないでください。
+・各回答は、対応するソースと同じ id の <<<SOURCE id="番号" name="名前">>> と <<<END SOURCE id="番号">>> のタグで囲んで出力してください。
+・すべてのソースについて、入力と同じ順序で出力してください。"""
+
+def get_packing_budget(model_name: str, question: str, output_ratio: float = 0.5) -> int:
+    """
+    パッキング1リクエストあたりに入力できるソースのトークン数を返します。
+    出力も同じコンテキストに収める必要があるため、output_ratio の分を出力用に残します。
+    """
+    context_window_limit = get_context_window_size(model_name)
+    reserved_tokens = count_tokens(question + PACKED_SOURCE_PROMPT, model_name) + 100
+    return max(0, int((context_window_limit - reserved_tokens) * (1 - output_ratio)))
+
+def _format_packed_source(source_id: str, name: str, content: str) -> str:
+    safe_name = str(name).replace('"', "'")
+    begin = PACKED_SOURCE_BEGIN_TAG.format(source_id=source_id, name=safe_name)
+    end = PACKED_SOURCE_END_TAG.format(source_id=source_id)
+    return f"{begin}\n{content}\n{end}"
+
+def pack_sources(
+    sources: List[Tuple[str, str]],
+    budget_tokens: int,
+    model_name: str
+) -> Tuple[List[List[int]], List[int]]:
+    """
+    (名前, 本文) のリストを、タグ込みのトークン数が budget_tokens に収まる束へ詰め込みます (First-Fit Decreasing)。
+    戻り値は (束ごとのインデックスリスト, 単独でも予算を超えるため詰め込めないインデックス) です。
+    束の中のインデックスは元の順序に並べ直して返します。
+    """
+    tagged_texts = [_format_packed_source(str(i), name, content) for i, (name, content) in enumerate(sources)]
+    token_counts = count_tokens_batch(tagged_texts, model_name)
+
+    oversize = [i for i, tokens in enumerate(token_counts) if tokens > budget_tokens]
+    candidates = sorted(
+        (i for i, tokens in enumerate(token_counts) if tokens <= budget_tokens),
+        key=lambda i: token_counts[i],
+        reverse=True
+    )
+
+    bins: List[List[int]] = []
+    bin_remaining: List[int] = []
+    for i in candidates:
+        for b, remaining in enumerate(bin_remaining):
+            if token_counts[i] <= remaining:
+                bins[b].append(i)
+                bin_remaining[b] -= token_counts[i]
+                break
+        else:
+            bins.append([i])
+            bin_remaining.append(budget_tokens - token_counts[i])
+
+    return [sorted(b) for b in bins], oversize
+
+def build_packed_source_text(sources: List[Tuple[str, str]], indexes: List[int]) -> str:
+    """pack_sources で得た束を、ソースごとにタグ付けした1つの参照データに組み立てます。(純粋)"""
+    return "\n\n".join(_format_packed_source(str(i), sources[i][0], sources[i][1]) for i in indexes)
+
+def split_packed_output(text: str) -> Dict[str, str]:
+    """
+    パッキングしたリクエストの出力を、ソースIDごとの回答に分割します。(純粋)
+    同じIDが複数回出現した場合は結合します。
+    """
+    results: Dict[str, str] = {}
+    for match in _PACKED_SOURCE_PATTERN.finditer(text or ""):
+        source_id = match.group("source_id")
+        body = match.group("body").strip()
+        results[source_id] = f"{results[source_id]}\n\n{body}" if source_id in results else body
+    return results
+
 def build_prompt(template_list, **kwargs):
     """
     テンプレートリストを結合し、kwargsで渡された値で穴埋めする。
@@ -687,21 +1794,67 @@ def build_prompt(template_list, **kwargs):
         
     return "\n\n".join(resolved_lines)
 
-def execute_llm_request(
-    ollama_client: Any,
-    model_name: str,
-    question:str ,
-    prompt: str="",
-    system_prompt: str="",
-    assistant_message: str="",
-    format: Optional[str] = None,
-    stream: bool = False,
-    use_chat: bool = True,
-    options: Optional[Dict[str, Any]] = None
-) -> str:
+# --- モデルの常駐時間 (keep_alive) ---
+# None の場合はサーバー既定 (OLLAMA_KEEP_ALIVE) に従う。スケジューラがモデル単位で上書きする
+DEFAULT_KEEP_ALIVE: Optional[Union[str, int]] = None
+MODEL_KEEP_ALIVE: Dict[str, Union[str, int]] = {}  # モデル別の上書き設定 (例: {"qwen3-coder:30b": "30m"})
+
+def _resolve_keep_alive(model_name: str) -> Optional[Union[str, int]]:
+    return MODEL_KEEP_ALIVE.get(model_name, DEFAULT_KEEP_ALIVE)
+
+@contextlib.contextmanager
+def keep_alive_override(model_name: str, keep_alive: Union[str, int]) -> Iterator[None]:
+    """with 文の間だけ model_name の keep_alive を上書きし、終了時に元の設定へ戻す"""
+    previous = MODEL_KEEP_ALIVE.get(model_name, _MISSING_KEEP_ALIVE)
+    MODEL_KEEP_ALIVE[model_name] = keep_alive
+    try:
+        yield
+    finally:
+        if previous is _MISSING_KEEP_ALIVE:
+            MODEL_KEEP_ALIVE.pop(model_name, None)
+        else:
+            MODEL_KEEP_ALIVE[model_name] = previous
+
+_MISSING_KEEP_ALIVE = object()
+
+@LLM_Trace.traced("preload_model", "model", arg_names=("model_name",))
+def preload_model(ollama_client: Any, model_name: str, keep_alive: Union[str, int] = "30m") -> bool:
     """
-    OllamaのChatとGenerateの違いを吸収して実行し、テキスト結果を返す。
+    空プロンプトの generate を送り、モデルの重みをメモリに読み込ませる。
+    次に使うモデルを先読みし、切り替え時のロード待ちを隠すために使います。
     """
+    try:
+        start_time = time.perf_counter()
+        ollama_client.generate(model=model_name, prompt="", keep_alive=keep_alive)
+        print(f"🔥 モデル '{model_name}' をプリロードしました ({time.perf_counter() - start_time:.1f}秒)", file=sys.stderr)
+        return True
+    except Exception as e:
+        print(f"モデル '{model_name}' のプリロードに失敗しました: {e}", file=sys.stderr)
+        return False
+
+def unload_model(ollama_client: Any, model_name: str) -> bool:
+    """keep_alive=0 を送り、モデルを即座にメモリから解放させる"""
+    try:
+        ollama_client.generate(model=model_name, prompt="", keep_alive=0)
+        _LOADED_NUM_CTX.pop((_client_endpoint(ollama_client), model_name), None)
+        print(f"💤 モデル '{model_name}' をアンロードしました", file=sys.stderr)
+        return True
+    except Exception as e:
+        print(f"モデル '{model_name}' のアンロードに失敗しました: {e}", file=sys.stderr)
+        return False
+
+def _build_llm_request_kwargs(
+    model_name: str,
+    question: Union[str, List[Dict[str, Any]]],
+    prompt: str,
+    system_prompt: str,
+    assistant_message: str,
+    format: Optional[str],
+    stream: bool,
+    use_chat: bool,
+    options: Optional[Dict[str, Any]]
+) -> Dict[str, Any]:
+    """chat/generate に渡す引数を組み立てる。(純粋)"""
     # optionsがNoneや文字列の場合に空辞書に変換（エラー対策）
     safe_options = options if isinstance(options, dict) else {}
     
@@ -712,10 +1865,12 @@ def execute_llm_request(
         'format': format,
         'options': safe_options
     }
+    keep_alive = _resolve_keep_alive(model_name)
+    if keep_alive is not None:
+        api_kwargs['keep_alive'] = keep_alive
 
-    # 2. メソッドと特有の引数を設定
+    # 2. 特有の引数を設定
     if use_chat:
-        api_method = ollama_client.chat
         # full_prompt_or_messages がリストであることを確認
         if not isinstance(question, list):
             # 文字列で渡された場合はユーザーメッセージとして包む
@@ -728,34 +1883,1133 @@ def execute_llm_request(
             api_kwargs['messages'] = question
 
     else:
-        api_method = ollama_client.generate
         # 文字列であることを確認
         api_kwargs['prompt'] = str(question)+"\n"+str(system_prompt)+"\n"+str(prompt)
+    return api_kwargs
+
+# --- num_ctx の自動設定 ---
+# Ollama はリクエストの num_ctx 分の KV キャッシュを確保するため、プロンプト + 想定出力に合わせて小さく指定する。
+# num_ctx が変わるとモデルが再ロードされるので、値は少数の段階 (NUM_CTX_BUCKETS) に丸め、
+# 同じモデルには一度確保した大きさ以上を使い続ける (小さくしても再ロードの方が高くつくため)
+NUM_CTX_BUCKETS = (2048, 4096, 8192, 16384, 32768, 65536, 131072, 262144)
+NUM_CTX_OUTPUT_RESERVE = 2048   # options に num_predict が無い場合に見込む出力トークン数
+NUM_CTX_TEMPLATE_MARGIN = 64    # チャットテンプレートなどで追加されるトークン数の見込み
+AUTO_NUM_CTX = True             # False にすると num_ctx を指定しない (サーバー/Modelfile の設定に従う)
+_LOADED_NUM_CTX: Dict[Tuple[str, str], int] = {}  # (接続先, モデル名) -> 最後に指定した num_ctx
+
+def _request_prompt_text(api_kwargs: Dict[str, Any]) -> str:
+    if "messages" in api_kwargs:
+        return "\n".join(str(message.get("content", "")) for message in api_kwargs["messages"])
+    return str(api_kwargs.get("prompt", ""))
+
+def _select_num_ctx(required_tokens: int, context_limit: int, loaded: Optional[int] = None) -> int:
+    """
+    required_tokens 以上の最小の段階を返す (モデルのコンテキスト長を上限とする)。(純粋)
+    loaded (ロード済みの num_ctx) が十分大きい場合はそれを再利用する。
+    """
+    if loaded is not None and required_tokens <= loaded <= context_limit:
+        return loaded
+    bucket = next((size for size in NUM_CTX_BUCKETS if size >= required_tokens), NUM_CTX_BUCKETS[-1])
+    return min(bucket, context_limit)
+
+def _apply_num_ctx(api_kwargs: Dict[str, Any], model_name: str, ollama_client: Any):
+    """options に num_ctx が無ければ、プロンプト + 想定出力が収まる段階の値を設定する (呼び出し元の options は変更しない)"""
+    options = api_kwargs.get("options") or {}
+    if not AUTO_NUM_CTX or "num_ctx" in options:
+        return
+    num_predict = options.get("num_predict")
+    output_tokens = num_predict if isinstance(num_predict, int) and num_predict > 0 else NUM_CTX_OUTPUT_RESERVE
+    required = count_tokens(_request_prompt_text(api_kwargs), model_name) + output_tokens + NUM_CTX_TEMPLATE_MARGIN
+    key = (_client_endpoint(ollama_client), model_name)
+    num_ctx = _select_num_ctx(required, get_context_window_size(model_name), _LOADED_NUM_CTX.get(key))
+    if required > num_ctx:
+        print(f"警告: プロンプト + 出力 ({required} tokens) がモデル '{model_name}' のコンテキスト長 ({num_ctx}) を超えています。", file=sys.stderr)
+    _LOADED_NUM_CTX[key] = num_ctx
+    api_kwargs["options"] = {**options, "num_ctx": num_ctx}
+
+def _extract_response_content(response: Any, use_chat: bool) -> str:
+    """chat は message -> content、generate は response からテキストを取り出す"""
+    if use_chat:
+        return response.get('message', {}).get('content', '') or ''
+    return response.get('response', '') or ''
+
+def _record_request_metrics(
+    metrics: Optional[Dict[str, Any]],
+    model_name: str,
+    start_time: float,
+    first_token_time: Optional[float],
+    final_response: Any,
+    text: str,
+    aborted: bool = False
+):
+    """
+    1リクエスト分の計測値 (初回トークンまでの時間、生成速度など) を metrics に書き込む。
+    Ollama が返す eval_count / eval_duration があればそれを優先し、無ければ手元で数える。
+    テレメトリが有効な場合は、応答のトークン数・ロード/プロンプト評価/生成時間と合わせて記録する。
+    """
+    if metrics is None and not LLM_Telemetry.is_enabled():
+        return
+    end_time = time.perf_counter()
+    eval_count = final_response.get('eval_count') if final_response is not None else None
+    eval_duration = final_response.get('eval_duration') if final_response is not None else None
+
+    output_tokens = eval_count if eval_count else count_tokens(text, model_name)
+    if eval_count and eval_duration:
+        tokens_per_sec = eval_count / (eval_duration / 1e9)
+    else:
+        generation_sec = end_time - (first_token_time or start_time)
+        tokens_per_sec = output_tokens / generation_sec if generation_sec > 0 else 0.0
+
+    values = {
+        "model": model_name,
+        "ttft_sec": (first_token_time - start_time) if first_token_time else None,
+        "total_sec": end_time - start_time,
+        "output_tokens": output_tokens,
+        "tokens_per_sec": tokens_per_sec,
+        "aborted": aborted,
+    }
+    if metrics is not None:
+        metrics.update(values)
+        prompt_eval_count = final_response.get('prompt_eval_count') if final_response is not None else None
+        if prompt_eval_count:
+            metrics["prompt_tokens"] = prompt_eval_count
+    LLM_Telemetry.record_llm_call(values, final_response)
+
+# --- LLM応答キャッシュ (任意) ---
+# 同じモデル・メッセージ・format・options の要求には保存済みの応答を返す。
+# configure_response_cache() で有効化するまでは使われない
+RESPONSE_CACHE_FILE = "./DocumentAuto/llm_response_cache.sqlite3"
+RESPONSE_CACHE: Optional[CacheControl.SQLiteCache] = None
+RESPONSE_CACHE_BYPASS = False  # True の間は読み出さずに再生成し、結果で上書きする
+
+def configure_response_cache(
+    cache_path: Optional[str] = RESPONSE_CACHE_FILE,
+    max_entries: Optional[int] = 50000,
+    max_bytes: Optional[int] = 1024 * 1024 * 1024,
+    ttl_sec: Optional[float] = None,
+    bypass: bool = False
+) -> Optional[CacheControl.SQLiteCache]:
+    """
+    応答キャッシュを有効化 (cache_path 指定) または無効化 (None / 空文字) する。
+    同じ設定での再呼び出しでは開いているキャッシュをそのまま使います。
+    """
+    global RESPONSE_CACHE, RESPONSE_CACHE_BYPASS
+    RESPONSE_CACHE_BYPASS = bypass
+    if not cache_path:
+        RESPONSE_CACHE = None
+        return None
+
+    current = RESPONSE_CACHE
+    if (current is not None and os.path.abspath(current.db_path) == os.path.abspath(cache_path)
+            and (current.max_entries, current.max_bytes, current.ttl_sec) == (max_entries, max_bytes, ttl_sec)):
+        return current
+
+    RESPONSE_CACHE = CacheControl.SQLiteCache(
+        cache_path, namespace="llm_response", max_entries=max_entries, max_bytes=max_bytes, ttl_sec=ttl_sec
+    )
+    print(f"LLM応答キャッシュを有効化しました: {cache_path} (登録数: {len(RESPONSE_CACHE)})", file=sys.stderr)
+    return RESPONSE_CACHE
+
+def _response_cache_key(api_kwargs: Dict[str, Any], use_chat: bool) -> str:
+    """応答に影響する要素 (モデル・メッセージ/プロンプト・format・options) からキーを作る。(純粋)"""
+    return CacheControl.make_cache_key(
+        "chat" if use_chat else "generate",
+        api_kwargs.get("model"),
+        api_kwargs.get("messages", api_kwargs.get("prompt")),
+        api_kwargs.get("format"),
+        api_kwargs.get("options") or {}
+    )
+
+def _get_cached_response(api_kwargs: Dict[str, Any], use_chat: bool, use_cache: bool) -> Tuple[Optional[str], Optional[str]]:
+    """(キャッシュ済み応答, キー) を返す。キャッシュを使わない場合はキーも None。"""
+    cache = RESPONSE_CACHE
+    if not use_cache or cache is None:
+        return None, None
+    cache_key = _response_cache_key(api_kwargs, use_chat)
+    if RESPONSE_CACHE_BYPASS:
+        return None, cache_key
+    return cache.get(cache_key), cache_key
+
+def _store_cached_response(cache_key: Optional[str], text: str, aborted: bool = False):
+    """中断されていない空でない応答のみ保存する"""
+    cache = RESPONSE_CACHE
+    if cache_key is None or cache is None or aborted or not text:
+        return
+    try:
+        cache.set(cache_key, text)
+    except Exception as e:
+        print(f"LLM応答キャッシュへの保存に失敗しました: {e}", file=sys.stderr)
+
+def _request_cache_key(request_kwargs: Dict[str, Any]) -> Optional[str]:
+    """execute_llm_request に渡す引数から、その応答を保存するキャッシュのキーを返す (キャッシュを使わない場合は None)"""
+    if RESPONSE_CACHE is None or not request_kwargs.get("use_cache", True):
+        return None
+    use_chat = request_kwargs.get("use_chat", True)
+    api_kwargs = _build_llm_request_kwargs(
+        request_kwargs["model_name"], request_kwargs["question"], request_kwargs.get("prompt", ""),
+        request_kwargs.get("system_prompt", ""), request_kwargs.get("assistant_message", ""),
+        request_kwargs.get("format"), request_kwargs.get("stream", False), use_chat, request_kwargs.get("options")
+    )
+    return _response_cache_key(api_kwargs, use_chat)
+
+def _discard_cached_response(request_kwargs: Dict[str, Any]):
+    """検証に失敗した応答を、次回のキャッシュヒットで返さないよう削除する"""
+    cache = RESPONSE_CACHE
+    cache_key = _request_cache_key(request_kwargs)
+    if cache is None or cache_key is None:
+        return
+    try:
+        cache.delete(cache_key)
+    except Exception as e:
+        print(f"LLM応答キャッシュからの削除に失敗しました: {e}", file=sys.stderr)
+
+def _record_cached_metrics(metrics: Optional[Dict[str, Any]], model_name: str, text: str):
+    if metrics is None and not LLM_Telemetry.is_enabled():
+        return
+    values = {
+        "model": model_name,
+        "ttft_sec": 0.0,
+        "total_sec": 0.0,
+        "output_tokens": count_tokens(text, model_name),
+        "tokens_per_sec": 0.0,
+        "aborted": False,
+        "cached": True
+    }
+    if metrics is not None:
+        metrics.update(values)
+    LLM_Telemetry.record_llm_call(values)
+
+def _prepare_llm_request(
+    ollama_client: Any,
+    model_name: str,
+    question: Union[str, List[Dict[str, Any]]],
+    prompt: str,
+    system_prompt: str,
+    assistant_message: str,
+    format: Optional[str],
+    stream: bool,
+    use_chat: bool,
+    options: Optional[Dict[str, Any]],
+    metrics: Optional[Dict[str, Any]],
+    use_cache: bool
+) -> Tuple[Dict[str, Any], Optional[str], Optional[str]]:
+    """
+    chat/generate の引数を組み立て、(引数, キャッシュ済みの応答, キャッシュのキー) を返す。
+    キャッシュに該当が無い場合は num_ctx を設定する (応答の内容に影響しないため、キャッシュのキーを作った後で設定する)。
+    """
+    api_kwargs = _build_llm_request_kwargs(
+        model_name, question, prompt, system_prompt, assistant_message, format, stream, use_chat, options
+    )
+    cached_text, cache_key = _get_cached_response(api_kwargs, use_chat, use_cache)
+    if cached_text is not None:
+        _record_cached_metrics(metrics, model_name, cached_text)
+        return api_kwargs, cached_text, cache_key
+    _apply_num_ctx(api_kwargs, model_name, ollama_client)
+    return api_kwargs, None, cache_key
+
+def _finish_llm_response(
+    response: Any,
+    model_name: str,
+    use_chat: bool,
+    start_time: float,
+    cache_key: Optional[str],
+    metrics: Optional[Dict[str, Any]]
+) -> str:
+    """ストリーミングしない応答からテキストを取り出し、計測値の記録とキャッシュへの保存を行う"""
+    text = _extract_response_content(response, use_chat).strip()
+    _record_request_metrics(metrics, model_name, start_time, None, response, text)
+    _store_cached_response(cache_key, text)
+    return text
+
+class _StreamCollector:
+    """ストリーミング応答のテキスト片・初回トークンの時刻・最終チャンクを集め、終了時に計測値の記録とキャッシュへの保存を行う"""
+
+    def __init__(self, model_name: str, use_chat: bool, start_time: float, cache_key: Optional[str], metrics: Optional[Dict[str, Any]]):
+        self.model_name = model_name
+        self.use_chat = use_chat
+        self.start_time = start_time
+        self.cache_key = cache_key
+        self.metrics = metrics
+        self.pieces: List[str] = []
+        self.first_token_time: Optional[float] = None
+        self.last_chunk: Any = None
+
+    def add(self, chunk: Any) -> str:
+        """チャンクからテキスト片を取り出して記録し、返す (テキストが無いチャンクは空文字列)"""
+        self.last_chunk = chunk
+        content = _extract_response_content(chunk, self.use_chat)
+        if content:
+            if self.first_token_time is None:
+                self.first_token_time = time.perf_counter()
+            self.pieces.append(content)
+        return content
+
+    def finish(self, aborted: bool = False) -> str:
+        text = "".join(self.pieces).strip()
+        _record_request_metrics(self.metrics, self.model_name, self.start_time, self.first_token_time, self.last_chunk, text, aborted)
+        _store_cached_response(self.cache_key, text, aborted)
+        return text
+
+@LLM_Trace.traced("llm_request", "llm", arg_names=("model_name", "stream"))
+def execute_llm_request(
+    ollama_client: Any,
+    model_name: str,
+    question:str ,
+    prompt: str="",
+    system_prompt: str="",
+    assistant_message: str="",
+    format: Optional[str] = None,
+    stream: bool = False,
+    use_chat: bool = True,
+    options: Optional[Dict[str, Any]] = None,
+    on_token: Optional[Callable[[str], Optional[bool]]] = None,
+    metrics: Optional[Dict[str, Any]] = None,
+    use_cache: bool = True
+) -> str:
+    """
+    OllamaのChatとGenerateの違いを吸収して実行し、テキスト結果を返す。
+    on_token を渡すとストリーミングで実行し、トークン到着ごとに呼び出します。
+    on_token が False を返した時点で生成を中断し、それまでのテキストを返します。
+    metrics (辞書) を渡すと、初回トークンまでの時間 (ttft_sec) や tokens_per_sec などを書き込みます。
+    応答キャッシュが有効 (configure_response_cache) で use_cache=True の場合、保存済みの応答を返します。
+    """
+    stream = stream or on_token is not None
+    api_kwargs, cached_text, cache_key = _prepare_llm_request(
+        ollama_client, model_name, question, prompt, system_prompt, assistant_message,
+        format, stream, use_chat, options, metrics, use_cache
+    )
+    if cached_text is not None:
+        if on_token is not None:
+            on_token(cached_text)
+        return cached_text
+    api_method = ollama_client.chat if use_chat else ollama_client.generate
 
     # 3. 実行
+    start_time = time.perf_counter()
     response = api_method(**api_kwargs)
 
     # 4. レスポンスのパース
-    if stream:
-        result = []
+    if not stream:
+        return _finish_llm_response(response, model_name, use_chat, start_time, cache_key, metrics)
+
+    collector = _StreamCollector(model_name, use_chat, start_time, cache_key, metrics)
+    aborted = False
+    try:
         for chunk in response:
-            if use_chat:
-                # chatの場合は message -> content
-                content = chunk.get('message', {}).get('content', '')
-            else:
-                # generateの場合は response
-                content = chunk.get('response', '')
-            result.append(content)
-        return "".join(result).strip()
+            content = collector.add(chunk)
+            if content and on_token is not None and on_token(content) is False:
+                aborted = True
+                break
+    finally:
+        # 中断時はストリームを閉じ、サーバー側の生成も止める
+        if aborted and hasattr(response, "close"):
+            response.close()
+    return collector.finish(aborted)
+
+# --- 非同期実行 (ollama.AsyncClient) ---
+# サーバーが同時に保持できるリクエスト数を超えないよう、接続先ごと・モデルごとにセマフォで制限する
+ASYNC_ENDPOINT_CONCURRENCY = 4           # 接続先(Ollamaサーバー)ごとの同時リクエスト数 (OLLAMA_NUM_PARALLEL 相当)
+ASYNC_DEFAULT_MODEL_CONCURRENCY = 2      # モデルごとの既定の同時リクエスト数
+ASYNC_MODEL_CONCURRENCY: Dict[str, int] = {}  # モデル別の上書き設定 (例: {"qwen3-coder:30b": 1})
+
+# イベントループ -> (キー -> セマフォ)。ループが破棄されると、そのループのセマフォも破棄される
+_ASYNC_SEMAPHORES: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+_ASYNC_SEMAPHORES_LOCK = threading.Lock()
+
+def _get_async_semaphore(key: str, limit: int) -> asyncio.Semaphore:
+    """実行中のイベントループ単位でセマフォを共有する"""
+    loop = asyncio.get_running_loop()
+    with _ASYNC_SEMAPHORES_LOCK:
+        semaphores = _ASYNC_SEMAPHORES.get(loop)
+        if semaphores is None:
+            semaphores = {}
+            _ASYNC_SEMAPHORES[loop] = semaphores
+    semaphore = semaphores.get(key)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(1, limit))
+        semaphores[key] = semaphore
+    return semaphore
+
+def _get_async_request_semaphores(ollama_client: Any, model_name: str) -> Tuple[asyncio.Semaphore, asyncio.Semaphore]:
+    """(モデルの枠, 接続先の枠) のセマフォを返す。モデルの枠を先に確保し、接続先の枠を待機中に占有しないようにする"""
+    endpoint = _client_endpoint(ollama_client)
+    model_semaphore = _get_async_semaphore(
+        f"model:{endpoint}:{model_name}",
+        ASYNC_MODEL_CONCURRENCY.get(model_name, ASYNC_DEFAULT_MODEL_CONCURRENCY)
+    )
+    endpoint_semaphore = _get_async_semaphore(f"endpoint:{endpoint}", ASYNC_ENDPOINT_CONCURRENCY)
+    return model_semaphore, endpoint_semaphore
+
+async def stream_llm_request_async(
+    ollama_client: Any,
+    model_name: str,
+    question: str,
+    prompt: str = "",
+    system_prompt: str = "",
+    assistant_message: str = "",
+    format: Optional[str] = None,
+    use_chat: bool = True,
+    options: Optional[Dict[str, Any]] = None,
+    metrics: Optional[Dict[str, Any]] = None,
+    use_cache: bool = True
+):
+    """
+    ollama.AsyncClient でストリーミング実行し、到着したテキスト片を順に yield する非同期イテレーター。
+    ループを途中で抜けると接続を閉じて生成を中断します。
+    同時実行数は execute_llm_request_async と同じセマフォで制限されます。
+    応答キャッシュに該当がある場合は、保存済みの応答全体を1回だけ yield します。
+    """
+    api_kwargs, cached_text, cache_key = _prepare_llm_request(
+        ollama_client, model_name, question, prompt, system_prompt, assistant_message,
+        format, True, use_chat, options, metrics, use_cache
+    )
+    if cached_text is not None:
+        yield cached_text
+        return
+    api_method = ollama_client.chat if use_chat else ollama_client.generate
+
+    model_semaphore, endpoint_semaphore = _get_async_request_semaphores(ollama_client, model_name)
+    async with model_semaphore:
+        async with endpoint_semaphore:
+            start_time = time.perf_counter()
+            response = await api_method(**api_kwargs)
+            collector = _StreamCollector(model_name, use_chat, start_time, cache_key, metrics)
+            completed = False
+            try:
+                async for chunk in response:
+                    content = collector.add(chunk)
+                    if content:
+                        yield content
+                completed = True
+            finally:
+                if not completed and hasattr(response, "aclose"):
+                    await response.aclose()
+                collector.finish(not completed)
+
+@LLM_Trace.traced("llm_request", "llm", arg_names=("model_name", "stream"))
+async def execute_llm_request_async(
+    ollama_client: Any,
+    model_name: str,
+    question: str,
+    prompt: str = "",
+    system_prompt: str = "",
+    assistant_message: str = "",
+    format: Optional[str] = None,
+    stream: bool = False,
+    use_chat: bool = True,
+    options: Optional[Dict[str, Any]] = None,
+    on_token: Optional[Callable[[str], Optional[bool]]] = None,
+    metrics: Optional[Dict[str, Any]] = None,
+    use_cache: bool = True
+) -> str:
+    """
+    execute_llm_request の ollama.AsyncClient 版。
+    モデルごと・接続先ごとのセマフォを取得してから実行します。
+    """
+    if stream or on_token is not None:
+        pieces: List[str] = []
+        stream_iterator = stream_llm_request_async(
+            ollama_client, model_name, question, prompt, system_prompt, assistant_message,
+            format, use_chat, options, metrics, use_cache
+        )
+        try:
+            async for content in stream_iterator:
+                pieces.append(content)
+                if on_token is not None and on_token(content) is False:
+                    break
+        finally:
+            await stream_iterator.aclose()
+        return "".join(pieces).strip()
+
+    api_kwargs, cached_text, cache_key = _prepare_llm_request(
+        ollama_client, model_name, question, prompt, system_prompt, assistant_message,
+        format, False, use_chat, options, metrics, use_cache
+    )
+    if cached_text is not None:
+        return cached_text
+    api_method = ollama_client.chat if use_chat else ollama_client.generate
+
+    model_semaphore, endpoint_semaphore = _get_async_request_semaphores(ollama_client, model_name)
+    async with model_semaphore:
+        async with endpoint_semaphore:
+            start_time = time.perf_counter()
+            response = await api_method(**api_kwargs)
+            return _finish_llm_response(response, model_name, use_chat, start_time, cache_key, metrics)
+
+# map_reduce モードの統合 (reduce) 段階で使用する指示
+REDUCE_PROMPT = "・以下の[部分回答]は、同じ質問に対して文書を分割し、部分ごとに生成した回答です。内容の重複を除き、矛盾なく1つの回答に統合してください。"
+REDUCE_DATA_TYTLE = "[部分回答]\n"
+
+def _build_answer_skeleton(
+    prompt: str,
+    format: Optional[Dict[str, Any]],
+    prev_response_key: str,
+    evaluation_feedback: str
+) -> str:
+    """answer_question の system_prompt (指示とフィードバック) を組み立てる。(純粋)"""
+    skeleton = f"{prompt}\n\n"
+    if format:
+        skeleton += f"- [出力形式:JSONスキーマ]\n{json.dumps(format, indent=2, ensure_ascii=False)}\n"
+    elif prev_response_key:
+        skeleton += f"- 全体のまとめ内容を{prev_response_key}セクションを作って記述してください。\n"
+
+    # 改善指示は User への命令(System/User側)として配置し、Assistantと分離
+    if evaluation_feedback:
+        skeleton += f"### 【重要：前回の回答への改善指示】\n{evaluation_feedback}\n"
+        skeleton += "上記の指摘事項を必ず反映させ、前回の回答を改善・修正してください。\n\n"
+    return skeleton
+
+INHERITANCE_HEADER = "【前回の回答内容】\n"
+
+def _inheritance_source_text(context_data: Any, prev_response_key: str) -> str:
+    """前回の回答から引き継ぐテキストを取り出す"""
+    if not context_data:
+        return ""
+    # 統合ロジック: Keyがあれば抽出、無ければデータ全体を文字列化して使用
+    if prev_response_key and isinstance(context_data, dict):
+        # 特定のKeyから継承データを取得
+        return str(context_data.get(prev_response_key, str(context_data)))
+    # Key指定がない、または辞書でない場合はそのまま使用
+    return str(context_data)
+
+def _build_inheritance_message(context_data: Any, prev_response_key: str, model_name: str, max_tokens: int) -> str:
+    """前回の回答から assistant_message (継承コンテキスト) を組み立てる (見出しを含めて max_tokens 以内)"""
+    raw_text = _inheritance_source_text(context_data, prev_response_key)
+    if not raw_text:
+        return ""
+    # トークン制限を考慮してテキストを取得
+    inheritance_text = _get_safe_inheritance_data(
+        raw_text, model_name, max_tokens - count_tokens(INHERITANCE_HEADER, model_name)
+    )
+    if inheritance_text:
+        return INHERITANCE_HEADER + inheritance_text
+    return ""
+
+# --- 逐次処理の階層メモリ ---
+# 直近の回答はそのまま残し、古い回答ほど要約を重ねて圧縮することで、
+# 文書がどれだけ長くても継承コンテキストを一定のトークン数に保つ
+MEMORY_RECENT_RATIO = 0.6   # 継承枠のうち直近の回答 (要約しない) に使う割合
+MEMORY_SUMMARY_HEADER = "【前回までの要約】\n"
+MEMORY_RECENT_HEADER = "【直近の回答】\n"
+MEMORY_SUMMARY_PROMPT = (
+    "・以下の[途中経過]は、長い文書を分割して順に処理した際の途中の回答です。"
+    "質問に答えるために必要な事実・数値・固有名詞・結論を残し、重複を除いて{target_tokens}トークン以内の1つの要約にまとめてください。"
+    "前置きや説明は不要です。要約のみを出力してください。"
+)
+MEMORY_SUMMARY_DATA_TYTLE = "[途中経過]\n"
+
+class RollingSummaryMemory:
+    """
+    answer_question の逐次モードで、チャンク間に引き継ぐ回答を保持する階層メモリ。
+    levels[0] は直近の回答 (そのまま)、levels[1] 以降は要約で、番号が大きいほど古い内容を表します。
+    render() の結果が常に max_tokens 以内になるよう、compact() で古いものから要約・切り詰めを行います。
+    """
+
+    def __init__(self, model_name: str, max_tokens: int, recent_ratio: float = MEMORY_RECENT_RATIO):
+        self.model_name = model_name
+        self.max_tokens = max(0, max_tokens)
+        self.recent_budget = max(1, int(self.max_tokens * recent_ratio))
+        # 要約1件の目安。要約の階層が数段積み重なっても残りの枠に収まる大きさにする
+        self.summary_target_tokens = max(64, (self.max_tokens - self.recent_budget) // 3)
+        self.levels: List[List[str]] = [[]]
+
+    def add(self, text: str):
+        """最新のチャンクの回答を追加する (要約は compact() で行う)"""
+        if text:
+            self.levels[0].append(text)
+
+    def render(self) -> str:
+        """古い要約 → 新しい要約 → 直近の回答 の順に並べたテキストを返す。(純粋)"""
+        summaries = [text for level in reversed(self.levels[1:]) for text in level]
+        recent = self.levels[0]
+        sections = []
+        if summaries:
+            sections.append(MEMORY_SUMMARY_HEADER + "\n\n".join(summaries))
+        if recent:
+            sections.append(MEMORY_RECENT_HEADER + "\n\n".join(recent))
+        return "\n\n".join(sections)
+
+    def token_count(self) -> int:
+        return count_tokens(self.render(), self.model_name)
+
+    def _next_compaction(self) -> Optional[Tuple[int, int]]:
+        """
+        次に要約する (階層, 先頭からの件数) を返す。件数 0 は要約できる組が無いことを表す。
+        枠に収まっている場合は None を返す。
+        """
+        if self.token_count() <= self.max_tokens:
+            return None
+        recent = self.levels[0]
+        recent_tokens = [count_tokens(text, self.model_name) for text in recent]
+        # 直近の回答が枠を超えた: 最新の1件は残し、古い方から枠に収まるまでを要約に回す
+        count = 0
+        while count < len(recent) - 1 and sum(recent_tokens[count:]) > self.recent_budget:
+            count += 1
+        if count:
+            return 0, count
+        # 要約が2件以上溜まった階層は、まとめて1つ上の階層の要約にする
+        for level in range(1, len(self.levels)):
+            if len(self.levels[level]) >= 2:
+                return level, len(self.levels[level])
+        return 0, 0
+
+    def _apply_compaction(self, level: int, count: int, summary: Optional[str]):
+        """levels[level] の先頭 count 件を summary (失敗時は末尾の切り詰め) で置き換え、1つ上の階層へ移す"""
+        texts = self.levels[level][:count]
+        if not summary:
+            summary = "\n\n".join(texts)
+        summary = _truncate_head_to_tokens(summary, self.summary_target_tokens, self.model_name)
+        del self.levels[level][:count]
+        if level + 1 == len(self.levels):
+            self.levels.append([])
+        self.levels[level + 1].append(summary)
+
+    def _reduce_without_summary(self):
+        """
+        要約できる組が無いのに枠を超えている場合の処理。
+        要約が複数の階層に1件ずつ残っていれば、最も新しい要約を1つ上の階層へ移して次回まとめて要約させ、
+        それも無ければ最も大きいエントリの先頭を超過分だけ切り詰める。
+        """
+        summary_levels = [level for level in range(1, len(self.levels)) if self.levels[level]]
+        if len(summary_levels) >= 2:
+            lowest = summary_levels[0]
+            self.levels[summary_levels[1]].extend(self.levels[lowest])
+            self.levels[lowest] = []
+            return
+        self._truncate_largest()
+
+    def _truncate_largest(self):
+        excess = self.token_count() - self.max_tokens
+        entries = [(count_tokens(text, self.model_name), level, index)
+                   for level, texts in enumerate(self.levels) for index, text in enumerate(texts)]
+        if not entries:
+            return
+        tokens, level, index = max(entries)
+        truncated = _truncate_head_to_tokens(self.levels[level][index], tokens - excess, self.model_name)
+        if truncated:
+            self.levels[level][index] = truncated
+        else:
+            del self.levels[level][index]
+
+    def compact(self, summarize: Optional[Callable[[List[str], int], Optional[str]]] = None):
+        """
+        render() が max_tokens 以内になるまで古いものから圧縮する。
+        summarize(テキスト一覧, 目標トークン数) は要約文を返す関数で、省略時・失敗時は切り詰めで代用します。
+        """
+        while True:
+            plan = self._next_compaction()
+            if plan is None:
+                return
+            level, count = plan
+            if count == 0:
+                self._reduce_without_summary()
+                continue
+            texts = self.levels[level][:count]
+            summary = summarize(texts, self.summary_target_tokens) if summarize else None
+            self._apply_compaction(level, count, summary)
+
+    async def compact_async(self, summarize: Optional[Callable[[List[str], int], Awaitable[Optional[str]]]] = None):
+        """compact のコルーチン版 (summarize はコルーチン関数)"""
+        while True:
+            plan = self._next_compaction()
+            if plan is None:
+                return
+            level, count = plan
+            if count == 0:
+                self._reduce_without_summary()
+                continue
+            texts = self.levels[level][:count]
+            summary = await summarize(texts, self.summary_target_tokens) if summarize else None
+            self._apply_compaction(level, count, summary)
+
+    def build_message(self, summarize: Optional[Callable[[List[str], int], Optional[str]]] = None) -> str:
+        """圧縮した上で assistant_message (継承コンテキスト) を返す"""
+        self.compact(summarize)
+        rendered = self.render()
+        return INHERITANCE_HEADER + rendered if rendered else ""
+
+    async def build_message_async(self, summarize: Optional[Callable[[List[str], int], Awaitable[Optional[str]]]] = None) -> str:
+        await self.compact_async(summarize)
+        rendered = self.render()
+        return INHERITANCE_HEADER + rendered if rendered else ""
+
+def _memory_summary_request_args(question: str, texts: List[str], target_tokens: int) -> Dict[str, Any]:
+    """階層メモリの要約リクエストの引数を組み立てる。(純粋)"""
+    return {
+        "question": question,
+        "system_prompt": MEMORY_SUMMARY_PROMPT.format(target_tokens=target_tokens),
+        "prompt": MEMORY_SUMMARY_DATA_TYTLE + "\n\n---\n\n".join(texts),
+        "options": {"temperature": 0.1, "num_predict": target_tokens},
+    }
+
+def _build_memory_summarizer(question: str, model_name: str, ollama_client: Any) -> Callable[[List[str], int], Optional[str]]:
+    """RollingSummaryMemory.compact に渡す要約関数 (LLMで要約し、失敗時は None)"""
+    def summarize(texts: List[str], target_tokens: int) -> Optional[str]:
+        print(f"{model_name} 継承メモリを要約中 ({len(texts)}件 -> {target_tokens}tokens以内)", file=sys.stderr)
+        try:
+            return execute_llm_request(
+                ollama_client=ollama_client,
+                model_name=model_name,
+                **_memory_summary_request_args(question, texts, target_tokens)
+            ).strip()
+        except Exception as e:
+            print(f"WARNING: 継承メモリの要約に失敗したため切り詰めで代用します: {e}", file=sys.stderr)
+            return None
+    return summarize
+
+def _build_memory_summarizer_async(question: str, model_name: str, ollama_client: Any) -> Callable[[List[str], int], Awaitable[Optional[str]]]:
+    """_build_memory_summarizer の ollama.AsyncClient 版"""
+    async def summarize(texts: List[str], target_tokens: int) -> Optional[str]:
+        print(f"{model_name} 継承メモリを要約中 ({len(texts)}件 -> {target_tokens}tokens以内)", file=sys.stderr)
+        try:
+            full_text = await execute_llm_request_async(
+                ollama_client=ollama_client,
+                model_name=model_name,
+                **_memory_summary_request_args(question, texts, target_tokens)
+            )
+            return full_text.strip()
+        except Exception as e:
+            print(f"WARNING: 継承メモリの要約に失敗したため切り詰めで代用します: {e}", file=sys.stderr)
+            return None
+    return summarize
+
+def _inheritance_budget(max_inheritance_tokens: int, context_window_limit: int) -> int:
+    """継承コンテキストに使うトークン数 (小さいコンテキストではチャンク用の枠を残すため 1/4 までに抑える)"""
+    return max(0, min(max_inheritance_tokens, context_window_limit // 4))
+
+def _parse_answer_output(full_text: str, format: Optional[Dict[str, Any]]) -> Tuple[Any, bool]:
+    """
+    LLMの出力を answer_question の戻り値の要素に変換し、(結果, 解析成功) を返す。
+    JSON形式指定時に解析できなかった場合はエラー内容を持つ辞書を返す。
+    """
+    if not format:
+        return full_text, True
+    try:
+        clean_json = re.sub(r'^```json\s*|```$', '', full_text, flags=re.MULTILINE).strip()
+        return json.loads(clean_json), True
+    except json.JSONDecodeError:
+        return {"summary": "JSON解析エラー", "raw": full_text}, False
+
+# --- 構造化出力 (format 指定時) のストリーミング検証 ---
+JSON_STREAM_MAX_RETRY = 2   # 出力がJSON/スキーマとして不正だった場合に、そのチャンクを再実行する回数
+
+def _build_validating_callback(
+    validator: Optional[JsonStreamControl.StreamingJsonValidator],
+    on_token: Optional[Callable[[str], Optional[bool]]]
+) -> Optional[Callable[[str], Optional[bool]]]:
+    """トークン到着ごとに出力を検証し、回復不能になった時点で False を返して生成を中断させるコールバックを作る"""
+    if validator is None:
+        return on_token
+    def callback(piece: str) -> Optional[bool]:
+        if not validator.feed(piece):
+            return False
+        return on_token(piece) if on_token is not None else None
+    return callback
+
+def _json_retry_kwargs(request_kwargs: Dict[str, Any], attempt: int, error: Optional[str]) -> Dict[str, Any]:
+    """再実行時は不正だった内容を指示に加え、キャッシュを使わずにリクエストする。(純粋)"""
+    if attempt == 0:
+        return request_kwargs
+    feedback = (
+        f"\n### 【重要：前回の出力はJSONとして不正でした】\n{error}\n"
+        "指定されたスキーマに従ったJSONのみを出力してください。\n"
+    )
+    return {**request_kwargs, "system_prompt": request_kwargs.get("system_prompt", "") + feedback, "use_cache": False}
+
+def _check_answer_output(
+    full_text: str,
+    format: Optional[Dict[str, Any]],
+    validator: Optional[JsonStreamControl.StreamingJsonValidator],
+    metrics: Dict[str, Any]
+) -> Tuple[Any, bool, Optional[str]]:
+    """
+    出力を解析し、(結果, 解析成功, 再実行が必要な理由) を返す。
+    検証による中断は利用者の中断 (on_token が False) と区別するため、metrics の aborted を戻します。
+    """
+    result, parsed = _parse_answer_output(full_text, format)
+    if validator is None:
+        return result, parsed, None
+    if validator.error is None:
+        if metrics.get("aborted"):
+            # on_token による中断は再実行しない
+            return result, parsed, None
+        validator.finish()
     else:
-        if use_chat:
-            return response.get('message', {}).get('content', "").strip()
+        metrics["aborted"] = False
+    if validator.error is not None:
+        metrics["json_error"] = validator.error
+        return result, parsed, validator.error
+    return result, parsed, None if parsed else "JSONとして解析できません"
+
+@LLM_Trace.traced("chunk", "chunk")
+def _execute_answer_request(
+    request_kwargs: Dict[str, Any],
+    on_token: Optional[Callable[[str], Optional[bool]]] = None,
+    metrics: Optional[Dict[str, Any]] = None
+) -> Tuple[str, Any, bool]:
+    """
+    1チャンク分の回答を生成し、(出力テキスト, 結果, 解析成功) を返す。
+    format 指定時は出力をトークン到着ごとに検証し、回復不能になった時点で生成を中断して、このチャンクだけを再実行します。
+    """
+    format = request_kwargs.get("format")
+    metrics = metrics if metrics is not None else {}
+    error = None
+    for attempt in range(JSON_STREAM_MAX_RETRY + 1):
+        validator = JsonStreamControl.build_validator(format)
+        attempt_kwargs = _json_retry_kwargs(request_kwargs, attempt, error)
+        full_text = execute_llm_request(
+            **attempt_kwargs,
+            on_token=_build_validating_callback(validator, on_token),
+            metrics=metrics
+        )
+        result, parsed, error = _check_answer_output(full_text, format, validator, metrics)
+        if error is not None or not parsed:
+            # JSON/スキーマとして不正な出力はキャッシュに残さない
+            _discard_cached_response(attempt_kwargs)
+        elif attempt > 0:
+            # 再実行の指示を加えたリクエストはキャッシュを使わないため、正しい出力は元のリクエストのキーで保存する
+            _store_cached_response(_request_cache_key(request_kwargs), full_text, metrics.get("aborted", False))
+        if error is None or attempt == JSON_STREAM_MAX_RETRY:
+            return full_text, result, parsed
+        print(f"\nWARNING: 出力が不正なため、このチャンクを再実行します ({attempt + 1}/{JSON_STREAM_MAX_RETRY}): {error}", file=sys.stderr)
+
+@LLM_Trace.traced("chunk", "chunk")
+async def _execute_answer_request_async(
+    request_kwargs: Dict[str, Any],
+    on_token: Optional[Callable[[str], Optional[bool]]] = None,
+    metrics: Optional[Dict[str, Any]] = None
+) -> Tuple[str, Any, bool]:
+    """_execute_answer_request の ollama.AsyncClient 版"""
+    format = request_kwargs.get("format")
+    metrics = metrics if metrics is not None else {}
+    error = None
+    for attempt in range(JSON_STREAM_MAX_RETRY + 1):
+        validator = JsonStreamControl.build_validator(format)
+        attempt_kwargs = _json_retry_kwargs(request_kwargs, attempt, error)
+        full_text = await execute_llm_request_async(
+            **attempt_kwargs,
+            on_token=_build_validating_callback(validator, on_token),
+            metrics=metrics
+        )
+        result, parsed, error = _check_answer_output(full_text, format, validator, metrics)
+        if error is not None or not parsed:
+            # JSON/スキーマとして不正な出力はキャッシュに残さない
+            _discard_cached_response(attempt_kwargs)
+        elif attempt > 0:
+            # 再実行の指示を加えたリクエストはキャッシュを使わないため、正しい出力は元のリクエストのキーで保存する
+            _store_cached_response(_request_cache_key(request_kwargs), full_text, metrics.get("aborted", False))
+        if error is None or attempt == JSON_STREAM_MAX_RETRY:
+            return full_text, result, parsed
+        print(f"\nWARNING: 出力が不正なため、このチャンクを再実行します ({attempt + 1}/{JSON_STREAM_MAX_RETRY}): {error}", file=sys.stderr)
+
+def _build_stream_callback(on_token: Optional[Callable[[str], Optional[bool]]]) -> Callable[[str], Optional[bool]]:
+    """ストリーミング中のテキスト片を端末へ逐次表示し、on_token にも渡すコールバックを作る"""
+    def callback(piece: str) -> Optional[bool]:
+        sys.stderr.write(piece)
+        sys.stderr.flush()
+        return on_token(piece) if on_token is not None else None
+    return callback
+
+def _format_request_metrics(metrics: Dict[str, Any]) -> str:
+    """計測値を1行の表示用文字列にする。(純粋)"""
+    ttft = metrics.get("ttft_sec")
+    ttft_text = f"{ttft:.2f}s" if ttft is not None else "-"
+    aborted_text = " / 中断" if metrics.get("aborted") else ""
+    cached_text = " / キャッシュ" if metrics.get("cached") else ""
+    return (
+        f"TTFT {ttft_text} / 合計 {metrics.get('total_sec', 0):.2f}s / "
+        f"{metrics.get('output_tokens', 0)}tokens ({metrics.get('tokens_per_sec', 0):.1f} tokens/s){aborted_text}{cached_text}"
+    )
+
+def _run_bounded_parallel(func: Callable[[Any], Any], items: Iterable[Any], parallelism: int) -> List[Any]:
+    """
+    items を最大 parallelism 並列で func に渡し、入力順の結果リストを返す。
+    投入済み・未完了のタスク数を制限し、items (遅延生成のチャンクなど) を先読みしすぎないようにする。
+    """
+    parallelism = max(1, parallelism)
+    results: List[Any] = []
+    pending: deque = deque()
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        for item in items:
+            # テレメトリのタスク名などがワーカースレッドにも引き継がれるよう、呼び出し元のコンテキストで実行する
+            pending.append(executor.submit(contextvars.copy_context().run, func, item))
+            if len(pending) >= parallelism * 2:
+                results.append(pending.popleft().result())
+        while pending:
+            results.append(pending.popleft().result())
+    return results
+
+def _group_texts_by_token_limit(texts: List[str], limit: int, model_name: str) -> List[List[int]]:
+    """順序を保ったまま、合計トークン数が limit に収まるようにテキストをまとめる (1件で超えるものは単独)"""
+    groups: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for i, tokens in enumerate(count_tokens_batch(texts, model_name)):
+        if current and current_tokens + tokens > limit:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+class _AnswerSession:
+    """
+    answer_question / answer_question_async の1回分の状態 (system_prompt・トークン枠・継承コンテキスト・回答) を持つ。
+    プロンプトの組み立て・チャンクのまとめ方・結果の処理はここで共通化し、LLM の呼び出し (同期/非同期) だけを各関数で行います。
+    """
+
+    def __init__(
+        self,
+        question: str,
+        model_name: str,
+        ollama_client: Any,
+        overlap_tokens: int,
+        prompt: str,
+        prompt_data_tytle: str,
+        format: Optional[Dict[str, Any]],
+        prev_response: Optional[Any],
+        prev_response_key: str,
+        evaluation_feedback: str,
+        stream: bool,
+        use_chat: bool,
+        options: Optional[Dict[str, Any]],
+        max_inheritance_tokens: int,
+        mode: str,
+        parallelism: int,
+        on_token: Optional[Callable[[str], Optional[bool]]],
+        memory_mode: str
+    ):
+        self.question = question
+        self.model_name = model_name
+        self.ollama_client = ollama_client
+        self.overlap_tokens = overlap_tokens
+        self.prompt_data_tytle = prompt_data_tytle
+        self.format = format
+        self.prev_response_key = prev_response_key
+        self.stream = stream
+        self.use_chat = use_chat
+        self.options = options
+        self.max_inheritance_tokens = max_inheritance_tokens
+        self.parallelism = parallelism
+        self.on_token = on_token
+
+        # --- 1. system_prompt (指示とフィードバック) の構築 ---
+        # チャンクに依存しないため、ループの外で一度だけ組み立てる
+        self.skeleton = _build_answer_skeleton(prompt, format, prev_response_key, evaluation_feedback)
+
+        # トークン計算と制限チェック
+        reserved_tokens = count_tokens(question + self.skeleton + prompt_data_tytle, model_name)
+        context_window_limit = get_context_window_size(model_name)
+        # 継承コンテキストの枠も先に確保し、各リクエストのプロンプトがコンテキストに収まるようにする
+        self.inheritance_budget = (
+            _inheritance_budget(max_inheritance_tokens, context_window_limit) if (mode != "map_reduce" or prev_response) else 0
+        )
+        self.available_tokens = context_window_limit - reserved_tokens - self.inheritance_budget - 100
+
+        self.current_context_data = prev_response
+        self.answer_chunks: List[Any] = []
+        self.memory: Optional[RollingSummaryMemory] = None
+        memory_budget = max(0, self.inheritance_budget - count_tokens(INHERITANCE_HEADER, model_name))
+        # 見出しも収まらないほど継承枠が小さい場合は、メモリを使わない (継承コンテキストなし)
+        if mode != "map_reduce" and memory_mode == "hierarchical" and memory_budget > 0:
+            self.memory = RollingSummaryMemory(model_name, memory_budget)
+            self.memory.add(_inheritance_source_text(prev_response, prev_response_key))
+
+        # map_reduce モードの統合 (reduce) 段階の指示と枠
+        self.reduce_skeleton = ""
+        self.reduce_limit = 0
+        if mode == "map_reduce":
+            self.reduce_skeleton = _build_answer_skeleton(REDUCE_PROMPT, format, prev_response_key, "")
+            self.reduce_limit = context_window_limit - count_tokens(question + self.reduce_skeleton + REDUCE_DATA_TYTLE, model_name) - 100
+
+    def fits_context(self) -> bool:
+        if self.available_tokens <= self.overlap_tokens:
+            print("ERROR: コンテキスト制限を超過しました。", file=sys.stderr)
+            return False
+        return True
+
+    def iter_chunks(self, data_source: Union[str, Path, Iterable[str]]) -> Iterator[str]:
+        # --- 2. チャンク分割 ---
+        # チャンクは送信直前に一つずつ生成し、残りデータ全体のコピーは作らない
+        return _iter_source_chunks(data_source, self.available_tokens, self.model_name, self.overlap_tokens)
+
+    def request_kwargs(self, system_prompt: str, prompt: str, assistant_message: str = "") -> Dict[str, Any]:
+        return dict(
+            ollama_client=self.ollama_client,
+            model_name=self.model_name,
+            question=self.question,
+            system_prompt=system_prompt,
+            prompt=prompt,
+            assistant_message=assistant_message,
+            format=self.format,
+            stream=self.stream,
+            use_chat=self.use_chat,
+            options=self.options
+        )
+
+    def inheritance_message(self) -> str:
+        """直前の回答 (memory_mode="latest") から assistant_message を作る"""
+        return _build_inheritance_message(self.current_context_data, self.prev_response_key, self.model_name, self.inheritance_budget)
+
+    # --- 逐次モード ---
+    def begin_chunk(
+        self, iteration: int, chunk: str, assistant_message: str
+    ) -> Tuple[Dict[str, Any], Optional[Callable[[str], Optional[bool]]], Dict[str, Any]]:
+        """チャンクのリクエスト引数・ストリーミング表示用のコールバック・計測値の辞書を返す"""
+        print(
+            f"{self.model_name} 実行中 {iteration}回目 (チャンク: {len(chunk)}文字 / 枠: {self.available_tokens}tokens"
+            f" / 継承: {count_tokens(assistant_message, self.model_name)}tokens)",
+            file=sys.stderr
+        )
+        stream_callback = _build_stream_callback(self.on_token) if (self.stream or self.on_token is not None) else None
+        # 過去の純粋な回答のみを assistant_message にする
+        request_kwargs = self.request_kwargs(self.skeleton, self.prompt_data_tytle + chunk, assistant_message)
+        return request_kwargs, stream_callback, {}
+
+    def end_chunk(
+        self,
+        full_text: str,
+        result: Any,
+        parsed: bool,
+        stream_callback: Optional[Callable[[str], Optional[bool]]],
+        request_metrics: Dict[str, Any]
+    ) -> bool:
+        """チャンクの結果を記録し、次のチャンクに進む場合は True を返す"""
+        if stream_callback is not None:
+            print(f"\n---------------------(stream end: {_format_request_metrics(request_metrics)})\n", file=sys.stderr)
         else:
-            return response.get('response', "").strip()
+            print(full_text[:1000]+"\n---------------------(preview end)\n", file=sys.stderr)
+        # --- 4. データの抽出と更新 ---
+        if parsed:
+            # 次回ループ用のコンテキストを更新
+            self.current_context_data = result
+            if self.memory is not None:
+                self.memory.add(_inheritance_source_text(result, self.prev_response_key))
+        self.answer_chunks.append(result)
+        if request_metrics.get("aborted"):
+            print("INFO: 生成が中断されたため、残りのチャンクの処理を終了します。", file=sys.stderr)
+            return False
+        return True
+
+    # --- map_reduce モード ---
+    def map_request_kwargs(self, chunk_no: int, chunk: str, inheritance_message: str) -> Dict[str, Any]:
+        print(f"{self.model_name} map実行中 チャンク{chunk_no} ({len(chunk)}文字)", file=sys.stderr)
+        return self.request_kwargs(self.skeleton, self.prompt_data_tytle + chunk, inheritance_message)
+
+    @staticmethod
+    def partial_texts(partials: List[Any]) -> List[str]:
+        return [partial if isinstance(partial, str) else json.dumps(partial, ensure_ascii=False) for partial in partials]
+
+    def plan_reduce_groups(self, texts: List[str], level: int) -> Optional[List[List[int]]]:
+        """
+        部分回答をコンテキストに収まる単位にまとめる (各要素は texts のインデックスのリスト)。
+        部分回答1件ずつでも枠を超える場合は None (逐次モードで統合する) を返します。
+        """
+        groups = _group_texts_by_token_limit(texts, self.reduce_limit, self.model_name)
+        if len(groups) == len(texts):
+            print(f"WARNING: 部分回答が大きすぎるため逐次統合に切り替えます。", file=sys.stderr)
+            return None
+        print(f"{self.model_name} reduce {level}段目: {len(texts)}件 -> {len(groups)}件", file=sys.stderr)
+        return groups
+
+    @staticmethod
+    def merge_reduced(partials: List[Any], groups: List[List[int]], reduced: List[Optional[Any]]) -> List[Any]:
+        """統合結果を並べる。統合に失敗した (None の) まとまりは入力の部分回答をそのまま残し、map の結果を捨てない"""
+        merged: List[Any] = []
+        for group, result in zip(groups, reduced):
+            if result is None:
+                merged.extend(partials[i] for i in group)
+            else:
+                merged.append(result)
+        return merged
+
+    def reduce_request_kwargs(self, group_texts: List[str]) -> Dict[str, Any]:
+        return self.request_kwargs(self.reduce_skeleton, REDUCE_DATA_TYTLE + "\n\n---\n\n".join(group_texts))
+
+    def sequential_reduce_kwargs(self, texts: List[str]) -> Dict[str, Any]:
+        """部分回答を逐次モードで前回回答を引き継ぎながら統合する answer_question の引数"""
+        return dict(
+            question=self.question,
+            data_source=iter(texts),
+            model_name=self.model_name,
+            ollama_client=self.ollama_client,
+            prompt=REDUCE_PROMPT,
+            prompt_data_tytle=REDUCE_DATA_TYTLE,
+            format=self.format,
+            prev_response_key=self.prev_response_key,
+            stream=self.stream,
+            use_chat=self.use_chat,
+            options=self.options,
+            max_inheritance_tokens=self.max_inheritance_tokens
+        )
+
+def _answer_question_sequential(session: _AnswerSession, chunks: Iterable[str]) -> List[Any]:
+    """前回の回答を引き継ぎながらチャンクを順に処理する"""
+    summarize = _build_memory_summarizer(session.question, session.model_name, session.ollama_client) if session.memory is not None else None
+    for iteration, current_chunk in enumerate(chunks, start=1):
+        # --- 3. assistant_message (過去のコンテキスト) の構築 ---
+        if session.memory is not None:
+            assistant_message = session.memory.build_message(summarize)
+        else:
+            assistant_message = session.inheritance_message()
+        try:
+            request_kwargs, stream_callback, request_metrics = session.begin_chunk(iteration, current_chunk, assistant_message)
+            # format 指定時は出力を逐次検証し、不正になった時点で中断してこのチャンクだけ再実行する
+            full_text, result, parsed = _execute_answer_request(request_kwargs, on_token=stream_callback, metrics=request_metrics)
+            if not session.end_chunk(full_text, result, parsed, stream_callback, request_metrics):
+                break
+        except Exception as e:
+            print(f"ERROR: 処理失敗: {e}", file=sys.stderr)
+            break
+    return session.answer_chunks
+
+def _answer_question_map_reduce(session: _AnswerSession, chunks: Iterable[str]) -> List[Any]:
+    """
+    map: 各チャンクを前回回答に依存させずに並列で回答させる。
+    reduce: 部分回答をコンテキストに収まる単位でまとめて統合し、1つになるまで木構造で繰り返す。
+    """
+    inheritance_message = session.inheritance_message()
 
+    def map_chunk(indexed_chunk: Tuple[int, str]) -> Optional[Any]:
+        chunk_no, chunk = indexed_chunk
+        try:
+            _, result, _ = _execute_answer_request(session.map_request_kwargs(chunk_no, chunk, inheritance_message))
+        except Exception as e:
+            print(f"ERROR: チャンク{chunk_no}の処理失敗: {e}", file=sys.stderr)
+            return None
+        return result
+
+    def reduce_group(group: List[int]) -> Optional[Any]:
+        if len(group) == 1:
+            return partials[group[0]]
+        try:
+            full_text = execute_llm_request(**session.reduce_request_kwargs([texts[i] for i in group]))
+        except Exception as e:
+            print(f"ERROR: reduce処理失敗: {e}", file=sys.stderr)
+            return None
+        return _parse_answer_output(full_text, session.format)[0]
+
+    partials = [p for p in _run_bounded_parallel(map_chunk, enumerate(chunks, start=1), session.parallelism) if p is not None]
+    level = 0
+    while len(partials) > 1:
+        level += 1
+        texts = session.partial_texts(partials)
+        groups = session.plan_reduce_groups(texts, level)
+        if groups is None:
+            return answer_question(**session.sequential_reduce_kwargs(texts))[-1:]
+        merged = session.merge_reduced(partials, groups, _run_bounded_parallel(reduce_group, groups, session.parallelism))
+        if len(merged) == len(partials):
+            print("ERROR: reduce処理がすべて失敗したため、統合前の部分回答を返します。", file=sys.stderr)
+            return merged
+        partials = merged
+    return partials
+
+@LLM_Trace.traced("answer_question", "answer", arg_names=("model_name", "mode", "memory_mode"))
 def answer_question(
     question: str,
-    data_source: str, 
+    data_source: Union[str, Path, Iterable[str]], 
     model_name: str, 
     ollama_client: Any, 
     overlap_tokens: int = 100,
@@ -769,102 +3023,183 @@ def answer_question(
     use_chat: bool = True,
     options: Optional[Dict[str, Any]] = {'temperature': 0.1},
     max_inheritance_tokens: int = 2000,
+    mode: str = "sequential",       # "sequential": 前回回答を引き継いで逐次処理 / "map_reduce": チャンクを並列処理して統合
+    parallelism: int = 4,           # map_reduce モードの同時リクエスト数 (OLLAMA_NUM_PARALLEL に合わせる)
+    on_token: Optional[Callable[[str], Optional[bool]]] = None,  # 逐次モードでトークン到着ごとに呼ばれる (False で中断)
+    memory_mode: str = "latest",    # 逐次モードの継承方法 "latest": 直前の回答のみ / "hierarchical": 直近の回答 + 古い回答の要約
 ) -> List[Any]:
     
     if not _pull_model_if_not_exists(model_name, ollama_client):
         return [f"[エラー: モデル '{model_name}' が利用できません。]"]
-        
-    current_context_data = prev_response
-    answer_chunks: List[Any] = []
-    remaining_data = data_source
-    iteration = 0
-    
-    while len(remaining_data) > 0:
-        iteration += 1
-        
-        # --- 1. assistant_message (過去のコンテキスト) の構築 ---
-        # 統合ロジック: Keyがあれば抽出、無ければデータ全体を文字列化して使用
-        combined_assistant_msg = ""
-        if current_context_data:
-            if prev_response_key and isinstance(current_context_data, dict):
-                # 特定のKeyから継承データを取得
-                raw_text = current_context_data.get(prev_response_key, str(current_context_data))
-            else:
-                # Key指定がない、または辞書でない場合はそのまま使用
-                raw_text = str(current_context_data)
-            
-            # トークン制限を考慮してテキストを取得
-            inheritance_text = _get_safe_inheritance_data(raw_text, model_name, max_inheritance_tokens)
-            if inheritance_text:
-                combined_assistant_msg = f"【前回の回答内容】\n{inheritance_text}"
-
-        # --- 2. system_prompt (指示とフィードバック) の構築 ---
-        skeleton = f"{prompt}\n\n"
-        if format:
-            skeleton += f"- [出力形式:JSONスキーマ]\n{json.dumps(format, indent=2, ensure_ascii=False)}\n"
-        elif prev_response_key:
-            skeleton += f"- 全体のまとめ内容を{prev_response_key}セクションを作って記述してください。\n"
-
-        # 改善指示は User への命令(System/User側)として配置し、Assistantと分離
-        if evaluation_feedback:
-            skeleton += f"### 【重要：前回の回答への改善指示】\n{evaluation_feedback}\n"
-            skeleton += "上記の指摘事項を必ず反映させ、前回の回答を改善・修正してください。\n\n"
 
-        # トークン計算と制限チェック
-        reserved_tokens = count_tokens(question + skeleton + prompt_data_tytle, model_name)
-        context_window_limit = get_context_window_size(model_name)
-        available_tokens = context_window_limit - reserved_tokens - 100
-        
-        if available_tokens <= overlap_tokens:
-            print("ERROR: コンテキスト制限を超過しました。", file=sys.stderr)
+    session = _AnswerSession(
+        question, model_name, ollama_client, overlap_tokens, prompt, prompt_data_tytle, format,
+        prev_response, prev_response_key, evaluation_feedback, stream, use_chat, options,
+        max_inheritance_tokens, mode, parallelism, on_token, memory_mode
+    )
+    if not session.fits_context():
+        return []
+    chunks = session.iter_chunks(data_source)
+    if mode == "map_reduce":
+        return _answer_question_map_reduce(session, chunks)
+    return _answer_question_sequential(session, chunks)
+
+async def _run_bounded_parallel_async(func: Callable[[Any], Any], items: Iterable[Any], parallelism: int) -> List[Any]:
+    """_run_bounded_parallel のコルーチン版 (func はコルーチン関数)"""
+    parallelism = max(1, parallelism)
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def run(item: Any) -> Any:
+        async with semaphore:
+            return await func(item)
+
+    results: List[Any] = []
+    pending: deque = deque()
+    for item in items:
+        pending.append(asyncio.ensure_future(run(item)))
+        if len(pending) >= parallelism * 2:
+            results.append(await pending.popleft())
+    while pending:
+        results.append(await pending.popleft())
+    return results
+
+async def _answer_question_sequential_async(session: _AnswerSession, chunks: Iterable[str]) -> List[Any]:
+    """_answer_question_sequential の非同期版"""
+    summarize = _build_memory_summarizer_async(session.question, session.model_name, session.ollama_client) if session.memory is not None else None
+    for iteration, current_chunk in enumerate(chunks, start=1):
+        if session.memory is not None:
+            assistant_message = await session.memory.build_message_async(summarize)
+        else:
+            assistant_message = session.inheritance_message()
+        try:
+            request_kwargs, stream_callback, request_metrics = session.begin_chunk(iteration, current_chunk, assistant_message)
+            full_text, result, parsed = await _execute_answer_request_async(request_kwargs, on_token=stream_callback, metrics=request_metrics)
+            if not session.end_chunk(full_text, result, parsed, stream_callback, request_metrics):
+                break
+        except Exception as e:
+            print(f"ERROR: 処理失敗: {e}", file=sys.stderr)
             break
+    return session.answer_chunks
 
-        current_chunk, consumed_text = get_chunk_by_token_limit(remaining_data, available_tokens, model_name)
+async def _answer_question_map_reduce_async(session: _AnswerSession, chunks: Iterable[str]) -> List[Any]:
+    """_answer_question_map_reduce の非同期版"""
+    inheritance_message = session.inheritance_message()
 
+    async def map_chunk(indexed_chunk: Tuple[int, str]) -> Optional[Any]:
+        chunk_no, chunk = indexed_chunk
         try:
-            print(f"{model_name} 実行中 {iteration}回目 (残: {len(remaining_data)}文字 / 枠: {available_tokens}tokens)", file=sys.stderr)
-            full_text = execute_llm_request(
-                ollama_client=ollama_client,
-                model_name=model_name,
-                question=question,
-                system_prompt=skeleton,
-                prompt=prompt_data_tytle + current_chunk,
-                assistant_message=combined_assistant_msg, # 過去の純粋な回答のみ
-                format=format,
-                stream=stream,
-                use_chat=use_chat,
-                options=options
-            )
-            print(full_text[:1000]+"\n---------------------(preview end)\n", file=sys.stderr)
-            # --- 3. データの抽出と更新 ---
-            if format:
-                try:
-                    clean_json = re.sub(r'^```json\s*|```$', '', full_text, flags=re.MULTILINE).strip()
-                    res_obj = json.loads(clean_json)
-                    # 次回ループ用のコンテキストを更新
-                    current_context_data = res_obj 
-                    answer_chunks.append(res_obj)
-                except json.JSONDecodeError:
-                    answer_chunks.append({"summary": "JSON解析エラー", "raw": full_text})
-            else:
-                current_context_data = full_text
-                answer_chunks.append(full_text)
-
-            remaining_data = remaining_data[len(consumed_text):]
-            
+            _, result, _ = await _execute_answer_request_async(session.map_request_kwargs(chunk_no, chunk, inheritance_message))
+        except Exception as e:
+            print(f"ERROR: チャンク{chunk_no}の処理失敗: {e}", file=sys.stderr)
+            return None
+        return result
 
+    async def reduce_group(group: List[int]) -> Optional[Any]:
+        if len(group) == 1:
+            return partials[group[0]]
+        try:
+            full_text = await execute_llm_request_async(**session.reduce_request_kwargs([texts[i] for i in group]))
         except Exception as e:
-            print(f"ERROR: 処理失敗: {e}", file=sys.stderr)
-            break
-            
-    return answer_chunks
+            print(f"ERROR: reduce処理失敗: {e}", file=sys.stderr)
+            return None
+        return _parse_answer_output(full_text, session.format)[0]
+
+    partials = [p for p in await _run_bounded_parallel_async(map_chunk, enumerate(chunks, start=1), session.parallelism) if p is not None]
+    level = 0
+    while len(partials) > 1:
+        level += 1
+        texts = session.partial_texts(partials)
+        groups = session.plan_reduce_groups(texts, level)
+        if groups is None:
+            return (await answer_question_async(**session.sequential_reduce_kwargs(texts)))[-1:]
+        merged = session.merge_reduced(partials, groups, await _run_bounded_parallel_async(reduce_group, groups, session.parallelism))
+        if len(merged) == len(partials):
+            print("ERROR: reduce処理がすべて失敗したため、統合前の部分回答を返します。", file=sys.stderr)
+            return merged
+        partials = merged
+    return partials
+
+@LLM_Trace.traced("answer_question", "answer", arg_names=("model_name", "mode", "memory_mode"))
+async def answer_question_async(
+    question: str,
+    data_source: Union[str, Path, Iterable[str]],
+    model_name: str,
+    ollama_client: Any,
+    overlap_tokens: int = 100,
+    prompt: str = "・以下の[参照データ]について回答を生成してください。",
+    prompt_data_tytle: str = f"[参照データ]\n",
+    format: Optional[Dict[str, Any]] = None,
+    prev_response: Optional[Any] = None,
+    prev_response_key: str = "",
+    evaluation_feedback: str = "",
+    stream: bool = False,
+    use_chat: bool = True,
+    options: Optional[Dict[str, Any]] = {'temperature': 0.1},
+    max_inheritance_tokens: int = 2000,
+    mode: str = "sequential",
+    parallelism: int = 4,
+    on_token: Optional[Callable[[str], Optional[bool]]] = None,
+    memory_mode: str = "latest",
+) -> List[Any]:
+    """
+    answer_question の ollama.AsyncClient 版。
+    複数のソース・モデル・評価を asyncio.gather で同時に進められるよう、待機中はイベントループを解放します。
+    同時実行数は execute_llm_request_async のセマフォで制限されます。
+    """
+    if not await _pull_model_if_not_exists_async(model_name, ollama_client):
+        return [f"[エラー: モデル '{model_name}' が利用できません。]"]
+
+    session = _AnswerSession(
+        question, model_name, ollama_client, overlap_tokens, prompt, prompt_data_tytle, format,
+        prev_response, prev_response_key, evaluation_feedback, stream, use_chat, options,
+        max_inheritance_tokens, mode, parallelism, on_token, memory_mode
+    )
+    if not session.fits_context():
+        return []
+    chunks = session.iter_chunks(data_source)
+    if mode == "map_reduce":
+        return await _answer_question_map_reduce_async(session, chunks)
+    return await _answer_question_sequential_async(session, chunks)
+
+def iter_dicts_with_required_keys(
+    data: Union[Dict[str, Any], List[Any], Any],
+    required_keys: Iterable[str]
+) -> Iterator[Dict[str, Any]]:
+    """
+    データ構造を深さ優先で探索し、指定されたすべての必須キーを持つ辞書を見つけた順に返します。
+    Documentが見つかった場合、そのDocumentより下層の探索は行いません。
+    再帰の代わりに明示的なスタック (各階層の反復子) を使うため、深い入れ子でも再帰上限に達しません。
+
+    Args:
+        data: 探索するデータ（辞書、リスト、またはその他の値）。
+        required_keys: Documentが必ず持っているべきキー名。探索の前に frozenset にまとめ、
+            各辞書は d.keys() >= required の1回の集合比較で判定します。
+    """
+    required = frozenset(required_keys)
+    stack: List[Iterator[Any]] = [iter((data,))]
+    while stack:
+        for value in stack[-1]:
+            if isinstance(value, dict):
+                if value.keys() >= required:
+                    # 目的のDocumentが見つかったため、この辞書以下は探索しない
+                    yield value
+                    continue
+                # {"sec1": {doc}, "sec2": {doc}} のように並列にDocumentが存在する可能性があるため、値を探索する
+                stack.append(iter(value.values()))
+                break
+            if isinstance(value, list):
+                stack.append(iter(value))
+                break
+            # その他の型 (文字列、数値など) は何もしない
+        else:
+            stack.pop()
 
 def extract_dicts_with_required_keys(
     data: Union[Dict[str, Any], List[Any], Any],
     required_keys: List[str]
 ) -> List[Dict[str, Any]]:
     """
-    データ構造を再帰的に深く探索し、指定されたすべての必須キーを持つ辞書を抽出します。
+    データ構造を深く探索し、指定されたすべての必須キーを持つ辞書を抽出します。
     Documentが見つかった場合、そのDocumentより下層の探索は行いません。
 
     Args:
@@ -874,42 +3209,59 @@ def extract_dicts_with_required_keys(
     Returns:
         List[Dict[str, Any]]: 抽出されたDocument辞書のリスト。
     """
-    extracted_elements = []
-    
-    # 1. 辞書の場合の処理
-    if isinstance(data, dict):
-        
-        # A. 現在の辞書が目的のDocumentであるかチェック
-        # (例: {"name": "...", "summary": "...", ...} の形式)
-        if all(key in data for key in required_keys):
-            # 目的のDocumentが見つかったため、この辞書を結果に追加し、
-            # この辞書以下のキー/値の探索は行わずに、ここで処理を終了して戻る
-            extracted_elements.append(data)
-            return extracted_elements
-        
-        # B. 目的のDocumentではない場合、値(Value)を再帰的に探索する
-        for key, value in data.items():
-            # Documentが見つかる可能性があるのは、値が辞書またはリストの場合のみ
-            if isinstance(value, (dict, list)):
-                # 再帰呼び出し
-                found = extract_dicts_with_required_keys(value, required_keys)
-                extracted_elements.extend(found)
-                # 注: ここで found が空でない場合でも、他のキーも探索します。
-                # なぜなら、{"sec1": {doc}, "sec2": {doc}} のように並列にDocumentが存在する可能性があるためです。
-
-    # 2. リストの場合の処理
-    elif isinstance(data, list):
-        # リストの要素を順に再帰的に探索する
-        for element in data:
-            # Documentが見つかる可能性があるのは、要素が辞書またはリストの場合のみ
-            if isinstance(element, (dict, list)):
-                # 再帰呼び出し
-                found = extract_dicts_with_required_keys(element, required_keys)
-                extracted_elements.extend(found)
-    
-    # 3. その他の型 (文字列、数値など) の場合は何もしない
+    return list(iter_dicts_with_required_keys(data, required_keys))
 
-    return extracted_elements
+def iter_dicts_with_required_keys_from_stream(
+    source: JsonStreamControl.JsonSource,
+    required_keys: Iterable[str],
+    read_size: int = JsonStreamControl.STREAM_READ_SIZE
+) -> Iterator[Dict[str, Any]]:
+    """
+    JSON のバイト列ストリーム (ファイルオブジェクトなど) を逐次解析し、
+    extract_dicts_with_required_keys と同じ辞書を同じ順序で返します。全体の木は作りません。
+    ・配列の中の要素は、閉じた時点で判定して返し、保持しません
+    ・辞書は閉じるまで自身が Document かどうか確定しないため、辞書の中身 (と中で見つかった候補) はその辞書が閉じるまで保持します
+    """
+    required = frozenset(required_keys)
+    # 各階層: [コンテナ (保持しない配列は None), 現在のキー, 辞書の中で見つかった候補 (辞書のみ)]
+    stack: List[List[Any]] = []
+    open_dicts = 0      # 開いている辞書の数 (0 なら見つけた Document をすぐに返せる)
+
+    def attach(value: Any):
+        """閉じた値を親のコンテナに追加する"""
+        if not stack or stack[-1][0] is None:
+            return
+        container, key, _ = stack[-1]
+        if key is None:
+            container.append(value)
+        else:
+            container[key] = value
+
+    def nearest_candidates() -> List[Dict[str, Any]]:
+        return next(frame[2] for frame in reversed(stack) if frame[2] is not None)
+
+    for event, value in JsonStreamControl.iter_json_events(source, read_size):
+        if event == "start_map":
+            stack.append([{}, None, []])
+            open_dicts += 1
+        elif event == "start_array":
+            stack.append([[] if open_dicts else None, None, None])
+        elif event == "key":
+            stack[-1][1] = value
+        elif event == "value":
+            attach(value)
+        elif event == "end_array":
+            container, _, _ = stack.pop()
+            attach(container)
+        else:  # end_map
+            container, _, candidates = stack.pop()
+            open_dicts -= 1
+            found = [container] if container.keys() >= required else candidates
+            attach(container)
+            if open_dicts:
+                nearest_candidates().extend(found)
+            else:
+                yield from found
 
     
 def clean_markdown_code_block(content: str) -> str:
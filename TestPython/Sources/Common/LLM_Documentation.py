@@ -5,10 +5,12 @@ import sys
 import time
 import shutil
 import re
-from typing import Dict, Any, List, Optional, Union
+from typing import Dict, Any, List, Optional, Union, Tuple, Set
 from pathlib import Path
 import datetime
 import gc
+import asyncio
+import threading
 
 # --- パス設定 ---
 source_directory = os.path.dirname(os.path.abspath(__file__))
@@ -17,6 +19,8 @@ sys.path.insert(0, project_root)
 
 from Sources.Common import LLM_Control 
 from Sources.Common import LLM_Evaluate
+from Sources.Common import LLM_Telemetry
+from Sources.Common import LLM_Trace
 from Sources.Common import FileControl
 from Sources.Common import DictionaryControl
 
@@ -171,9 +175,10 @@ def create_content_document(
     }
     
     return document
+@LLM_Trace.traced("create_document_list", "document", arg_names=("model_name", "answer_mode"))
 def create_document_list(
     question: str,
-    source_texts: List[str],
+    source_texts: List[Union[str, Path]],
     model_name: str,
     ollama_client: Any,
     evaluation_model: str = "",
@@ -184,7 +189,11 @@ def create_document_list(
     prev_response_key: str = None,
 
     format: Optional[Dict[str, Any]] = "",
-    options: Optional[Dict[str, Any]] = {'temperature': 0.2}
+    options: Optional[Dict[str, Any]] = {'temperature': 0.2},
+    answer_mode: str = "sequential",
+    parallelism: int = 4,
+    on_token: Optional[Any] = None,
+    memory_mode: str = "latest"
 ) -> List[Dict[str, Any]]:
     all_results = []
     for text in source_texts:
@@ -200,17 +209,22 @@ def create_document_list(
             print(f"  [Try {retry}] {model_name} で処理中...", file=sys.stderr)
 
             # --- 1. 生成処理 ---
-            responses = LLM_Control.answer_question(
-                question=question,
-                data_source=text,
-                model_name=model_name,
-                ollama_client=ollama_client,
-                prev_response=current_prev_response,
-                prev_response_key=prev_response_key,
-                evaluation_feedback=feedback,
-                format=format,
-                options=options
-            )
+            with LLM_Telemetry.telemetry_context(retry=retry, stage="generate"):
+                responses = LLM_Control.answer_question(
+                    question=question,
+                    data_source=text,
+                    model_name=model_name,
+                    ollama_client=ollama_client,
+                    prev_response=current_prev_response,
+                    prev_response_key=prev_response_key,
+                    evaluation_feedback=feedback,
+                    format=format,
+                    options=options,
+                    mode=answer_mode,
+                    parallelism=parallelism,
+                    on_token=on_token,
+                    memory_mode=memory_mode
+                )
             generated_content = "\n".join([str(r) for r in responses]) if isinstance(responses, list) else str(responses)
             if not generated_content:
                 break
@@ -225,13 +239,14 @@ def create_document_list(
             }
             score = 0
             if evaluation_model:
-                score, summary = LLM_Evaluate.evaluate_text_content(
-                    target_text=generated_content,
-                    question=question,
-                    evaluation_model=evaluation_model,
-                    ollama_client=ollama_client,
-                    evaluate_template=evaluate_template
-                )
+                with LLM_Telemetry.telemetry_context(retry=retry, stage="evaluate"):
+                    score, summary = LLM_Evaluate.evaluate_text_content(
+                        target_text=generated_content,
+                        question=question,
+                        evaluation_model=evaluation_model,
+                        ollama_client=ollama_client,
+                        evaluate_template=evaluate_template
+                    )
                 print(f"    -> 評価スコア: {score} (目標: {target_score})", file=sys.stderr)
                 
                 # 判定が行われた場合のみ evaluation 要素を追加
@@ -262,14 +277,376 @@ def create_document_list(
 
     return all_results
 
+@LLM_Trace.traced("create_document_list", "document", arg_names=("model_name", "answer_mode"))
+async def create_document_list_async(
+    question: str,
+    source_texts: List[Union[str, Path]],
+    model_name: str,
+    ollama_client: Any,
+    evaluation_model: str = "",
+    evaluate_template: str = LLM_Evaluate.EVALUATION_PROMPT_TEMPLATE,
+    target_score: int = 85,
+    max_retry: int = 3,
+    prev_response: str = "",
+    prev_response_key: str = None,
+    format: Optional[Dict[str, Any]] = "",
+    options: Optional[Dict[str, Any]] = {'temperature': 0.2},
+    answer_mode: str = "sequential",
+    parallelism: int = 4,
+    memory_mode: str = "latest"
+) -> List[Dict[str, Any]]:
+    """
+    create_document_list の非同期版 (ollama.AsyncClient を渡す)。
+    source_texts の各ソースの生成・評価・リトライを同時に進めます。
+    複数モデルを同時に処理する場合は、モデルごとの呼び出しを asyncio.gather でまとめてください。
+    """
+    async def process_text(text: str) -> Optional[Dict[str, Any]]:
+        retry = 0
+        current_prev_response = prev_response
+        feedback = ""
+        best_doc = None
+        max_score_found = -1
+
+        while retry < max_retry:
+            start_time = time.time()
+            retry += 1
+            print(f"  [Try {retry}] {model_name} で処理中...", file=sys.stderr)
+
+            with LLM_Telemetry.telemetry_context(retry=retry, stage="generate"):
+                responses = await LLM_Control.answer_question_async(
+                    question=question,
+                    data_source=text,
+                    model_name=model_name,
+                    ollama_client=ollama_client,
+                    prev_response=current_prev_response,
+                    prev_response_key=prev_response_key,
+                    evaluation_feedback=feedback,
+                    format=format,
+                    options=options,
+                    mode=answer_mode,
+                    parallelism=parallelism,
+                    memory_mode=memory_mode
+                )
+            generated_content = "\n".join([str(r) for r in responses]) if isinstance(responses, list) else str(responses)
+            if not generated_content:
+                break
+
+            current_result_doc = {
+                "content": generated_content,
+                "generation_information": {
+                    "model": model_name,
+                    "retrys": retry
+                }
+            }
+            score = 0
+            summary = ""
+            if evaluation_model:
+                with LLM_Telemetry.telemetry_context(retry=retry, stage="evaluate"):
+                    score, summary = await LLM_Evaluate.evaluate_text_content_async(
+                        target_text=generated_content,
+                        question=question,
+                        evaluation_model=evaluation_model,
+                        ollama_client=ollama_client,
+                        evaluate_template=evaluate_template
+                    )
+                print(f"    -> 評価スコア: {score} (目標: {target_score})", file=sys.stderr)
+                current_result_doc["evaluation"] = {
+                    "score": score,
+                    "summary": summary
+                }
+                current_result_doc["generation_information"]["score"] = score
+                current_result_doc["generation_information"]["latency"] = time.time() - start_time
+
+            if best_doc is None or score > max_score_found:
+                max_score_found = score
+                best_doc = current_result_doc
+
+            if evaluation_model and score < target_score:
+                print(f"    ⚠️ スコア不足。改善リトライへ。", file=sys.stderr)
+                current_prev_response = generated_content
+                feedback = summary
+            else:
+                break
+
+        return best_doc
+
+    results = await asyncio.gather(*(process_text(text) for text in source_texts))
+    return [doc for doc in results if doc]
+
+@LLM_Trace.traced("create_packed_document_list", "document", arg_names=("model_name",))
+def create_packed_document_list(
+    question: str,
+    sources: List[Tuple[str, str]],
+    model_name: str,
+    ollama_client: Any,
+    budget_tokens: int,
+    evaluation_model: str = "",
+    evaluate_template: str = LLM_Evaluate.EVALUATION_PROMPT_TEMPLATE,
+    options: Optional[Dict[str, Any]] = {'temperature': 0.2}
+) -> Dict[int, Dict[str, Any]]:
+    """
+    小さな (名前, 本文) ソースを束にまとめて1リクエストで処理し、出力をソースごとのDocumentに分割します。
+    戻り値は sources のインデックス -> Document の辞書です。
+    出力からタグで切り出せなかったソースは含まれないため、呼び出し側で個別処理してください。
+    """
+    results: Dict[int, Dict[str, Any]] = {}
+    bins, _ = LLM_Control.pack_sources(sources, budget_tokens, model_name)
+
+    for bin_no, indexes in enumerate(bins, start=1):
+        start_time = time.time()
+        print(f"  [Pack {bin_no}/{len(bins)}] {model_name} で {len(indexes)} ソースを一括処理中...", file=sys.stderr)
+
+        with LLM_Telemetry.telemetry_context(stage="generate"):
+            responses = LLM_Control.answer_question(
+                question=question,
+                data_source=LLM_Control.build_packed_source_text(sources, indexes),
+                model_name=model_name,
+                ollama_client=ollama_client,
+                prompt="・以下の[参照データ]について回答を生成してください。\n" + LLM_Control.PACKED_SOURCE_PROMPT,
+                options=options
+            )
+        split_outputs = LLM_Control.split_packed_output("\n".join(str(r) for r in responses))
+        # 束全体の所要時間をソース数で按分する
+        latency = (time.time() - start_time) / len(indexes)
+
+        for i in indexes:
+            content = split_outputs.get(str(i))
+            if not content:
+                print(f"    ⚠️ {sources[i][0]} の回答を出力から分割できませんでした。", file=sys.stderr)
+                continue
+
+            doc = {
+                "content": content,
+                "generation_information": {
+                    "model": model_name,
+                    "retrys": 1,
+                    "packed_sources": len(indexes),
+                    "latency": latency
+                }
+            }
+            if evaluation_model:
+                with LLM_Telemetry.telemetry_context(stage="evaluate"):
+                    score, summary = LLM_Evaluate.evaluate_text_content(
+                        target_text=content,
+                        question=question,
+                        evaluation_model=evaluation_model,
+                        ollama_client=ollama_client,
+                        evaluate_template=evaluate_template
+                    )
+                print(f"    -> {sources[i][0]} 評価スコア: {score}", file=sys.stderr)
+                doc["evaluation"] = {"score": score, "summary": summary}
+                doc["generation_information"]["score"] = score
+            results[i] = doc
+
+    return results
+
+def _build_save_file_path(output_path: str, source_name: str, model: str) -> str:
+    """ソース名・モデル名から出力ファイルのパスを作成する"""
+    safe_source_name = re.sub(r'[\\/:*?"<>|]', "_", source_name).strip("_")
+    safe_model_name = re.sub(r'[\\/:*?"<>|]', "_", model)
+    return os.path.join(output_path, f"{safe_source_name}_{safe_model_name}.txt")
+
+def _build_partial_file_writer(partial_file: Any) -> Any:
+    """
+    ストリーミングで届いたテキスト片をそのままファイルへ追記するコールバックを作る。
+    生成のリトライ (telemetry_context の retry) が変わった時はファイルを空にし、試行の見出しを書いてから追記します。
+    """
+    current_retry = object()
+
+    def write_token(piece: str):
+        nonlocal current_retry
+        retry = LLM_Telemetry.current_context().get("retry")
+        if retry != current_retry:
+            current_retry = retry
+            partial_file.seek(0)
+            partial_file.truncate()
+            if retry is not None:
+                partial_file.write(f"===== [Try {retry}] =====\n")
+        partial_file.write(piece)
+        partial_file.flush()
+    return write_token
+
+def _create_packed_source_documents(
+    task: Dict[str, Any],
+    question: str,
+    models: List[str],
+    file_configs: List[Dict[str, Any]],
+    output_path: str,
+    ollama_client: Any,
+    evaluation_model: str = ""
+) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """
+    出力ファイルがまだ無い小さなファイルソースを、モデルごとにまとめて生成・保存します。
+    戻り値は 処理済みの (ファイルパス, モデル) -> 生成したDocument です。
+    """
+    documents: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    max_source_bytes = task.get("pack_source_max_bytes", 1024 * 1024)
+    contents: Dict[str, str] = {}
+
+    for model in models:
+        # 既存出力があるソースは通常処理 (前回回答の継承・skip判定) に任せる
+        candidates = []
+        for config in file_configs:
+            if os.path.exists(_build_save_file_path(output_path, config["name"], model)):
+                continue
+            if os.path.getsize(config["path"]) > max_source_bytes:
+                continue
+            if config["path"] not in contents:
+                contents[config["path"]] = FileControl.read_file(config["path"]) or ""
+            if contents[config["path"]]:
+                candidates.append(config)
+
+        budget_tokens = LLM_Control.get_packing_budget(model, question)
+        if task.get("pack_max_tokens"):
+            budget_tokens = min(budget_tokens, task["pack_max_tokens"])
+        max_source_tokens = task.get("pack_source_max_tokens", budget_tokens // 4)
+
+        token_counts = LLM_Control.count_tokens_batch([contents[c["path"]] for c in candidates], model)
+        selected = [c for c, tokens in zip(candidates, token_counts) if tokens <= max_source_tokens]
+        if len(selected) < 2:
+            continue
+
+        print(f" -> パッキング処理開始 ({model}): {len(selected)} ソース / 予算 {budget_tokens}tokens", file=sys.stderr)
+        sources = [(c["name"], contents[c["path"]]) for c in selected]
+        packed_docs = create_packed_document_list(
+            question=question,
+            sources=sources,
+            model_name=model,
+            ollama_client=ollama_client,
+            budget_tokens=budget_tokens,
+            evaluation_model=evaluation_model
+        )
+
+        for i, doc in sorted(packed_docs.items()):
+            config = selected[i]
+            doc["source_name"] = config["name"]
+            FileControl.write_file(
+                _build_save_file_path(output_path, config["name"], model),
+                DictionaryControl.format_to_text(doc)
+            )
+            documents[(config["path"], model)] = doc
+
+    return documents
+
 class ContentDocument(Dict[str, Any]):
     pass
 
 
-def create_multisource_document_list(task: Dict[str, Any]) -> List[Dict[str, Any]]:
+@LLM_Trace.traced("generate_source_model_documents", "source", arg_names=("model", "source_name"))
+def _generate_source_model_documents(
+    task: Dict[str, Any],
+    question: str,
+    model: str,
+    source_name: str,
+    source_content: str,
+    output_path: str,
+    ollama_client: Any,
+    evaluation_model: str
+) -> List[Dict[str, Any]]:
+    """
+    1つの (ソース, モデル) について、既存ファイルの評価・生成・保存を行い、生成ドキュメントを返す。
+    """
+    existing_mode = task.get("existing_file_mode", "skip")
+    prev_response_key = task.get("prev_response_key", "summary")
+    safe_source_name = re.sub(r'[\\/:*?"<>|]', "_", source_name).strip("_")
+    safe_model_name = re.sub(r'[\\/:*?"<>|]', "_", model)
+    save_file_path = _build_save_file_path(output_path, source_name, model)
+
+    prev_response_content = None
+    skip_generate = False
+    # 1. 既存ファイル/新規生成の切り分け
+    if os.path.exists(save_file_path) :
+        prev_response_content = FileControl.read_file(save_file_path)
+        if existing_mode == "skip":
+            skip_generate = True
+
+    # 2. 評価の実行 (モデルがある場合のみ)
+    prev_score = -1
+    feedback = ""
+    if evaluation_model and prev_response_content:
+        print(f" >> 評価実行中 ({evaluation_model})...", file=sys.stderr)
+        prev_score, feedback = LLM_Evaluate.evaluate_text_content(
+            target_text=prev_response_content,
+            question=question,
+            evaluation_model=evaluation_model,
+            ollama_client=ollama_client
+        )
+    
+    # --- C. AIによる生成処理 (既存ファイルを prev_response として渡す) ---
+    if  not skip_generate:
+        print(f" -> AI処理開始 ({model})", file=sys.stderr)
+        # 生成中のテキストを途中経過ファイル (*.partial) に逐次書き出す (task["stream_to_file"])
+        partial_file = open(save_file_path + ".partial", "w", encoding="utf-8") if task.get("stream_to_file") else None
+        completed = False
+        try:
+            generated_docs = create_document_list(
+                question=question,
+                source_texts=[source_content], 
+                model_name=model,
+                ollama_client=ollama_client,
+                evaluation_model=evaluation_model,
+                target_score=task.get("target_score", 85),
+                prev_response=prev_response_content,
+                prev_response_key=prev_response_key,
+                format=task.get("format"),
+                answer_mode=task.get("answer_mode", "sequential"),
+                parallelism=task.get("parallelism", 4),
+                on_token=_build_partial_file_writer(partial_file) if partial_file else None,
+                memory_mode=task.get("memory_mode", "latest")
+            )
+            completed = bool(generated_docs)
+        finally:
+            if partial_file:
+                partial_file.close()
+                # 生成に失敗・中断した場合は途中経過を残す
+                if completed:
+                    os.remove(partial_file.name)
+                else:
+                    print(f" -> 途中経過を残しました: {partial_file.name}", file=sys.stderr)
+    else:
+        generated_docs = [
+            {
+            "content": prev_response_content,
+            "evaluation": {"score": prev_score, "summary": feedback} if evaluation_model else None,
+            "generation_information": {"model": model, "score": max(0, prev_score)}
+            }
+        ]
+
+    # --- C. 保存処理 ---
+    if not skip_generate:
+        for d in generated_docs:
+            d["source_name"] = source_name
+            # 保存テキスト構築
+            current_score = d.get("evaluation", {}).get("score", 0) if d.get("evaluation") else 0
+            content_body = DictionaryControl.format_to_text(d)
+            
+            # 既存よりスコアが高い、または新規保存の場合のみ書き込み
+            if current_score >= prev_score:
+                FileControl.write_file(save_file_path, content_body)
+            else:
+                # スコアが低い場合の保存処理（オプション）
+                low_score_path = task.get("low_score_output_folder", "")
+                if low_score_path:
+                    now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                    low_score_filename = f"{now_str}_{safe_source_name}_{safe_model_name}.txt"
+                    low_score_full_path = os.path.join(low_score_path, low_score_filename)
+                    FileControl.write_file(low_score_full_path, low_score_full_path)
+                    print(f"    >> スコア未更新のため別フォルダに保存: {low_score_full_path}", file=sys.stderr)
+                else:
+                    print(f"    >> 生成完了（スコア {current_score} は既存 {prev_score} 以下につきファイル更新なし）", file=sys.stderr)                    
+    return generated_docs
+
+@LLM_Trace.traced("create_multisource_document_list", "pipeline")
+def create_multisource_document_list(
+    task: Dict[str, Any],
+    search_contexts: Optional[Dict[str, str]] = None,
+    rag_contexts: Optional[Dict[Tuple[str, str], str]] = None
+) -> List[Dict[str, Any]]:
     """
     ソースの収集、AI処理、ファイル出力を順次実行し、
     最終的に評価用のドキュメントリストを返す統合関数。
+    search_contexts: prefetch_search_contexts の結果 (正規化クエリ -> 検索コンテキスト)。該当が無ければその場で検索する。
+    rag_contexts: prefetch_task_rag_contexts の結果 ((RAGサーバーURL, 質問) -> 参照テキスト)。該当が無ければその場で登録・検索する。
     """
     # --- パラメータ抽出 ---
     question = task.get("text", task.get("question", ""))
@@ -278,14 +655,24 @@ def create_multisource_document_list(task: Dict[str, Any]) -> List[Dict[str, Any
     
     output_path = task.get("auto_doc_output_folder", "./DocumentAuto/Analysis/")
     ranking_output_file_path = task.get("ranking_output_file_path", "./DocumentAuto/ranking.md")
-    existing_mode = task.get("existing_file_mode", "skip") 
     evaluation_model = task.get("evaluation_model", "")
     integrate_model = task.get("integrate_model", "")
     target_paths = FileControl.get_file_path_list(task.get("target_paths", []), recursive=True)
-    prev_response_key = task.get("prev_response_key", "summary")
     
     ollama_client = LLM_Control.initialize_ollama_client(task.get("Ollama_server_url", LLM_Control.OLLAMA_SERVER_URL))
 
+    # LLM応答キャッシュ (task["response_cache"]: True またはキャッシュファイルのパスで有効化)
+    # task["response_cache_bypass"]: True の場合はキャッシュを読まずに再生成し、結果で上書きする
+    response_cache = task.get("response_cache")
+    LLM_Control.configure_response_cache(
+        LLM_Control.RESPONSE_CACHE_FILE if response_cache is True else (response_cache or None),
+        ttl_sec=task.get("response_cache_ttl_sec"),
+        bypass=task.get("response_cache_bypass", False)
+    )
+    # LLM呼び出しごとの性能記録 (task["telemetry_jsonl_path"]: JSONLの出力先 / task["telemetry_prometheus_path"]: Prometheus textfile の出力先)
+    if task.get("telemetry_jsonl_path") or task.get("telemetry_prometheus_path"):
+        LLM_Telemetry.configure_telemetry(task.get("telemetry_jsonl_path"), task.get("telemetry_prometheus_path"))
+
     source_configs = []
     if task.get("use_rag"):
         source_configs.append({"type": "rag", "name": "RAG_Vector_DB"})
@@ -298,103 +685,135 @@ def create_multisource_document_list(task: Dict[str, Any]) -> List[Dict[str, Any
     final_all_documents = []
     os.makedirs(output_path, exist_ok=True)
 
-    for config in source_configs:
-        source_name = config["name"]
-        source_type = config["type"]
-        safe_source_name = re.sub(r'[\\/:*?"<>|]', "_", source_name).strip("_")
+    # --- 小さなファイルソースのパッキング (JSON形式指定時は分割できないため対象外) ---
+    # 生成結果は最後に他のソースと同じ ソース → モデル の順に並べる
+    packed_documents: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    if task.get("pack_sources") and not task.get("format"):
+        file_configs = [c for c in source_configs if c["type"] == "file"]
+        packed_documents = _create_packed_source_documents(
+            task, question, models, file_configs, output_path, ollama_client, evaluation_model
+        )
+    packed_pairs: Set[Tuple[str, str]] = set(packed_documents)
 
-        try:
-            # --- A. コンテンツの取得 ---
-            if source_type == "rag":
-                rag_files = task.get("rag_register_paths", [])
-                rag_url = task.get("rag_server_url", LLM_Control.RAG_SERVER_URL)
-                db_status = LLM_Control.rag_server_register(rag_files, rag_url)
-                source_content = LLM_Control.rag_server_query_context(question, rag_url)
-            elif source_type == "internet":
-                source_content = LLM_Control.get_or_fetch_search_context(
-                    question, task.get("encrypted_secrets_path"), LLM_Control.INTERNET_CACHE_FILE
-                )
-            
-            elif source_type == "file":
-                source_content = FileControl.read_file(config["path"])
-
-            if not source_content: continue
-
-            # --- B. モデル毎のループ ---
-            for model in models:
-                safe_model_name = re.sub(r'[\\/:*?"<>|]', "_", model)
-                save_file_path = os.path.join(output_path, f"{safe_source_name}_{safe_model_name}.txt")
-
-                prev_response_content = None
-                skip_generate = False
-                # 1. 既存ファイル/新規生成の切り分け
-                if os.path.exists(save_file_path) :
-                    prev_response_content = FileControl.read_file(save_file_path)
-                    if existing_mode == "skip":
-                        skip_generate = True
-
-                # 2. 評価の実行 (モデルがある場合のみ)
-                prev_score = -1
-                feedback = ""
-                if evaluation_model and prev_response_content:
-                    print(f" >> 評価実行中 ({evaluation_model})...", file=sys.stderr)
-                    prev_score, feedback = LLM_Evaluate.evaluate_text_content(
-                        target_text=prev_response_content,
-                        question=question,
-                        evaluation_model=evaluation_model,
-                        ollama_client=ollama_client
+    # --- A. コンテンツの取得 (RAG・検索は一度だけ取得し、全モデルで共有する) ---
+    fetched_sources: List[Tuple[Dict[str, Any], Optional[str]]] = []
+    fetched_index: Dict[int, int] = {}  # source_configs の位置 -> fetched_sources の位置
+    for config_index, config in enumerate(source_configs):
+        source_type = config["type"]
+        with LLM_Trace.span(f"fetch {config['name']}", "fetch", source_type=source_type):
+            try:
+                source_content = None
+                if source_type == "rag" and task.get("rag_backend") == "embedded":
+                    # RAGサーバーを使わず、プロセス内のベクトル索引で登録・検索する (numpy が必要)
+                    from Sources.Common import LLM_Retrieval
+                    retrieval_index = LLM_Retrieval.get_retrieval_index(
+                        ollama_client,
+                        task.get("rag_index_dir", LLM_Retrieval.RETRIEVAL_INDEX_DIR),
+                        task.get("rag_embed_model", LLM_Retrieval.DEFAULT_EMBED_MODEL)
                     )
-                
-                # --- C. AIによる生成処理 (既存ファイルを prev_response として渡す) ---
-                if  not skip_generate:
-                    print(f" -> AI処理開始 ({model})", file=sys.stderr)
-                    generated_docs = create_document_list(
-                        question=question,
-                        source_texts=[source_content], 
-                        model_name=model,
-                        ollama_client=ollama_client,
-                        evaluation_model=evaluation_model,
-                        target_score=task.get("target_score", 85),
-                        prev_response=prev_response_content,
-                        prev_response_key=prev_response_key,
-                        format=task.get("format")
+                    db_status = retrieval_index.register(task.get("rag_register_paths", []))
+                    source_content = retrieval_index.query(question, task.get("rag_top_k"), task.get("rag_score_threshold"))
+                elif source_type == "rag":
+                    rag_files = task.get("rag_register_paths", [])
+                    rag_url = task.get("rag_server_url", LLM_Control.RAG_SERVER_URL)
+                    if rag_contexts is not None and (rag_url, question) in rag_contexts:
+                        source_content = rag_contexts[(rag_url, question)]
+                    else:
+                        db_status = LLM_Control.rag_server_register(rag_files, rag_url)
+                        source_content = LLM_Control.rag_server_query_context(question, rag_url)
+                elif source_type == "internet":
+                    search_key = LLM_Control.normalize_search_query(question)
+                    if search_contexts is not None and search_key in search_contexts:
+                        source_content = search_contexts[search_key]
+                    else:
+                        source_content = LLM_Control.get_or_fetch_search_context(
+                            question, task.get("encrypted_secrets_path"),
+                            task.get("internet_search_cash_file_path", LLM_Control.INTERNET_CACHE_FILE)
+                        )
+                elif source_type == "file":
+                    # ファイルは最初に使うモデルの処理直前に読み込む (フェーズB)
+                    if all((config["path"], m) in packed_pairs for m in models): continue
+                    if task.get("csv_mode") == "profile" and config["path"].lower().endswith(".csv"):
+                        # CSVは全行の代わりに列の統計と層化サンプルを参照データにする (pandas が必要)
+                        from Sources.Common import CsvControl
+                        source_content = CsvControl.read_csv_profile_text(
+                            config["path"],
+                            stratify_column=task.get("csv_stratify_column"),
+                            sample_rows=task.get("csv_sample_rows", CsvControl.PROFILE_SAMPLE_ROWS)
+                        )
+                        if not source_content: continue
+
+                if source_type != "file" and not source_content: continue
+                fetched_index[config_index] = len(fetched_sources)
+                fetched_sources.append((config, source_content))
+            except Exception as e:
+                print(f" ❌ エラー: {e}", file=sys.stderr)
+
+    # --- B. モデル単位のスケジューリング ---
+    # モデルを外側のループにして同じモデルの処理を連続させ、ソース毎のモデル再ロードを避ける。
+    # 現在のモデルの最後のソースを処理している間に、次のモデルを裏でプリロードする。
+    keep_alive = task.get("keep_alive", "30m")
+    preload_next_model = task.get("preload_next_model", True)
+    generated_by_pair: Dict[Tuple[int, int], List[Dict[str, Any]]] = {}
+    # ファイルソースはモデルをまたいで1回だけ読み込み、最後に使うモデルの処理後に解放する
+    # (大きなファイルは open_text_source が Path を返すため、保持するのは小さなファイルの本文だけ)
+    file_sources: Dict[int, Union[str, Path]] = {}
+    last_model_index = {
+        source_index: max((i for i, m in enumerate(models) if (config.get("path"), m) not in packed_pairs), default=-1)
+        for source_index, (config, source_content) in enumerate(fetched_sources)
+        if source_content is None
+    }
+
+    for model_index, model in enumerate(models):
+        work_items = [
+            (source_index, config, source_content)
+            for source_index, (config, source_content) in enumerate(fetched_sources)
+            if (config.get("path"), model) not in packed_pairs
+        ]
+        if not work_items: continue
+
+        with LLM_Trace.span(f"model {model}", "model", model=model, sources=len(work_items)), \
+                LLM_Control.keep_alive_override(model, keep_alive):
+            next_model = next((m for m in models[model_index + 1:] if m != model), None)
+            warm_thread = None
+
+            for work_index, (source_index, config, source_content) in enumerate(work_items):
+                if preload_next_model and next_model and warm_thread is None and work_index == len(work_items) - 1:
+                    warm_thread = threading.Thread(
+                        target=LLM_Control.preload_model, args=(ollama_client, next_model, keep_alive), daemon=True
                     )
-                else:
-                    generated_docs = [
-                        {
-                        "content": prev_response_content,
-                        "evaluation": {"score": prev_score, "summary": feedback} if evaluation_model else None,
-                        "generation_information": {"model": model, "score": max(0, prev_score)}
-                        }
-                    ]
-
-                # --- C. 保存処理 ---
-                if not skip_generate:
-                    for d in generated_docs:
-                        d["source_name"] = source_name
-                        # 保存テキスト構築
-                        current_score = d.get("evaluation", {}).get("score", 0) if d.get("evaluation") else 0
-                        content_body = DictionaryControl.format_to_text(d)
-                        
-                        # 既存よりスコアが高い、または新規保存の場合のみ書き込み
-                        if current_score >= prev_score:
-                            FileControl.write_file(save_file_path, content_body)
-                        else:
-                            # スコアが低い場合の保存処理（オプション）
-                            low_score_path = task.get("low_score_output_folder", "")
-                            if low_score_path:
-                                now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                                low_score_filename = f"{now_str}_{safe_source_name}_{safe_model_name}.txt"
-                                low_score_full_path = os.path.join(low_score_path, low_score_filename)
-                                FileControl.write_file(low_score_full_path, low_score_full_path)
-                                print(f"    >> スコア未更新のため別フォルダに保存: {low_score_full_path}", file=sys.stderr)
-                            else:
-                                print(f"    >> 生成完了（スコア {current_score} は既存 {prev_score} 以下につきファイル更新なし）", file=sys.stderr)                    
-                final_all_documents.extend(generated_docs)
+                    warm_thread.start()
+                try:
+                    if source_content is None:
+                        # 大きなファイルは Path のまま渡し、answer_question 側でメモリマップから逐次チャンク化する
+                        if source_index not in file_sources:
+                            file_sources[source_index] = LLM_Control.open_text_source(config["path"])
+                        source_content = file_sources[source_index]
+                    if not source_content: continue
+                    with LLM_Telemetry.telemetry_context(source=config["name"]):
+                        generated_by_pair[(source_index, model_index)] = _generate_source_model_documents(
+                            task, question, model, config["name"], source_content, output_path, ollama_client, evaluation_model
+                        )
+                except Exception as e:
+                    print(f" ❌ エラー: {e}", file=sys.stderr)
+                if last_model_index.get(source_index) == model_index:
+                    file_sources.pop(source_index, None)
                 gc.collect()
 
-        except Exception as e:
-            print(f" ❌ エラー: {e}", file=sys.stderr)
+            # 使い終わったモデルを解放する (後続の評価・統合や再登場で使うモデルは残す)
+            if next_model and model not in (evaluation_model, integrate_model) and model not in models[model_index + 1:]:
+                LLM_Control.unload_model(ollama_client, model)
+            if warm_thread:
+                warm_thread.join()
+
+    # 出力順は従来通り ソース → モデル の順に並べ直す (パッキングで生成したものも元のソースの位置に置く)
+    for config_index, config in enumerate(source_configs):
+        for model_index, model in enumerate(models):
+            packed_document = packed_documents.get((config.get("path"), model))
+            if packed_document is not None:
+                final_all_documents.append(packed_document)
+            elif config_index in fetched_index:
+                final_all_documents.extend(generated_by_pair.get((fetched_index[config_index], model_index), []))
 
     # --- C. ランキング出力 (evaluation) ---
     if evaluation_model and len(final_all_documents) > 1 and ranking_output_file_path:
@@ -415,6 +834,7 @@ def create_multisource_document_list(task: Dict[str, Any]) -> List[Dict[str, Any
 # --------------------------------------------------------------------------------
 # 3. 構成要素の統合関数: integrate_document_list (修正版: JSONではなく単一のstrを返す)
 # --------------------------------------------------------------------------------
+@LLM_Trace.traced("integrate_document_list", "integrate", arg_names=("model_name",))
 def integrate_document_list(
     question: str,
     document_list: List[Dict[str, Any]],
@@ -501,18 +921,85 @@ def _write_documents_to_file_step(doc_root: str, documents: Union[Dict[str, Any]
         except Exception as e:
             print(f"[ERROR] Document保存に失敗: {e}", file=sys.stderr)
 
-def llm_documentation(tasks:Union[ Dict[str, Any],List[Dict[str, Any]]]):
+def prefetch_task_search_contexts(tasks: List[Dict[str, Any]], search_client: Any = None) -> Dict[str, str]:
+    """
+    インターネット検索を使う全タスクの質問を先に集め、重複を除いてまとめて検索する。
+    キャッシュファイル・認証情報の組み合わせごとに prefetch_search_contexts を呼び出します。
+    """
+    question_groups: Dict[Tuple[str, Optional[str]], List[str]] = {}
+    for task in tasks:
+        if not task.get("use_internet_search"):
+            continue
+        question = task.get("text", task.get("question", ""))
+        group_key = (task.get("internet_search_cash_file_path", LLM_Control.INTERNET_CACHE_FILE), task.get("encrypted_secrets_path"))
+        question_groups.setdefault(group_key, []).append(question)
+
+    search_contexts: Dict[str, str] = {}
+    for (cache_file_path, secrets_path), questions in question_groups.items():
+        try:
+            search_contexts.update(LLM_Control.prefetch_search_contexts(
+                questions, secrets_path, cache_file_path, search_client=search_client
+            ))
+        except Exception as e:
+            print(f"検索のプリフェッチに失敗しました (各タスクで個別に検索します): {e}", file=sys.stderr)
+    return search_contexts
+
+def prefetch_task_rag_contexts(tasks: List[Dict[str, Any]]) -> Dict[Tuple[str, str], str]:
+    """
+    RAGサーバーを使う全タスクの登録ファイルと質問を先に集め、サーバーごとに登録をまとめてから
+    rag_server_query_contexts (/query_batch) で全質問を1往復で検索する。
+    同じサーバーを使うタスクの登録ファイルは、どのタスクの検索にも含まれます (サーバーの索引は共有のため)。
+    """
+    server_groups: Dict[str, Tuple[List[str], List[str]]] = {}
+    for task in tasks:
+        if not task.get("use_rag") or task.get("rag_backend") == "embedded":
+            continue
+        rag_url = task.get("rag_server_url", LLM_Control.RAG_SERVER_URL)
+        paths, questions = server_groups.setdefault(rag_url, ([], []))
+        rag_files = task.get("rag_register_paths", [])
+        for path in [rag_files] if isinstance(rag_files, str) else rag_files:
+            if path not in paths:
+                paths.append(path)
+        question = task.get("text", task.get("question", ""))
+        if question not in questions:
+            questions.append(question)
+
+    rag_contexts: Dict[Tuple[str, str], str] = {}
+    for rag_url, (paths, questions) in server_groups.items():
+        try:
+            LLM_Control.rag_server_register(paths, rag_url)
+            contexts = LLM_Control.rag_server_query_contexts(questions, rag_url)
+            rag_contexts.update({(rag_url, question): context for question, context in zip(questions, contexts)})
+        except Exception as e:
+            print(f"RAG検索のプリフェッチに失敗しました (各タスクで個別に検索します): {e}", file=sys.stderr)
+    return rag_contexts
+
+def llm_documentation(tasks:Union[ Dict[str, Any],List[Dict[str, Any]]], search_client: Any = None):
     if not isinstance(tasks,list):
         tasks =[tasks]
+
+    # 検索は全タスク分を先にまとめて取得する (同じ質問は1回だけ検索)
+    search_contexts = prefetch_task_search_contexts(tasks, search_client)
+    # RAGサーバーの検索も全タスク分をまとめて1往復で取得する
+    rag_contexts = prefetch_task_rag_contexts(tasks)
         
     for i, task in enumerate(tasks):
         print(f"\n\n========================= タスク {i+1}/{len(tasks)} の処理開始 =========================", file=sys.stderr)
         try:
             #llm_documentation_dict(task)
-            create_multisource_document_list(task)
+            # 処理区間のトレース (task["trace_output_path"]: Chrome Trace JSON の出力先。Perfetto などで開けます)
+            if task.get("trace_output_path"):
+                LLM_Trace.start_trace(task["trace_output_path"])
+            with LLM_Telemetry.telemetry_context(task=task.get("name", f"タスク{i+1}")):
+                with LLM_Trace.span(f"task {i+1}", "task"):
+                    create_multisource_document_list(task, search_contexts, rag_contexts)
         except Exception as e:
             print(f"タスク {i+1} の実行中に予期せぬエラーが発生しました: {e}", file=sys.stderr)
             continue
+        finally:
+            if task.get("trace_output_path"):
+                LLM_Trace.save_trace()
+                LLM_Trace.stop_trace()
 
 def main():
     # 動作確認用テストケース
@@ -15,6 +15,7 @@ sys.path.insert(0, project_root)
 
 # LLM_Control.py と KeyManager.py から必要な関数や設定をインポート
 from Sources.Common import LLM_Control 
+from Sources.Common import LLM_Trace
 from Sources.Common import DictionaryControl
 from Sources.Common import FileControl 
 
@@ -141,6 +142,7 @@ def format_ranking_output(
 # I. 純粋関数：評価ロジック
 # ====================================================================
 
+@LLM_Trace.traced("evaluate_text_content", "evaluate", arg_names=("evaluation_model",))
 def evaluate_text_content(
     target_text: str,
     question: str,
@@ -166,6 +168,34 @@ def evaluate_text_content(
     )
     
     return parse_evaluation_output(response_text)
+
+@LLM_Trace.traced("evaluate_text_content", "evaluate", arg_names=("evaluation_model",))
+async def evaluate_text_content_async(
+    target_text: str,
+    question: str,
+    evaluation_model: str,
+    ollama_client: Any,
+    latency: float = 0.0,
+    evaluate_template: str = EVALUATION_PROMPT_TEMPLATE
+) -> Tuple[int, str]:
+    """
+    evaluate_text_content の ollama.AsyncClient 版。
+    生成と評価を同時に進める非同期パイプラインから利用します。
+    """
+    prompt = evaluate_template.format(question=question, answer=target_text, latency=latency)
+
+    response_text = await LLM_Control.execute_llm_request_async(
+        ollama_client=ollama_client,
+        model_name=evaluation_model,
+        question="以下の回答を評価してください。",
+        prompt=prompt,
+        system_prompt="あなたは厳格な採点官です。",
+        use_chat=True,
+        options={'temperature': 0.1}
+    )
+
+    return parse_evaluation_output(response_text)
+
 def format_and_save_ranking(
     question: str, 
     evaluation_model: str, 
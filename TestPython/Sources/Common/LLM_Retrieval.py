@@ -0,0 +1,324 @@
+import os
+import sys
+import time
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+# --- パス設定 ---
+source_directory = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(source_directory, "..", ".."))
+sys.path.insert(0, project_root)
+
+from Sources.Common import LLM_Control
+from Sources.Common import FileControl
+
+# ====================================================================
+# 組み込みベクトル検索 (RAGサーバーの代替)
+# --------------------------------------------------------------------
+# ・rag_server_register / rag_server_query_context と同じ登録・検索の使い方を、プロセス内で提供する
+# ・埋め込みは Ollama の embed で作成し、正規化した float32 行列を np.memmap で保持する
+# ・チャンク本文・ファイルのハッシュは同じフォルダの SQLite に保存する
+# ====================================================================
+
+RETRIEVAL_INDEX_DIR = "./DocumentAuto/RetrievalIndex/"
+DEFAULT_EMBED_MODEL = "nomic-embed-text"
+RETRIEVAL_CHUNK_TOKENS = 512     # 1チャンクのトークン数
+RETRIEVAL_CHUNK_OVERLAP = 64     # チャンク間の重複トークン数
+RETRIEVAL_EMBED_BATCH = 32       # 1回の embed 呼び出しで送るチャンク数
+RETRIEVAL_DEFAULT_TOP_K = 5
+_INITIAL_CAPACITY = 1024         # 行列の初期行数 (不足時は倍に拡張)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    row   INTEGER PRIMARY KEY,
+    path  TEXT    NOT NULL,
+    text  TEXT    NOT NULL,
+    alive INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS idx_chunks_path ON chunks (path);
+CREATE TABLE IF NOT EXISTS files (
+    path  TEXT PRIMARY KEY,
+    hash  TEXT NOT NULL,
+    size  INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+"""
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """各行を単位ベクトルにする (内積 = コサイン類似度)。(純粋)"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class EmbeddedRetrievalIndex:
+    """
+    1フォルダに保存するベクトル索引。
+    vectors.f32 (行列本体, memmap) と index.sqlite3 (チャンク本文・ファイル情報・次元数など) で構成されます。
+    """
+
+    def __init__(self, index_dir: str, ollama_client: Any, embed_model: str = DEFAULT_EMBED_MODEL):
+        self.index_dir = index_dir
+        self.ollama_client = ollama_client
+        self.embed_model = embed_model
+        self._model_ready = False
+        self._lock = threading.RLock()
+        os.makedirs(index_dir, exist_ok=True)
+
+        self._vector_path = os.path.join(index_dir, "vectors.f32")
+        self._connection = sqlite3.connect(os.path.join(index_dir, "index.sqlite3"), check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+        self._connection.commit()
+
+        stored_model = self._get_meta("embed_model")
+        if stored_model and stored_model != embed_model:
+            raise ValueError(
+                f"索引 {index_dir} は埋め込みモデル '{stored_model}' で作成されています ('{embed_model}' は使用できません)。"
+            )
+        self.dim = int(self._get_meta("dim") or 0)
+        self.count = int(self._get_meta("count") or 0)
+        self.capacity = int(self._get_meta("capacity") or 0)
+        self._vectors: Optional[np.memmap] = None
+        self._alive = np.zeros(self.capacity, dtype=bool)
+        if self.dim:
+            self._open_vectors()
+            for (row,) in self._connection.execute("SELECT row FROM chunks WHERE alive = 1"):
+                self._alive[row] = True
+
+    # --- 内部: メタ情報・行列の管理 ---
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, **values: Any):
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", [(k, str(v)) for k, v in values.items()]
+        )
+
+    def _open_vectors(self):
+        self._vectors = np.memmap(self._vector_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dim))
+
+    def _ensure_capacity(self, required_rows: int, dim: int):
+        """行列の行数が足りない場合はファイルを拡張して開き直す"""
+        if not self.dim:
+            self.dim = dim
+            self._set_meta(dim=dim, embed_model=self.embed_model)
+        elif dim != self.dim:
+            raise ValueError(f"埋め込みの次元数が索引と一致しません ({dim} != {self.dim})")
+        if required_rows <= self.capacity:
+            return
+
+        new_capacity = max(_INITIAL_CAPACITY, self.capacity)
+        while new_capacity < required_rows:
+            new_capacity *= 2
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        with open(self._vector_path, "r+b" if os.path.exists(self._vector_path) else "w+b") as f:
+            f.truncate(new_capacity * self.dim * 4)
+        self.capacity = new_capacity
+        self._alive = np.concatenate([self._alive, np.zeros(new_capacity - len(self._alive), dtype=bool)])
+        self._open_vectors()
+
+    def _ensure_embed_model(self):
+        """初回の埋め込み前に、埋め込みモデルがローカルに無ければ取得する"""
+        if self._model_ready:
+            return
+        if not LLM_Control._pull_model_if_not_exists(self.embed_model, self.ollama_client):
+            raise RuntimeError(f"埋め込みモデル '{self.embed_model}' を取得できませんでした。")
+        self._model_ready = True
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        self._ensure_embed_model()
+        response = self.ollama_client.embed(model=self.embed_model, input=texts)
+        return _normalize_rows(np.asarray(response["embeddings"], dtype=np.float32))
+
+    def _add_chunks(self, path: str, texts: List[str]):
+        vectors = self._embed(texts)
+        start = self.count
+        self._ensure_capacity(start + len(texts), vectors.shape[1])
+        self._vectors[start:start + len(texts)] = vectors
+        self._alive[start:start + len(texts)] = True
+        self._connection.executemany(
+            "INSERT INTO chunks (row, path, text, alive) VALUES (?, ?, ?, 1)",
+            [(start + i, path, text) for i, text in enumerate(texts)]
+        )
+        self.count = start + len(texts)
+
+    def _remove_path(self, path: str):
+        """再登録するファイルの古いチャンクを無効化する (行列の行は再利用しない)"""
+        rows = [row for (row,) in self._connection.execute("SELECT row FROM chunks WHERE path = ? AND alive = 1", (path,))]
+        if rows:
+            self._alive[rows] = False
+            self._connection.execute("UPDATE chunks SET alive = 0 WHERE path = ?", (path,))
+
+    # --- 登録 ---
+    def register(self, path_list: Union[str, List[str]], force: bool = False) -> bool:
+        """
+        ファイルをチャンク分割・埋め込みして索引に追加します (rag_server_register と同じ使い方)。
+        前回登録時から内容が変わっていないファイルはスキップします。
+        """
+        file_paths = FileControl.get_file_path_list(path_list, recursive=True)
+        registered = unchanged = 0
+        start_time = time.perf_counter()
+
+        with self._lock:
+            for path in file_paths:
+                abs_path = os.path.abspath(path)
+                count_before, dim_before = self.count, self.dim
+                try:
+                    stat = os.stat(abs_path)
+                    record = self._connection.execute(
+                        "SELECT hash, size, mtime FROM files WHERE path = ?", (abs_path,)
+                    ).fetchone()
+                    if not force and record and record[1] == stat.st_size and record[2] == stat.st_mtime:
+                        unchanged += 1
+                        continue
+                    file_hash = LLM_Control._hash_file(abs_path)
+                    if not force and record and record[0] == file_hash:
+                        self._connection.execute(
+                            "UPDATE files SET size = ?, mtime = ? WHERE path = ?", (stat.st_size, stat.st_mtime, abs_path)
+                        )
+                        unchanged += 1
+                        continue
+
+                    self._remove_path(abs_path)
+                    batch: List[str] = []
+                    for chunk in LLM_Control.iter_file_chunks(abs_path, RETRIEVAL_CHUNK_TOKENS, self.embed_model, RETRIEVAL_CHUNK_OVERLAP):
+                        if not chunk.strip():
+                            continue
+                        batch.append(chunk)
+                        if len(batch) >= RETRIEVAL_EMBED_BATCH:
+                            self._add_chunks(abs_path, batch)
+                            batch = []
+                    if batch:
+                        self._add_chunks(abs_path, batch)
+
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO files (path, hash, size, mtime) VALUES (?, ?, ?, ?)",
+                        (abs_path, file_hash, stat.st_size, stat.st_mtime)
+                    )
+                    # ファイル単位で確定させ、途中で止まっても登録済み分は再利用できるようにする
+                    self._set_meta(count=self.count, capacity=self.capacity)
+                    if self._vectors is not None:
+                        self._vectors.flush()
+                    self._connection.commit()
+                    registered += 1
+                except Exception as e:
+                    # このファイルの追加分を取り消し、無効化した旧チャンクを元に戻す
+                    self._connection.rollback()
+                    self.count = count_before
+                    if not dim_before and self.dim:
+                        # 最初の登録で確定した次元数もメタ情報と一緒に取り消し、行列は次の登録で作り直す
+                        self.dim = self.capacity = 0
+                        self._vectors = None
+                        self._alive = np.zeros(0, dtype=bool)
+                    self._alive[count_before:] = False
+                    for (row,) in self._connection.execute("SELECT row FROM chunks WHERE path = ? AND alive = 1", (abs_path,)):
+                        self._alive[row] = True
+                    print(f"RAG(組み込み): 警告: ファイル {path} の登録に失敗しました: {e}", file=sys.stderr)
+
+            self._connection.commit()
+
+        print(
+            f"RAG(組み込み): 登録 {registered} 件 / 変更なし {unchanged} 件 "
+            f"(有効チャンク {int(self._alive.sum())} 件, {time.perf_counter() - start_time:.1f}秒)",
+            file=sys.stderr
+        )
+        return int(self._alive.sum()) > 0
+
+    # --- 検索 ---
+    def search(
+        self,
+        query: str,
+        top_k: Optional[int] = None,
+        score_threshold: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        """クエリに近いチャンクを [{"text", "path", "score"}] で類似度の高い順に返す"""
+        if not query.strip() or not self.count:
+            return []
+        top_k = top_k or RETRIEVAL_DEFAULT_TOP_K
+        query_vector = self._embed([query])[0]
+
+        with self._lock:
+            scores = self._vectors[:self.count] @ query_vector
+            scores = np.where(self._alive[:self.count], scores, -np.inf)
+            if score_threshold is not None:
+                scores = np.where(scores >= score_threshold, scores, -np.inf)
+
+            k = min(top_k, self.count)
+            candidates = np.argpartition(-scores, k - 1)[:k]
+            ranked = [int(i) for i in candidates[np.argsort(-scores[candidates])] if np.isfinite(scores[i])]
+            if not ranked:
+                return []
+            rows = {
+                row: (path, text) for row, path, text in self._connection.execute(
+                    f"SELECT row, path, text FROM chunks WHERE row IN ({','.join('?' * len(ranked))})", ranked
+                )
+            }
+        return [
+            {"text": rows[i][1], "path": rows[i][0], "score": float(scores[i])}
+            for i in ranked if i in rows
+        ]
+
+    def query(self, query: str, top_k: Optional[int] = None, score_threshold: Optional[float] = None) -> str:
+        """rag_server_query_context と同じ形式 (チャンク本文を空行で連結) の参照テキストを返す"""
+        hits = self.search(query, top_k, score_threshold)
+        if not hits:
+            print("RAG(組み込み): 関連コンテキストなし", file=sys.stderr)
+            return ""
+        print(f"RAG(組み込み): {len(hits)} 件取得（threshold={score_threshold}）", file=sys.stderr)
+        return "\n\n".join(hit["text"] for hit in hits)
+
+    def close(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._vectors = None
+            self._connection.close()
+
+
+_INDEXES: Dict[Tuple[str, str], EmbeddedRetrievalIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+def get_retrieval_index(
+    ollama_client: Any,
+    index_dir: str = RETRIEVAL_INDEX_DIR,
+    embed_model: str = DEFAULT_EMBED_MODEL
+) -> EmbeddedRetrievalIndex:
+    """索引フォルダ・埋め込みモデルごとに1つだけ開き、使い回す"""
+    key = (os.path.abspath(index_dir), embed_model)
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(key)
+        if index is None:
+            index = EmbeddedRetrievalIndex(index_dir, ollama_client, embed_model)
+            _INDEXES[key] = index
+        return index
+
+def retrieval_register(
+    path_list: Union[str, List[str]],
+    ollama_client: Any,
+    index_dir: str = RETRIEVAL_INDEX_DIR,
+    embed_model: str = DEFAULT_EMBED_MODEL,
+    force: bool = False
+) -> bool:
+    """rag_server_register の組み込み版"""
+    return get_retrieval_index(ollama_client, index_dir, embed_model).register(path_list, force=force)
+
+def retrieval_query_context(
+    query: str,
+    ollama_client: Any,
+    index_dir: str = RETRIEVAL_INDEX_DIR,
+    embed_model: str = DEFAULT_EMBED_MODEL,
+    top_k: Optional[int] = None,
+    score_threshold: Optional[float] = None
+) -> str:
+    """rag_server_query_context の組み込み版"""
+    return get_retrieval_index(ollama_client, index_dir, embed_model).query(query, top_k, score_threshold)
@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import contextvars
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+# ====================================================================
+# LLM 呼び出しごとの性能記録
+# --------------------------------------------------------------------
+# Ollama の応答に含まれる prompt_eval_count / eval_count / *_duration を1件ずつ記録し、
+# ・JSONL ファイル (1行1リクエスト) に追記する
+# ・Prometheus の text exposition 形式のファイル (node_exporter の textfile collector 用) に集計を書き出す
+# タスク名・ソース名・リトライ回数などは telemetry_context() で設定した値を各レコードに付与する
+# ====================================================================
+
+TELEMETRY_JSONL_PATH: Optional[str] = None
+TELEMETRY_PROMETHEUS_PATH: Optional[str] = None
+PROMETHEUS_METRIC_PREFIX = "llm"
+# Prometheus のラベルに使うコンテキストの項目 (source などは種類が多すぎるため JSONL のみに出力する)
+PROMETHEUS_LABELS = ("model", "task", "stage")
+
+_CONTEXT: contextvars.ContextVar = contextvars.ContextVar("llm_telemetry_context", default={})
+_LOCK = threading.Lock()
+# (メトリクス名, ラベルの組) -> 合計値
+_PROMETHEUS_TOTALS: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+
+# メトリクス名 -> (レコードの項目, 説明)。項目が None のものはリクエスト数を数える
+_PROMETHEUS_COUNTERS = {
+    "requests_total": (None, "LLMリクエスト数"),
+    "cache_hits_total": ("cached", "応答キャッシュから返したリクエスト数"),
+    "aborted_total": ("aborted", "生成を中断したリクエスト数"),
+    "prompt_tokens_total": ("prompt_tokens", "入力 (プロンプト) トークン数"),
+    "output_tokens_total": ("output_tokens", "出力トークン数"),
+    "load_seconds_total": ("load_sec", "モデルのロード時間 (秒)"),
+    "prompt_eval_seconds_total": ("prompt_eval_sec", "プロンプト評価時間 (秒)"),
+    "eval_seconds_total": ("eval_sec", "生成時間 (秒)"),
+    "request_seconds_total": ("total_sec", "リクエスト全体の時間 (秒)"),
+}
+
+
+def configure_telemetry(jsonl_path: Optional[str] = None, prometheus_path: Optional[str] = None):
+    """記録先を設定する。両方 None の場合は記録しない。"""
+    global TELEMETRY_JSONL_PATH, TELEMETRY_PROMETHEUS_PATH
+    TELEMETRY_JSONL_PATH = jsonl_path or None
+    TELEMETRY_PROMETHEUS_PATH = prometheus_path or None
+    for path in (TELEMETRY_JSONL_PATH, TELEMETRY_PROMETHEUS_PATH):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+def is_enabled() -> bool:
+    return bool(TELEMETRY_JSONL_PATH or TELEMETRY_PROMETHEUS_PATH)
+
+@contextlib.contextmanager
+def telemetry_context(**fields: Any) -> Iterator[Dict[str, Any]]:
+    """
+    with 文の中で行われた LLM 呼び出しのレコードに fields (task / source / retry / stage など) を付与する。
+    入れ子にした場合は外側の値に追加・上書きされます。asyncio のタスクには作成時の値が引き継がれます。
+    """
+    merged = {**_CONTEXT.get(), **fields}
+    token = _CONTEXT.set(merged)
+    try:
+        yield merged
+    finally:
+        _CONTEXT.reset(token)
+
+def current_context() -> Dict[str, Any]:
+    return dict(_CONTEXT.get())
+
+
+def _nanoseconds_to_sec(value: Any) -> Optional[float]:
+    return value / 1e9 if isinstance(value, (int, float)) and value else None
+
+def build_record(values: Dict[str, Any], final_response: Any = None) -> Dict[str, Any]:
+    """
+    LLM_Control の計測値と Ollama の最終応答から1リクエスト分のレコードを作る。(純粋)
+    応答に含まれない項目 (キャッシュ応答など) は None になります。
+    """
+    def field(name: str) -> Any:
+        return final_response.get(name) if final_response is not None else None
+
+    prompt_tokens = field("prompt_eval_count")
+    prompt_eval_sec = _nanoseconds_to_sec(field("prompt_eval_duration"))
+    record = {
+        "timestamp": time.time(),
+        **current_context(),
+        "model": values.get("model"),
+        "prompt_tokens": prompt_tokens,
+        "output_tokens": values.get("output_tokens"),
+        "load_sec": _nanoseconds_to_sec(field("load_duration")),
+        "prompt_eval_sec": prompt_eval_sec,
+        "eval_sec": _nanoseconds_to_sec(field("eval_duration")),
+        "ttft_sec": values.get("ttft_sec"),
+        # サーバー側の total_duration が無い場合 (キャッシュ応答など) は手元で測った時間
+        "total_sec": _nanoseconds_to_sec(field("total_duration")) or values.get("total_sec"),
+        "tokens_per_sec": values.get("tokens_per_sec"),
+        "prompt_tokens_per_sec": prompt_tokens / prompt_eval_sec if prompt_tokens and prompt_eval_sec else None,
+        "cached": bool(values.get("cached")),
+        "aborted": bool(values.get("aborted")),
+    }
+    return record
+
+def record_llm_call(values: Dict[str, Any], final_response: Any = None) -> Optional[Dict[str, Any]]:
+    """1リクエスト分のレコードを作り、設定された記録先へ書き出す。記録しない場合は None を返す。"""
+    if not is_enabled():
+        return None
+    record = build_record(values, final_response)
+    try:
+        with _LOCK:
+            if TELEMETRY_JSONL_PATH:
+                with open(TELEMETRY_JSONL_PATH, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            if TELEMETRY_PROMETHEUS_PATH:
+                _accumulate_prometheus(record)
+                _write_prometheus_file(TELEMETRY_PROMETHEUS_PATH)
+    except Exception as e:
+        print(f"テレメトリの書き出しに失敗しました: {e}", file=sys.stderr)
+    return record
+
+
+# --- Prometheus text exposition ---
+def _escape_label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _accumulate_prometheus(record: Dict[str, Any]):
+    labels = tuple((name, _escape_label_value(record.get(name) or "")) for name in PROMETHEUS_LABELS)
+    for metric, (field, _) in _PROMETHEUS_COUNTERS.items():
+        value = 1 if field is None else record.get(field)
+        if value:
+            key = (metric, labels)
+            _PROMETHEUS_TOTALS[key] = _PROMETHEUS_TOTALS.get(key, 0.0) + float(value)
+
+def format_prometheus() -> str:
+    """集計済みの値を text exposition 形式の文字列にする"""
+    lines = []
+    for metric, (_, description) in _PROMETHEUS_COUNTERS.items():
+        name = f"{PROMETHEUS_METRIC_PREFIX}_{metric}"
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} counter")
+        for (metric_name, labels), value in sorted(_PROMETHEUS_TOTALS.items()):
+            if metric_name != metric:
+                continue
+            label_text = ",".join(f'{label}="{value_text}"' for label, value_text in labels)
+            lines.append(f"{name}{{{label_text}}} {value:.6g}")
+    return "\n".join(lines) + "\n"
+
+def _write_prometheus_file(path: str):
+    """収集側が書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(format_prometheus())
+    os.replace(temp_path, path)
@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import inspect
+import functools
+import threading
+import contextlib
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# --- パス設定 ---
+source_directory = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(source_directory, "..", ".."))
+sys.path.insert(0, project_root)
+
+from Sources.Common import LLM_Telemetry
+
+# ====================================================================
+# 処理区間 (スパン) のトレース
+# --------------------------------------------------------------------
+# タスク → ソース取得 / モデル → ドキュメント生成 → チャンク → LLMリクエスト / 評価 / 統合 の各区間を
+# Chrome Trace Event 形式 (完了イベント "ph": "X") で記録し、JSON に書き出す。
+# 書き出したファイルは Perfetto (ui.perfetto.dev) や chrome://tracing で開くとタイムラインとして表示できる。
+# 入れ子はスレッド (asyncio ではタスク) ごとの時間の包含関係で表示されるため、親子の管理は行わない。
+# telemetry_context() で設定した task / source / stage / retry は各スパンの args に付与する。
+# ====================================================================
+
+TRACE_ENABLED = False
+TRACE_OUTPUT_PATH: Optional[str] = None
+TRACE_SUMMARY_CATEGORY = "llm"     # 空き時間の集計対象にするカテゴリ (LLMリクエスト)
+TRACE_SUMMARY_GAPS = 5             # 集計で表示する空き時間の件数
+TRACE_ARG_MAX_LENGTH = 120         # args に記録する文字列の最大長
+
+_LOCK = threading.Lock()
+_EVENTS: List[Dict[str, Any]] = []
+# (種類, 識別子) -> トラック番号 (Chrome Trace の tid)
+_TRACKS: Dict[Tuple[str, int], int] = {}
+_TRACK_NAMES: Dict[int, str] = {}
+_ORIGIN_NS = time.perf_counter_ns()
+_PID = os.getpid()
+
+
+def start_trace(output_path: Optional[str] = None):
+    """記録済みのイベントを破棄して記録を開始する。output_path は save_trace() の既定の出力先。"""
+    global TRACE_ENABLED, TRACE_OUTPUT_PATH, _ORIGIN_NS
+    with _LOCK:
+        _EVENTS.clear()
+        _TRACKS.clear()
+        _TRACK_NAMES.clear()
+        _ORIGIN_NS = time.perf_counter_ns()
+    TRACE_OUTPUT_PATH = output_path or None
+    TRACE_ENABLED = True
+
+def stop_trace():
+    """記録を停止する (記録済みのイベントは save_trace() で書き出せる)"""
+    global TRACE_ENABLED
+    TRACE_ENABLED = False
+
+def is_enabled() -> bool:
+    return TRACE_ENABLED
+
+
+def _current_track() -> int:
+    """
+    現在のスレッド、または実行中の asyncio タスクに対応するトラック番号を返す。
+    同じイベントループ上で並行する asyncio タスクを別トラックにし、区間が重なって表示されないようにする。
+    """
+    thread = threading.current_thread()
+    key, label = ("thread", thread.ident or 0), thread.name
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        key, label = ("task", id(task)), f"{thread.name} / {task.get_name()}"
+    with _LOCK:
+        track = _TRACKS.get(key)
+        if track is None:
+            track = len(_TRACKS) + 1
+            _TRACKS[key] = track
+            _TRACK_NAMES[track] = label
+    return track
+
+def _arg_value(value: Any) -> Any:
+    """JSON にそのまま書ける値はそのまま、それ以外は短い文字列にする"""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    text = value if isinstance(value, str) else repr(value)
+    return text if len(text) <= TRACE_ARG_MAX_LENGTH else text[:TRACE_ARG_MAX_LENGTH] + "…"
+
+def _elapsed_us(ns: int) -> float:
+    return (ns - _ORIGIN_NS) / 1000
+
+@contextlib.contextmanager
+def span(name: str, category: str = "function", **args: Any) -> Iterator[Optional[Dict[str, Any]]]:
+    """
+    with 文の区間を1つのスパンとして記録する。記録していない場合は何もしない。
+    yield される辞書に値を追加すると、終了時にスパンの args として記録されます。
+    例外で抜けた場合は args の error に例外を記録します (例外はそのまま送出)。
+    """
+    if not TRACE_ENABLED:
+        yield None
+        return
+    track = _current_track()
+    fields = {**LLM_Telemetry.current_context(), **args}
+    start = time.perf_counter_ns()
+    try:
+        yield fields
+    except BaseException as e:
+        fields["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        end = time.perf_counter_ns()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": _elapsed_us(start),
+            "dur": (end - start) / 1000,
+            "pid": _PID,
+            "tid": track,
+            "args": {key: _arg_value(value) for key, value in fields.items()},
+        }
+        with _LOCK:
+            _EVENTS.append(event)
+
+def traced(name: Optional[str] = None, category: str = "function", arg_names: Sequence[str] = ()) -> Callable:
+    """
+    関数の呼び出しをスパンとして記録するデコレーター (async 関数にも対応)。
+    arg_names に指定した引数の値をスパンの args に記録します。
+    """
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+        signature = inspect.signature(func) if arg_names else None
+
+        def span_args(args: tuple, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+            if signature is None:
+                return {}
+            try:
+                bound = signature.bind_partial(*args, **kwargs).arguments
+            except TypeError:
+                return {}
+            return {arg: bound[arg] for arg in arg_names if arg in bound}
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not TRACE_ENABLED:
+                    return await func(*args, **kwargs)
+                with span(span_name, category, **span_args(args, kwargs)):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACE_ENABLED:
+                return func(*args, **kwargs)
+            with span(span_name, category, **span_args(args, kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- 書き出し ---
+def get_events() -> List[Dict[str, Any]]:
+    with _LOCK:
+        return list(_EVENTS)
+
+def build_trace(events: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """Chrome Trace Event 形式の辞書を作る (トラック名のメタデータイベントを含む)"""
+    events = get_events() if events is None else events
+    with _LOCK:
+        track_names = dict(_TRACK_NAMES)
+    metadata = [{"name": "process_name", "ph": "M", "pid": _PID, "args": {"name": "LLM_Documentation"}}]
+    metadata += [
+        {"name": "thread_name", "ph": "M", "pid": _PID, "tid": track, "args": {"name": label}}
+        for track, label in sorted(track_names.items())
+    ]
+    metadata += [
+        {"name": "thread_sort_index", "ph": "M", "pid": _PID, "tid": track, "args": {"sort_index": track}}
+        for track in sorted(track_names)
+    ]
+    return {"traceEvents": metadata + sorted(events, key=lambda e: e["ts"]), "displayTimeUnit": "ms"}
+
+def summarize_trace(events: Optional[List[Dict[str, Any]]] = None, category: str = TRACE_SUMMARY_CATEGORY) -> Dict[str, Any]:
+    """
+    記録全体の時間と、category のスパン (既定は LLM リクエスト) がどのスレッドでも実行されていなかった
+    空き時間を集計する。(純粋) 空き時間が長い区間がパイプラインの待ち (ファイル読み込み・検索・保存など) です。
+    """
+    events = get_events() if events is None else events
+    if not events:
+        return {"wall_ms": 0.0, "busy_ms": 0.0, "idle_ms": 0.0, "gaps": []}
+    start = min(e["ts"] for e in events)
+    end = max(e["ts"] + e["dur"] for e in events)
+
+    # 対象スパンの区間を結合する
+    busy: List[List[float]] = []
+    for e in sorted((e for e in events if e["cat"] == category), key=lambda e: e["ts"]):
+        if busy and e["ts"] <= busy[-1][1]:
+            busy[-1][1] = max(busy[-1][1], e["ts"] + e["dur"])
+        else:
+            busy.append([e["ts"], e["ts"] + e["dur"]])
+
+    gaps, cursor = [], start
+    for busy_start, busy_end in busy:
+        if busy_start > cursor:
+            gaps.append((cursor, busy_start))
+        cursor = max(cursor, busy_end)
+    if end > cursor:
+        gaps.append((cursor, end))
+
+    busy_us = sum(b - a for a, b in busy)
+    gaps.sort(key=lambda gap: gap[1] - gap[0], reverse=True)
+    return {
+        "wall_ms": (end - start) / 1000,
+        "busy_ms": busy_us / 1000,
+        "idle_ms": (end - start - busy_us) / 1000,
+        "gaps": [{"start_ms": (a - start) / 1000, "duration_ms": (b - a) / 1000} for a, b in gaps],
+    }
+
+def format_trace_summary(summary: Dict[str, Any], max_gaps: int = TRACE_SUMMARY_GAPS) -> str:
+    wall = summary["wall_ms"]
+    lines = [
+        f"全体 {wall / 1000:.2f}s / LLM実行中 {summary['busy_ms'] / 1000:.2f}s"
+        f" / LLM非実行 {summary['idle_ms'] / 1000:.2f}s ({summary['idle_ms'] / wall:.0%})" if wall else "記録なし"
+    ]
+    for gap in summary["gaps"][:max_gaps]:
+        lines.append(f"  空き {gap['duration_ms'] / 1000:.2f}s (開始 +{gap['start_ms'] / 1000:.2f}s)")
+    return "\n".join(lines)
+
+def save_trace(output_path: Optional[str] = None) -> Optional[str]:
+    """記録したスパンを Chrome Trace JSON として書き出し、出力先を返す。出力先が無い場合は None。"""
+    output_path = output_path or TRACE_OUTPUT_PATH
+    if not output_path:
+        return None
+    events = get_events()
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        temp_path = f"{output_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(build_trace(events), f, ensure_ascii=False, default=str)
+        os.replace(temp_path, output_path)
+    except Exception as e:
+        print(f"トレースの書き出しに失敗しました: {e}", file=sys.stderr)
+        return None
+    print(f"トレースを書き出しました ({len(events)} スパン): {output_path}", file=sys.stderr)
+    print(format_trace_summary(summarize_trace(events)), file=sys.stderr)
+    return output_path
@@ -0,0 +1,371 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+from typing import Dict, Any, List, Callable, Tuple
+
+# --- パス設定 ---
+source_directory = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(source_directory, "..", ".."))
+sys.path.insert(0, project_root)
+
+# ====================================================================
+# LLM_Control のテキスト処理 (トークン計算・チャンク分割など) のベンチマーク
+#
+# - Ollama サーバーには接続しません (オフラインで実行可能)。
+# - 各ケースは子プロセスで実行し、ケースごとのピークRSSを計測します。
+# - 結果はベースライン(JSON)と比較し、スループットの差分を表示します。
+#
+# 使用例:
+#   python Benchmark_LLM_Control.py --sizes 10KB,1MB --save-baseline
+#   python Benchmark_LLM_Control.py --sizes 10KB,1MB            (ベースラインとの比較)
+#   python Benchmark_LLM_Control.py --byte-tokenizer             (tiktokenの語彙ファイルが無い環境)
+# ====================================================================
+
+DEFAULT_SIZES = "10KB,100KB,1MB,10MB,50MB"
+DEFAULT_BASELINE_PATH = "./Benchmark/llm_control_baseline.json"
+DEFAULT_MODEL = "qwen2.5:7b"
+CORPUS_KINDS = ["japanese", "english", "csv"]
+SECTION_PATTERN = r"< [^>]+ >"
+
+_JAPANESE_WORDS = [
+    "濃度", "送信", "受信", "設定", "測定値", "装置", "制御", "通信", "異常", "正常", "確認", "処理",
+    "データ", "ログ", "センサー", "温度", "圧力", "流量", "開始", "終了", "エラー", "警告", "記録", "結果",
+    "は", "が", "を", "に", "で", "と", "の", "から", "まで", "について", "として", "により",
+]
+_ENGLISH_WORDS = [
+    "the", "sensor", "value", "request", "response", "server", "model", "document", "summary", "token",
+    "context", "window", "buffer", "stream", "error", "warning", "config", "update", "received", "sent",
+    "of", "and", "to", "in", "for", "with", "on", "by", "from", "at",
+]
+_CSV_CATEGORIES = ["A", "B", "C", "D", "E", "ERROR", "WARN", "INFO"]
+
+
+# ====================================================================
+# I. コーパス生成 (再現性のため乱数シード固定)
+# ====================================================================
+
+def parse_size(size_text: str) -> int:
+    """'10KB', '1MB' などをバイト数に変換します。(純粋)"""
+    units = {"KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "B": 1}
+    text = size_text.strip().upper()
+    for unit, factor in units.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+def _japanese_sentence(rng: random.Random) -> str:
+    return "".join(rng.choice(_JAPANESE_WORDS) for _ in range(rng.randint(8, 24))) + "。"
+
+def _english_sentence(rng: random.Random) -> str:
+    words = [rng.choice(_ENGLISH_WORDS) for _ in range(rng.randint(6, 20))]
+    return " ".join(words).capitalize() + "."
+
+def _csv_row(rng: random.Random, row_no: int) -> str:
+    return ",".join([
+        str(row_no),
+        f"2024/{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}",
+        rng.choice(_CSV_CATEGORIES),
+        f"{rng.uniform(0, 1000):.3f}",
+        str(rng.randint(-50, 150)),
+        rng.choice(_JAPANESE_WORDS) + rng.choice(_JAPANESE_WORDS),
+    ])
+
+def generate_corpus(kind: str, size_bytes: int, seed: int = 0) -> str:
+    """
+    指定サイズ(UTF-8バイト数)以上のテキストを生成します。
+    文のプールから乱択して連結するため、50MBでも数秒で生成できます。
+    split_text_by_pattern 用に、一定間隔で '< セクション N >' の区切り行を含めます。
+    """
+    rng = random.Random(f"{kind}:{seed}")
+    if kind == "csv":
+        pool = [_csv_row(rng, i) for i in range(4096)]
+        header = "id,timestamp,category,value,temperature,label"
+    elif kind == "english":
+        pool = [_english_sentence(rng) for _ in range(4096)]
+        header = ""
+    else:
+        pool = [_japanese_sentence(rng) for _ in range(4096)]
+        header = ""
+
+    lines = [header] if header else []
+    total_bytes = len(header.encode("utf-8"))
+    section_no = 0
+    while total_bytes < size_bytes:
+        if len(lines) % 50 == 0:
+            section_no += 1
+            line = f"< セクション {section_no} >"
+        else:
+            line = rng.choice(pool)
+        lines.append(line)
+        total_bytes += len(line.encode("utf-8")) + 1
+    return "\n".join(lines)
+
+
+# ====================================================================
+# II. ベンチマーク対象
+# ====================================================================
+
+def _build_cases(LLM_Control: Any, model_name: str) -> Dict[str, Callable[[str], Any]]:
+    """ケース名 -> (コーパスを受け取って対象処理を1回実行する関数)"""
+    template_list = [
+        "・以下の[参照データ]について回答を生成してください。",
+        "{question}",
+        "[参照データ]\n{chunk}",
+        "{feedback}",
+    ]
+
+    def count_tokens_cold(text: str) -> Any:
+        LLM_Control.clear_token_count_cache()
+        return LLM_Control.count_tokens(text, model_name)
+
+    def count_tokens_warm(text: str) -> Any:
+        return LLM_Control.count_tokens(text, model_name)
+
+    def iter_text_chunks(text: str) -> Any:
+        return sum(1 for _ in LLM_Control.iter_text_chunks(text, 4096, model_name, 100))
+
+    return {
+        "count_tokens(cold)": count_tokens_cold,
+        "count_tokens(warm)": count_tokens_warm,
+        "get_chunk_by_token_limit": lambda text: LLM_Control.get_chunk_by_token_limit(text, 4096, model_name),
+        "get_last_n_tokens_text": lambda text: LLM_Control.get_last_n_tokens_text(text, 2000, model_name),
+        "_get_safe_inheritance_data": lambda text: LLM_Control._get_safe_inheritance_data(text, model_name, 2000),
+        "iter_text_chunks": iter_text_chunks,
+        "build_prompt": lambda text: LLM_Control.build_prompt(template_list, question="要約してください。", chunk=text),
+        "split_text_by_pattern": lambda text: LLM_Control.split_text_by_pattern(text, SECTION_PATTERN),
+    }
+
+def _install_byte_tokenizer(LLM_Control: Any):
+    """
+    tiktoken の語彙ファイルを取得できない環境向けに、1バイト=1トークンのエンコーダーを登録します。
+    絶対値は実際のトークナイザーと異なるため、ベースラインは同じ設定同士で比較してください。
+    """
+    import tiktoken
+    for encoding_name in ("o200k_base", "cl100k_base"):
+        LLM_Control.register_tokenizer(encoding_name, tiktoken.Encoding(
+            name=encoding_name,
+            pat_str=r"[\s\S]",
+            mergeable_ranks={bytes([i]): i for i in range(256)},
+            special_tokens={}
+        ))
+
+def _current_rss_bytes() -> Tuple[int, int]:
+    """(現在のRSS, ピークRSS) をバイト数で返す。取得できない場合は 0。"""
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        peak = getattr(info, "peak_wset", 0) or 0
+        if not peak:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return info.rss, peak
+    except ImportError:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            peak *= 1024
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        return rss, peak
+    except Exception:
+        return 0, 0
+
+def run_case(case_name: str, kind: str, size_bytes: int, repeats: int, model_name: str, byte_tokenizer: bool) -> Dict[str, Any]:
+    """1ケースを実行して計測結果を返します。(子プロセスから呼び出される)"""
+    from Sources.Common import LLM_Control
+    if byte_tokenizer:
+        _install_byte_tokenizer(LLM_Control)
+
+    text = generate_corpus(kind, size_bytes)
+    actual_bytes = len(text.encode("utf-8"))
+    case = _build_cases(LLM_Control, model_name)[case_name]
+
+    # 初回はトークナイザーのロードを含むため計測対象外 (warmケースのキャッシュ投入も兼ねる)
+    LLM_Control.get_tokenizer(model_name)
+    if case_name == "count_tokens(warm)":
+        case(text)
+
+    rss_before, _ = _current_rss_bytes()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        case(text)
+        timings.append(time.perf_counter() - start)
+    _, peak_rss = _current_rss_bytes()
+
+    best = min(timings)
+    return {
+        "case": case_name,
+        "corpus": kind,
+        "size_bytes": actual_bytes,
+        "best_sec": best,
+        "mean_sec": sum(timings) / len(timings),
+        "throughput_mb_s": (actual_bytes / (1024 ** 2)) / best if best > 0 else float("inf"),
+        "peak_rss_mb": peak_rss / (1024 ** 2),
+        "rss_delta_mb": max(0, peak_rss - rss_before) / (1024 ** 2),
+    }
+
+
+# ====================================================================
+# III. 集計・ベースライン比較
+# ====================================================================
+
+def _result_key(result: Dict[str, Any]) -> str:
+    return f"{result['case']}|{result['corpus']}|{result['size_label']}"
+
+def scaling_exponent(results: List[Dict[str, Any]]) -> float:
+    """
+    サイズと処理時間の両対数の傾き (1.0 で線形、2.0 で二乗) を最小二乗で求めます。(純粋)
+    """
+    points = [(math.log(r["size_bytes"]), math.log(r["best_sec"])) for r in results if r["best_sec"] > 0]
+    if len(points) < 2:
+        return float("nan")
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        return float("nan")
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+
+def format_report(results: List[Dict[str, Any]], baseline: Dict[str, Any], threshold: float) -> Tuple[str, int]:
+    """結果表・スケーリング・ベースライン差分を文字列化し、(レポート, 劣化件数) を返します。"""
+    baseline_results = {_result_key(r): r for r in baseline.get("results", [])}
+    lines = [f"{'case':<28}{'corpus':<10}{'size':>8}{'best[s]':>11}{'MB/s':>10}{'peakRSS':>10}{'ΔRSS':>9}{'vs base':>10}"]
+    regressions = 0
+
+    for r in results:
+        diff_text = ""
+        base = baseline_results.get(_result_key(r))
+        if base and base.get("throughput_mb_s"):
+            change = r["throughput_mb_s"] / base["throughput_mb_s"] - 1.0
+            diff_text = f"{change:+.0%}"
+            if change < -threshold:
+                diff_text += " ⚠️"
+                regressions += 1
+        lines.append(
+            f"{r['case']:<28}{r['corpus']:<10}{r['size_label']:>8}{r['best_sec']:>11.4f}"
+            f"{r['throughput_mb_s']:>10.2f}{r['peak_rss_mb']:>10.1f}{r['rss_delta_mb']:>9.1f}{diff_text:>10}"
+        )
+
+    lines.append("")
+    lines.append("--- スケーリング (両対数の傾き: 1.0=線形) ---")
+    groups: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for r in results:
+        groups.setdefault((r["case"], r["corpus"]), []).append(r)
+    for (case_name, kind), group in groups.items():
+        exponent = scaling_exponent(group)
+        curve = " ".join(f"{g['size_label']}:{g['best_sec']:.3g}s" for g in sorted(group, key=lambda g: g["size_bytes"]))
+        lines.append(f"{case_name:<28}{kind:<10} k={exponent:5.2f}  {curve}")
+
+    if regressions:
+        lines.append("")
+        lines.append(f"⚠️ ベースライン比でスループットが {threshold:.0%} 以上低下したケース: {regressions} 件")
+    return "\n".join(lines), regressions
+
+def load_baseline(baseline_path: str) -> Dict[str, Any]:
+    if not os.path.exists(baseline_path):
+        return {}
+    try:
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"警告: ベースラインの読み込みに失敗しました: {e}", file=sys.stderr)
+        return {}
+
+def save_baseline(baseline_path: str, results: List[Dict[str, Any]], settings: Dict[str, Any]):
+    os.makedirs(os.path.dirname(baseline_path) or ".", exist_ok=True)
+    data = {
+        "created": datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "settings": settings,
+        "results": results,
+    }
+    with open(baseline_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    print(f"ベースラインを保存しました: {baseline_path}", file=sys.stderr)
+
+
+# ====================================================================
+# IV. 実行
+# ====================================================================
+
+def _run_case_in_subprocess(case_name: str, kind: str, size_bytes: int, repeats: int, model_name: str, byte_tokenizer: bool) -> Dict[str, Any]:
+    """ケースごとのピークRSSを分離するため、子プロセスで1ケースを実行する"""
+    request = json.dumps({
+        "case": case_name, "corpus": kind, "size_bytes": size_bytes,
+        "repeats": repeats, "model": model_name, "byte_tokenizer": byte_tokenizer,
+    })
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", request],
+        capture_output=True, text=True, encoding="utf-8"
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"{case_name}/{kind}/{size_bytes}: {completed.stderr.strip()[-500:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM_Control テキスト処理ベンチマーク (Ollama不要)")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"コーパスサイズ (既定: {DEFAULT_SIZES})")
+    parser.add_argument("--corpora", default=",".join(CORPUS_KINDS), help="japanese,english,csv")
+    parser.add_argument("--cases", default="", help="実行するケース名 (カンマ区切り、既定: 全ケース)")
+    parser.add_argument("--repeats", type=int, default=3, help="各ケースの繰り返し回数 (10MB以上は1回)")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="トークナイザー選択に使うモデル名")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="ベースラインJSONのパス")
+    parser.add_argument("--save-baseline", action="store_true", help="今回の結果をベースラインとして保存")
+    parser.add_argument("--threshold", type=float, default=0.2, help="劣化とみなすスループット低下率")
+    parser.add_argument("--byte-tokenizer", action="store_true", help="1バイト=1トークンの代替エンコーダーを使う")
+    parser.add_argument("--worker", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        request = json.loads(args.worker)
+        result = run_case(request["case"], request["corpus"], request["size_bytes"],
+                          request["repeats"], request["model"], request["byte_tokenizer"])
+        print(json.dumps(result))
+        return
+
+    size_labels = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    corpora = [c.strip() for c in args.corpora.split(",") if c.strip()]
+    case_names = [c.strip() for c in args.cases.split(",") if c.strip()] or [
+        "count_tokens(cold)", "count_tokens(warm)", "get_chunk_by_token_limit", "get_last_n_tokens_text",
+        "_get_safe_inheritance_data", "iter_text_chunks", "build_prompt", "split_text_by_pattern",
+    ]
+
+    results = []
+    for case_name in case_names:
+        for kind in corpora:
+            for size_label in size_labels:
+                size_bytes = parse_size(size_label)
+                repeats = 1 if size_bytes >= 10 * 1024 ** 2 else args.repeats
+                print(f"実行中: {case_name} / {kind} / {size_label}", file=sys.stderr)
+                try:
+                    result = _run_case_in_subprocess(case_name, kind, size_bytes, repeats, args.model, args.byte_tokenizer)
+                except Exception as e:
+                    print(f"エラー: {e}", file=sys.stderr)
+                    continue
+                result["size_label"] = size_label
+                results.append(result)
+
+    baseline = {} if args.save_baseline else load_baseline(args.baseline)
+    report, regressions = format_report(results, baseline, args.threshold)
+    print(report)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results, {
+            "model": args.model, "byte_tokenizer": args.byte_tokenizer, "repeats": args.repeats,
+        })
+    elif regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import sqlite3
+
+import pytest
+
+# --- パス設定 ---
+source_directory = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(source_directory, "..", ".."))
+sys.path.insert(0, project_root)
+
+from Sources.Common import CacheControl
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "cache" / "cache.sqlite3")
+
+def _stored_keys(path, namespace="default"):
+    with sqlite3.connect(path) as connection:
+        return sorted(key for (key,) in connection.execute(
+            "SELECT key FROM cache_entries WHERE namespace = ?", (namespace,)
+        ))
+
+
+def test_make_cache_key_ignores_dict_order():
+    assert CacheControl.make_cache_key({"a": 1, "b": [1, 2]}, "x") == CacheControl.make_cache_key({"b": [1, 2], "a": 1}, "x")
+    assert CacheControl.make_cache_key({"a": 1}) != CacheControl.make_cache_key({"a": 2})
+
+def test_values_round_trip_and_persist(cache_path):
+    cache = CacheControl.SQLiteCache(cache_path)
+    cache.set("k", {"text": "値", "items": [1, 2.5, None]})
+    assert cache.get("k") == {"text": "値", "items": [1, 2.5, None]}
+    assert cache.get("missing", "default") == "default"
+    assert "k" in cache and "missing" not in cache
+    cache.close()
+
+    reopened = CacheControl.SQLiteCache(cache_path)
+    assert reopened.get("k") == {"text": "値", "items": [1, 2.5, None]}
+    assert len(reopened) == 1
+    reopened.close()
+
+def test_namespaces_are_separate(cache_path):
+    first = CacheControl.SQLiteCache(cache_path, namespace="first")
+    second = CacheControl.SQLiteCache(cache_path, namespace="second")
+    first.set("k", 1)
+    second.set("k", 2)
+    second.clear()
+    assert first.get("k") == 1
+    assert second.get("k") is None
+    first.close()
+    second.close()
+
+def test_expired_entries_are_not_returned(cache_path):
+    cache = CacheControl.SQLiteCache(cache_path, ttl_sec=3600, memory_items=8)
+    cache.set("old", 1, ttl_sec=-1)
+    cache.set("new", 2)
+    assert cache.get("old") is None
+    assert cache.get("new") == 2
+    cache.close()
+
+def test_max_entries_evicts_least_recently_used(cache_path):
+    cache = CacheControl.SQLiteCache(cache_path, max_entries=3, memory_items=8)
+    for key in ("a", "b", "c"):
+        cache.set(key, key)
+        time.sleep(0.01)
+    # メモリ上のエントリへのアクセスも追い出し順に反映される
+    assert cache.get("a") == "a"
+    time.sleep(0.01)
+    cache.set("d", "d")
+    assert _stored_keys(cache_path) == ["a", "c", "d"]
+    cache.close()
+
+def test_max_bytes_evicts_until_under_the_limit(cache_path):
+    cache = CacheControl.SQLiteCache(cache_path, max_bytes=250)
+    for key in ("a", "b", "c"):
+        cache.set(key, "x" * 100)
+        time.sleep(0.01)
+    assert _stored_keys(cache_path) == ["b", "c"]
+    cache.close()
+
+def test_memory_hits_do_not_write_until_flushed(cache_path):
+    cache = CacheControl.SQLiteCache(cache_path, memory_items=8)
+    cache.set("k", 1)
+    changes = cache._connection.total_changes
+    for _ in range(100):
+        assert cache.get("k") == 1
+    assert cache._connection.total_changes == changes
+    cache.flush()
+    assert cache._connection.total_changes == changes + 1
+    cache.close()
+
+def test_get_returns_copies(cache_path):
+    cache = CacheControl.SQLiteCache(cache_path, memory_items=8)
+    value = {"items": [1]}
+    cache.set("k", value)
+    value["items"].append(2)
+    first = cache.get("k")
+    first["items"].append(3)
+    assert cache.get("k") == {"items": [1]}
+    cache.close()
+
+def test_set_many_and_delete(cache_path):
+    cache = CacheControl.SQLiteCache(cache_path, memory_items=8)
+    cache.set_many({"a": 1, "b": 2, "c": 3})
+    cache.delete("b")
+    assert [cache.get(key) for key in ("a", "b", "c")] == [1, None, 3]
+    cache.close()
+
+def test_broken_values_are_discarded(cache_path):
+    cache = CacheControl.SQLiteCache(cache_path)
+    cache.set("k", 1)
+    cache._connection.execute("UPDATE cache_entries SET value = '{broken' WHERE key = 'k'")
+    cache._connection.commit()
+    assert cache.get("k", "default") == "default"
+    assert _stored_keys(cache_path) == []
+    cache.close()
+
+def test_close_is_idempotent(cache_path):
+    cache = CacheControl.SQLiteCache(cache_path, memory_items=8)
+    cache.set("k", 1)
+    cache.get("k")
+    cache.close()
+    cache.close()
+    cache.flush()
@@ -0,0 +1,99 @@
+import os
+import sys
+
+import pytest
+
+# --- パス設定 ---
+source_directory = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(source_directory, "..", ".."))
+sys.path.insert(0, project_root)
+
+# CsvControl は LLM_Control (KeyManager などの同梱モジュールに依存) を使うため、無い環境ではスキップする
+try:
+    from Sources.Common import CsvControl
+    from Sources.Common import CacheControl
+    from Sources.Common import LLM_Control
+except ImportError as e:
+    pytest.skip(f"CsvControl を読み込めません: {e}", allow_module_level=True)
+
+
+@pytest.fixture(autouse=True)
+def encoding_cache(tmp_path, monkeypatch):
+    """エンコーディング判定のキャッシュをテストごとの一時ファイルにする"""
+    cache = CacheControl.SQLiteCache(str(tmp_path / "encoding_cache.sqlite3"), namespace="file_encoding")
+    monkeypatch.setattr(LLM_Control, "_ENCODING_CACHE", cache)
+    yield cache
+    cache.close()
+
+@pytest.fixture
+def sales_csv(tmp_path):
+    """地域 (3区分) ・整数・小数・欠損ありの列を持つCSV"""
+    regions = ["東京", "大阪", "福岡"]
+    lines = ["region,units,price,note"]
+    for i in range(300):
+        note = "" if i % 4 == 0 else f"memo{i % 7}"
+        lines.append(f"{regions[i % 3]},{i},{i * 1.5 + 0.25},{note}")
+    path = tmp_path / "sales.csv"
+    path.write_bytes(("\n".join(lines) + "\n").encode("cp932"))
+    return str(path)
+
+def _columns(profile):
+    return {column["name"]: column for column in profile["columns"]}
+
+
+def test_profile_column_statistics(sales_csv):
+    profile = CsvControl.profile_csv(sales_csv, chunk_rows=64)
+    columns = _columns(profile)
+    assert profile["rows"] == 300
+    assert profile["encoding"] == "cp932"
+
+    assert columns["units"]["type"] == "integer"
+    assert (columns["units"]["min"], columns["units"]["max"]) == (0, 299)
+    assert columns["units"]["mean"] == pytest.approx(149.5)
+    assert columns["units"]["quantiles"][0.5] == pytest.approx(149.5, abs=1)
+
+    assert columns["price"]["type"] == "float"
+    assert columns["region"]["type"] == "text"
+    assert columns["region"]["distinct"] == 3
+    assert columns["note"]["null_rate"] == pytest.approx(0.25)
+
+def test_profile_is_independent_of_chunk_size(sales_csv):
+    small = CsvControl.profile_csv(sales_csv, chunk_rows=7)
+    large = CsvControl.profile_csv(sales_csv, chunk_rows=10000)
+    for column in ("units", "price", "region", "note"):
+        for key in ("type", "null_rate", "distinct", "top_values"):
+            assert _columns(small)[column][key] == _columns(large)[column][key]
+
+def test_stratified_sample_covers_every_stratum(sales_csv):
+    profile = CsvControl.profile_csv(sales_csv, sample_rows=9, chunk_rows=50)
+    assert profile["stratify_column"] == "region"
+    assert profile["strata"] == 3
+    assert len(profile["sample"]) == 9
+    assert profile["sample"]["region"].value_counts().to_dict() == {"東京": 3, "大阪": 3, "福岡": 3}
+
+def test_unknown_stratify_column_falls_back_to_random_sampling(sales_csv):
+    profile = CsvControl.profile_csv(sales_csv, stratify_column="missing", sample_rows=5)
+    assert profile["stratify_column"] is None
+    assert len(profile["sample"]) == 5
+
+def test_profile_text(sales_csv):
+    text = CsvControl.read_csv_profile_text(sales_csv, sample_rows=6)
+    assert text.startswith("[CSVプロファイル] sales.csv")
+    assert "行数: 300 / 列数: 4" in text
+    assert "- units (integer)" in text
+    assert "## サンプル行 (6 行, region の 3 区分から層化抽出)" in text
+
+def test_profile_reads_a_tail_in_another_encoding_than_the_head(tmp_path):
+    # 判定用サンプルより長い ASCII の行の後に、Shift-JIS の行が続くCSV
+    head_rows = LLM_Control.ENCODING_DETECT_SAMPLE_SIZE // 10 + 100
+    lines = ["region,units"] + [f"west,{i}" for i in range(head_rows)] + [f"東京,{i}" for i in range(50)]
+    path = tmp_path / "ascii_head.csv"
+    path.write_bytes(("\n".join(lines) + "\n").encode("cp932"))
+    profile = CsvControl.profile_csv(str(path), stratify_column="region", sample_rows=4)
+    assert profile["encoding"] == "cp932"
+    assert profile["rows"] == head_rows + 50
+    assert _columns(profile)["region"]["distinct"] == 2
+    assert "東京" in set(profile["sample"]["region"])
+
+def test_profile_text_of_unreadable_file(tmp_path):
+    assert CsvControl.read_csv_profile_text(str(tmp_path / "missing.csv")) == ""
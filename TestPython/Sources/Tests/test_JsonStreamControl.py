@@ -0,0 +1,143 @@
+import io
+import os
+import sys
+import json
+import random
+
+import pytest
+
+# --- パス設定 ---
+source_directory = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(source_directory, "..", ".."))
+sys.path.insert(0, project_root)
+
+from Sources.Common import JsonStreamControl
+
+
+# ====================================================================
+# ストリーミング JSON 検証
+# ====================================================================
+DOCUMENT_SCHEMA = {
+    "type": "object",
+    "required": ["name"],
+    "properties": {
+        "name": {"type": "string", "minLength": 2},
+        "count": {"type": "integer", "maximum": 5},
+        "tags": {"type": "array", "items": {"type": "string"}},
+    },
+    "additionalProperties": False,
+}
+
+@pytest.mark.parametrize("text", [
+    '{"name": "ab"}',
+    '{"name": "ab", "count": 3, "tags": ["x", "y"]}',
+    '```json\n{"name": "ab"}\n```',
+    '  {"name": "a\\"b\\u3042"}  ',
+])
+def test_valid_documents_pass(text):
+    assert JsonStreamControl.validate_json_text(text, DOCUMENT_SCHEMA) is None
+
+@pytest.mark.parametrize("text, message", [
+    ('{"count": 1}', "必須キー"),
+    ('{"name": "a"}', "minLength"),
+    ('{"name": "ab", "count": 9}', "大きすぎます"),
+    ('{"name": "ab", "count": 1.5}', "整数"),
+    ('{"name": "ab", "extra": 1}', "スキーマに無いキー"),
+    ('{"name": "ab", "tags": [1]}', "型が一致しません"),
+    ('{"name": "ab"', "途中で終了"),
+    ('{"name": "ab"} trailing', "余分なテキスト"),
+])
+def test_invalid_documents_report_the_reason(text, message):
+    error = JsonStreamControl.validate_json_text(text, DOCUMENT_SCHEMA)
+    assert error is not None and message in error
+
+@pytest.mark.parametrize("text", ["[1,]", '{"a" 1}', "{'a': 1}", "nul"])
+def test_grammar_errors_without_schema(text):
+    assert JsonStreamControl.validate_json_text(text) is not None
+
+def test_feed_fails_as_soon_as_the_output_is_unrecoverable():
+    validator = JsonStreamControl.StreamingJsonValidator(DOCUMENT_SCHEMA)
+    assert validator.feed('{"name": "ab", ')
+    assert not validator.feed('"count": "')
+    assert "型が一致しません" in validator.error
+    # 一度失敗した後は読み進めない
+    assert not validator.feed('3"}')
+
+def test_feed_in_single_characters_matches_whole_text():
+    text = '{"name": "ab", "count": 2, "tags": ["x"]}'
+    validator = JsonStreamControl.StreamingJsonValidator(DOCUMENT_SCHEMA)
+    assert all(validator.feed(ch) for ch in text)
+    assert validator.finish()
+
+def test_unsupported_keywords_are_not_validated():
+    assert JsonStreamControl.validate_json_text('{"a": 1}', {"anyOf": [{"type": "string"}]}) is None
+
+def test_build_validator():
+    assert isinstance(JsonStreamControl.build_validator("json"), JsonStreamControl.StreamingJsonValidator)
+    assert isinstance(JsonStreamControl.build_validator(DOCUMENT_SCHEMA), JsonStreamControl.StreamingJsonValidator)
+    assert JsonStreamControl.build_validator(None) is None
+    assert JsonStreamControl.build_validator("text") is None
+
+
+# ====================================================================
+# JSON のイベント列 (iter_json_events)
+# ====================================================================
+def _build_from_events(events):
+    """イベント列から値を組み立て直す (テスト用)"""
+    stack, keys, root = [], [], None
+
+    def attach(value):
+        nonlocal root
+        if not stack:
+            root = value
+        elif isinstance(stack[-1], list):
+            stack[-1].append(value)
+        else:
+            stack[-1][keys.pop()] = value
+
+    for event, value in events:
+        if event in ("start_map", "start_array"):
+            stack.append({} if event == "start_map" else [])
+        elif event in ("end_map", "end_array"):
+            attach(stack.pop())
+        elif event == "key":
+            keys.append(value)
+        else:
+            attach(value)
+    return root
+
+def _random_value(rng, depth=0):
+    choice = rng.random()
+    if depth < 4 and choice < 0.3:
+        return {f"k{i}あ": _random_value(rng, depth + 1) for i in range(rng.randrange(4))}
+    if depth < 4 and choice < 0.5:
+        return [_random_value(rng, depth + 1) for _ in range(rng.randrange(4))]
+    return rng.choice([0, -12, 3.25, 1e-7, True, False, None, "", "text", "改行\n\"引用\"\\", "😀" * 3])
+
+def test_events_in_order():
+    events = list(JsonStreamControl.iter_json_events('{"a": [1, 2.5, "x", true, null], "b": {}}'))
+    assert events == [
+        ("start_map", None), ("key", "a"), ("start_array", None),
+        ("value", 1), ("value", 2.5), ("value", "x"), ("value", True), ("value", None),
+        ("end_array", None), ("key", "b"), ("start_map", None), ("end_map", None), ("end_map", None),
+    ]
+
+@pytest.mark.parametrize("read_size", [1, 2, 3, 7, 64 * 1024])
+def test_events_rebuild_the_same_value(read_size):
+    rng = random.Random(read_size)
+    for _ in range(30):
+        value = _random_value(rng)
+        raw = json.dumps(value, ensure_ascii=False, indent=rng.choice([None, 2])).encode("utf-8")
+        events = JsonStreamControl.iter_json_events(io.BytesIO(raw), read_size=read_size)
+        assert _build_from_events(events) == value
+
+def test_events_accept_bom_and_text_pieces():
+    raw = b"\xef\xbb\xbf" + json.dumps({"key": "値"}, ensure_ascii=False).encode("utf-8")
+    pieces = [raw[i:i + 1] for i in range(len(raw))]
+    assert _build_from_events(JsonStreamControl.iter_json_events(pieces)) == {"key": "値"}
+    assert _build_from_events(JsonStreamControl.iter_json_events(io.StringIO('[1, "a"]'), read_size=1)) == [1, "a"]
+
+@pytest.mark.parametrize("text", ['{"a": 1', '{"a" 1}', "[1, 2] 3", '{"a": tru}', ""])
+def test_malformed_json_raises(text):
+    with pytest.raises(json.JSONDecodeError):
+        list(JsonStreamControl.iter_json_events(text))
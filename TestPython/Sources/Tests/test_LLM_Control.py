@@ -0,0 +1,377 @@
+import io
+import os
+import sys
+import json
+import asyncio
+import itertools
+
+import pytest
+import tiktoken
+
+# --- パス設定 ---
+source_directory = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(source_directory, "..", ".."))
+sys.path.insert(0, project_root)
+
+# LLM_Control は KeyManager などの同梱モジュールに依存するため、無い環境ではスキップする
+try:
+    from Sources.Common import LLM_Control
+except ImportError as e:
+    pytest.skip(f"LLM_Control を読み込めません: {e}", allow_module_level=True)
+
+from Sources.Common import CacheControl
+
+MODEL_NAME = "test-model"
+
+# tiktoken の語彙を取得できない環境でも動くよう、1バイト=1トークンのエンコーダーを使う
+for _encoding_name in ("o200k_base", "cl100k_base"):
+    LLM_Control.register_tokenizer(_encoding_name, tiktoken.Encoding(
+        name=_encoding_name,
+        pat_str=r"[\s\S]",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={}
+    ))
+
+@pytest.fixture(autouse=True)
+def encoding_cache(tmp_path, monkeypatch):
+    """エンコーディング判定のキャッシュをテストごとの一時ファイルにする"""
+    cache = CacheControl.SQLiteCache(str(tmp_path / "encoding_cache.sqlite3"), namespace="file_encoding", memory_items=16)
+    monkeypatch.setattr(LLM_Control, "_ENCODING_CACHE", cache)
+    yield cache
+    cache.close()
+
+
+# ====================================================================
+# チャンク分割
+# ====================================================================
+SAMPLE_TEXT = "".join(f"line{i} あいうえお\n" for i in range(300))
+
+def test_text_chunks_fit_the_limit_and_cover_the_text():
+    chunks = list(LLM_Control.iter_text_chunks(SAMPLE_TEXT, 100, MODEL_NAME))
+    assert len(chunks) > 1
+    assert all(LLM_Control.count_tokens(chunk, MODEL_NAME) <= 100 for chunk in chunks)
+    assert "".join(chunks) == SAMPLE_TEXT
+
+def test_text_chunks_with_overlap_repeat_the_previous_tail():
+    chunks = list(LLM_Control.iter_text_chunks(SAMPLE_TEXT, 100, MODEL_NAME, overlap_tokens=20))
+    assert all(LLM_Control.count_tokens(chunk, MODEL_NAME) <= 100 for chunk in chunks)
+    assert chunks[0] == SAMPLE_TEXT[:len(chunks[0])]
+    assert SAMPLE_TEXT.endswith(chunks[-1])
+    for previous, current in zip(chunks, chunks[1:]):
+        overlap = next(n for n in range(len(current), 0, -1) if previous.endswith(current[:n]))
+        assert 0 < overlap <= 20
+
+def test_text_chunks_never_split_a_character():
+    chunks = list(LLM_Control.iter_text_chunks("あ" * 100, 10, MODEL_NAME))
+    assert all(set(chunk) == {"あ"} for chunk in chunks)
+    assert "".join(chunks) == "あ" * 100
+
+@pytest.mark.parametrize("limit, overlap", [(10, 8), (10, 9), (4, 3), (2, 1)])
+def test_overlap_close_to_the_limit_still_advances(tmp_path, limit, overlap):
+    # 3バイト文字では重なりを戻した位置が文字の途中になり、完全な文字が0文字になることがある
+    text = "あ" * 100
+    path = tmp_path / "multibyte.txt"
+    path.write_bytes(text.encode("utf-8"))
+    for source in (
+        LLM_Control.iter_text_chunks(text, limit, MODEL_NAME, overlap_tokens=overlap),
+        LLM_Control.iter_file_chunks(path, limit, MODEL_NAME, overlap_tokens=overlap),
+    ):
+        chunks = list(itertools.islice(source, len(text) + 1))
+        assert len(chunks) <= len(text)
+        assert chunks[0] and text.endswith(chunks[-1])
+
+def test_short_text_is_a_single_chunk():
+    assert list(LLM_Control.iter_text_chunks("short", 100, MODEL_NAME)) == ["short"]
+    assert list(LLM_Control.iter_text_chunks("", 100, MODEL_NAME)) == []
+
+@pytest.mark.parametrize("encoding", ["utf-8", "cp932"])
+def test_file_chunks_match_text_chunks(tmp_path, encoding):
+    path = tmp_path / f"source_{encoding}.txt"
+    path.write_bytes(SAMPLE_TEXT.replace("\n", "\r\n").encode(encoding))
+    file_chunks = list(LLM_Control.iter_file_chunks(path, 100, MODEL_NAME, overlap_tokens=10))
+    text_chunks = list(LLM_Control.iter_text_chunks(SAMPLE_TEXT, 100, MODEL_NAME, overlap_tokens=10))
+    assert file_chunks == text_chunks
+
+def test_token_boundaries_from_start_and_end():
+    assert LLM_Control.get_chunk_by_token_limit("abcdef", 3, MODEL_NAME)[0] == "abc"
+    assert LLM_Control.get_last_n_tokens_text("abcdef", 2, MODEL_NAME) == "ef"
+    # 3バイトの文字は途中で切らない
+    assert LLM_Control.get_chunk_by_token_limit("aあ", 2, MODEL_NAME)[0] == "a"
+    assert LLM_Control.get_last_n_tokens_text("aあ", 2, MODEL_NAME) == ""
+
+
+# ====================================================================
+# コンテキスト長
+# ====================================================================
+@pytest.mark.parametrize("model_name, discovered, expected", [
+    ("llama3.1:8b", 131072, 8192),     # メタデータの学習時の長さで枠を広げない
+    ("llama3.1:8b", 4096, 4096),       # 表より小さい場合は下げる
+    ("unknown-model", 131072, 4096),   # 表に無いモデルは既定値まで
+])
+def test_discovered_context_length_only_lowers_the_window(monkeypatch, model_name, discovered, expected):
+    monkeypatch.setattr(LLM_Control, "_DISCOVERED_CONTEXT_LIMITS", {})
+    client = type("ShowClient", (), {"show": lambda self, name: {"modelinfo": {"llama.context_length": discovered}}})()
+    assert LLM_Control.discover_context_window_size(model_name, client) == discovered
+    assert LLM_Control.get_context_window_size(model_name) == expected
+
+
+# ====================================================================
+# エンコーディング判定
+# ====================================================================
+JAPANESE_TEXT = "日本語のテキストです。エンコーディング判定のテスト。\n" * 50
+
+@pytest.mark.parametrize("raw, expected", [
+    (JAPANESE_TEXT.encode("utf-8"), "utf-8"),
+    (b"\xef\xbb\xbf" + JAPANESE_TEXT.encode("utf-8"), "utf-8-sig"),
+    (JAPANESE_TEXT.encode("utf-16"), "utf-16"),
+    (JAPANESE_TEXT.encode("cp932"), "cp932"),
+    (b"plain ascii only\n", "utf-8"),
+])
+def test_detect_encoding_from_bytes(raw, expected):
+    assert LLM_Control._detect_encoding_from_bytes(raw)[0] == expected
+
+def test_sample_cut_inside_a_character_is_still_utf8():
+    raw = JAPANESE_TEXT.encode("utf-8")[:901]  # 3バイト文字の途中で切れる位置
+    assert LLM_Control._detect_encoding_from_bytes(raw, is_complete=False)[0] == "utf-8"
+    assert LLM_Control._decodes_strictly(raw, "utf-8", is_complete=True) is None
+
+def test_detect_file_encoding(tmp_path):
+    path = tmp_path / "sjis.txt"
+    path.write_bytes(JAPANESE_TEXT.encode("cp932"))
+    assert LLM_Control.detect_file_encoding(path) == "cp932"
+    assert LLM_Control.read_text_with_auto_encoding(str(path)) == JAPANESE_TEXT
+
+def test_sample_detection_does_not_decide_full_reads(tmp_path):
+    # 先頭のサンプルは ASCII だけで、後半に Shift-JIS が現れるファイル
+    path = tmp_path / "mixed.txt"
+    path.write_bytes(b"a" * 20000 + JAPANESE_TEXT.encode("cp932"))
+    assert LLM_Control.detect_file_encoding(path, sample_size=10000) == "utf-8"
+    assert LLM_Control.read_text_with_auto_encoding(str(path)) == "a" * 20000 + JAPANESE_TEXT
+
+def test_file_chunks_redetect_when_the_tail_is_not_the_sampled_encoding(tmp_path):
+    # 判定用サンプル (ENCODING_DETECT_SAMPLE_SIZE) より長い ASCII の後に Shift-JIS が続くファイル
+    head = "ascii line\n" * (LLM_Control.ENCODING_DETECT_SAMPLE_SIZE // 11 + 100)
+    path = tmp_path / "ascii_head_sjis_tail.txt"
+    path.write_bytes((head + JAPANESE_TEXT).encode("cp932"))
+    assert LLM_Control.detect_file_encoding(path) == "utf-8"
+    assert LLM_Control.detect_full_file_encoding(path) == "cp932"
+    file_chunks = list(LLM_Control.iter_file_chunks(path, 1000, MODEL_NAME, overlap_tokens=50))
+    assert file_chunks == list(LLM_Control.iter_text_chunks(head + JAPANESE_TEXT, 1000, MODEL_NAME, overlap_tokens=50))
+
+
+# ====================================================================
+# 継承メモリ (RollingSummaryMemory)
+# ====================================================================
+@pytest.mark.parametrize("max_tokens", [-50, 0, 3])
+def test_memory_without_budget_builds_an_empty_message(max_tokens):
+    memory = LLM_Control.RollingSummaryMemory(MODEL_NAME, max_tokens)
+    memory.add("前回の回答" * 10)
+    assert memory.build_message() == ""
+    assert memory.max_tokens >= 0
+
+def test_memory_stays_within_budget():
+    memory = LLM_Control.RollingSummaryMemory(MODEL_NAME, 300)
+    for i in range(20):
+        memory.add(f"回答{i} " + "x" * 100)
+        memory.compact()
+        assert memory.token_count() <= 300
+
+def test_truncate_largest_without_entries():
+    memory = LLM_Control.RollingSummaryMemory(MODEL_NAME, 0)
+    memory._truncate_largest()
+    assert memory.render() == ""
+
+
+# ====================================================================
+# 構造化出力の検証と応答キャッシュ
+# ====================================================================
+SCHEMA = {"type": "object", "properties": {"answer": {"type": "string"}}, "required": ["answer"]}
+
+class FakeClient:
+    """chat の呼び出しを記録し、replies を順に返す (最後の応答は繰り返す)"""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = []
+
+    def chat(self, **kwargs):
+        self.calls.append(kwargs)
+        reply = self.replies[min(len(self.calls), len(self.replies)) - 1]
+        if kwargs.get("stream"):
+            return iter([{"message": {"content": piece}} for piece in reply] + [{"message": {"content": ""}, "done": True}])
+        return {"message": {"content": reply}}
+
+@pytest.fixture
+def response_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(LLM_Control, "AUTO_NUM_CTX", False)
+    monkeypatch.setattr(LLM_Control, "JSON_STREAM_MAX_RETRY", 1)
+    cache = LLM_Control.configure_response_cache(str(tmp_path / "responses.sqlite3"))
+    yield cache
+    LLM_Control.configure_response_cache(None)
+    cache.close()
+
+def _answer_kwargs(client):
+    return dict(ollama_client=client, model_name=MODEL_NAME, question="q", system_prompt="s", prompt="p", format=SCHEMA)
+
+def test_invalid_output_is_not_left_in_the_cache(response_cache):
+    # 生成が途中で打ち切られた出力 (ストリーミング中は不正と判定できず、最後まで受信される)
+    client = FakeClient('{"answer": "trunc')
+    kwargs = _answer_kwargs(client)
+    _, _, parsed = LLM_Control._execute_answer_request(kwargs)
+    assert len(client.calls) == 2
+    assert LLM_Control._request_cache_key(kwargs) not in response_cache
+    # 次回もキャッシュの不正な出力ではなく、モデルに問い合わせる
+    LLM_Control._execute_answer_request(kwargs)
+    assert len(client.calls) == 4
+
+def test_accepted_retry_is_cached_under_the_original_request(response_cache):
+    client = FakeClient('{"answer": "trunc', '{"answer": "fixed"}')
+    kwargs = _answer_kwargs(client)
+    assert LLM_Control._execute_answer_request(kwargs)[1] == {"answer": "fixed"}
+    assert response_cache.get(LLM_Control._request_cache_key(kwargs)) == '{"answer": "fixed"}'
+    # 2回目は再実行なしでキャッシュから返る
+    assert LLM_Control._execute_answer_request(kwargs)[1] == {"answer": "fixed"}
+    assert len(client.calls) == 2
+
+def test_async_accepted_retry_is_cached(response_cache):
+    class FakeAsyncClient(FakeClient):
+        async def chat(self, **kwargs):
+            response = FakeClient.chat(self, **kwargs)
+            if not kwargs.get("stream"):
+                return response
+            async def stream():
+                for chunk in response:
+                    yield chunk
+            return stream()
+
+    client = FakeAsyncClient('{"answer": "trunc', '{"answer": "fixed"}')
+    kwargs = _answer_kwargs(client)
+    assert asyncio.run(LLM_Control._execute_answer_request_async(kwargs))[1] == {"answer": "fixed"}
+    assert response_cache.get(LLM_Control._request_cache_key(kwargs)) == '{"answer": "fixed"}'
+
+def test_valid_output_is_cached(response_cache):
+    client = FakeClient('{"answer": "ok"}')
+    kwargs = _answer_kwargs(client)
+    assert LLM_Control._execute_answer_request(kwargs)[1] == {"answer": "ok"}
+    assert LLM_Control._execute_answer_request(kwargs)[1] == {"answer": "ok"}
+    assert len(client.calls) == 1
+
+
+# ====================================================================
+# RAGサーバーへの登録
+# ====================================================================
+class FakeRagResponse:
+    status_code = 200
+    text = ""
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
+
+class FakeRagSession:
+    """/register で受け取ったファイル名を索引として保持し、/query はその有無だけを返す"""
+
+    def __init__(self):
+        self.indexed = set()
+        self.failing = set()
+        self.uploads = []
+
+    def post(self, url, files=None, json=None, timeout=None):
+        if url.endswith("/register"):
+            names = [name for _, (name, _) in files]
+            self.uploads.append(names)
+            if self.failing & set(names):
+                return FakeRagResponse({"status": "error", "message": "failed"})
+            self.indexed.update(names)
+            return FakeRagResponse({"status": "ok", "files": len(names), "chunks": len(names)})
+        return FakeRagResponse({"count": min(1, len(self.indexed)), "contexts": []})
+
+@pytest.fixture
+def rag(tmp_path, monkeypatch):
+    registry = CacheControl.SQLiteCache(str(tmp_path / "rag_registry.sqlite3"), namespace="rag_registry")
+    monkeypatch.setattr(LLM_Control, "_RAG_REGISTRY", registry)
+    monkeypatch.setattr(LLM_Control, "RAG_UPLOAD_BATCH_FILES", 1)
+    client = LLM_Control.RAGClient("http://rag.test")
+    client.session = FakeRagSession()
+    paths = []
+    for name in ("a.txt", "b.txt", "c.txt"):
+        path = tmp_path / name
+        path.write_text(f"{name} の内容\n", encoding="utf-8")
+        paths.append(str(path))
+    yield client, paths
+    registry.close()
+
+def test_rag_register_reports_failed_batches_and_retries_them(rag):
+    client, paths = rag
+    client.session.failing = {"b.txt"}
+    assert client.register(paths) is False
+    client.session.failing = set()
+    client.session.uploads.clear()
+    assert client.register(paths) is True
+    assert client.session.uploads == [["b.txt"]]
+
+def test_rag_register_skips_files_the_server_still_has(rag):
+    client, paths = rag
+    assert client.register(paths) is True
+    client.session.uploads.clear()
+    assert client.register(paths) is True
+    assert client.session.uploads == []
+
+def test_rag_register_resends_everything_when_the_server_lost_its_index(rag):
+    client, paths = rag
+    assert client.register(paths) is True
+    client.session.indexed.clear()
+    client.session.uploads.clear()
+    assert client.register(paths) is True
+    assert sorted(name for names in client.session.uploads for name in names) == ["a.txt", "b.txt", "c.txt"]
+
+
+# ====================================================================
+# Document 抽出 (extract_dicts_with_required_keys)
+# ====================================================================
+NESTED_DOCUMENTS = {
+    "title": "report",
+    "sections": [
+        {"name": "a", "summary": "sa", "children": [{"name": "inner", "summary": "si"}]},
+        {"group": {"first": {"name": "b", "summary": "sb"}, "second": {"name": "c"}}},
+        [[{"name": "d", "summary": "sd", "extra": 1}]],
+    ],
+    "tail": {"name": "e", "summary": "se"},
+}
+
+def test_extract_dicts_returns_documents_in_order():
+    found = LLM_Control.extract_dicts_with_required_keys(NESTED_DOCUMENTS, ["name", "summary"])
+    assert [d["name"] for d in found] == ["a", "b", "d", "e"]
+
+def test_extract_dicts_does_not_search_inside_documents():
+    found = LLM_Control.extract_dicts_with_required_keys(NESTED_DOCUMENTS, ["name", "summary"])
+    assert all(d["name"] != "inner" for d in found)
+    assert found[0]["children"] == [{"name": "inner", "summary": "si"}]
+
+def test_extract_dicts_returns_the_original_objects():
+    found = LLM_Control.extract_dicts_with_required_keys(NESTED_DOCUMENTS, ["name", "summary"])
+    assert found[-1] is NESTED_DOCUMENTS["tail"]
+
+def test_extract_dicts_ignores_scalars_and_missing_keys():
+    assert LLM_Control.extract_dicts_with_required_keys("text", ["name"]) == []
+    assert LLM_Control.extract_dicts_with_required_keys([1, None, {"x": 1}], ["name"]) == []
+
+def test_extract_dicts_handles_deep_nesting():
+    deep = current = []
+    for _ in range(5000):
+        child = []
+        current.append(child)
+        current = child
+    current.append({"name": "deep", "summary": "s"})
+    assert LLM_Control.extract_dicts_with_required_keys(deep, ["name", "summary"]) == [{"name": "deep", "summary": "s"}]
+
+@pytest.mark.parametrize("read_size", [1, 7, 4096])
+def test_stream_extraction_matches_in_memory_extraction(read_size):
+    source = io.BytesIO(json.dumps(NESTED_DOCUMENTS, ensure_ascii=False).encode("utf-8"))
+    streamed = list(LLM_Control.iter_dicts_with_required_keys_from_stream(source, ["name", "summary"], read_size=read_size))
+    assert streamed == LLM_Control.extract_dicts_with_required_keys(NESTED_DOCUMENTS, ["name", "summary"])
@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+
+import pytest
+
+# --- パス設定 ---
+source_directory = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(source_directory, "..", ".."))
+sys.path.insert(0, project_root)
+
+from Sources.Common import LLM_Telemetry
+
+
+@pytest.fixture(autouse=True)
+def isolated_telemetry(monkeypatch):
+    """記録先と Prometheus の集計をテストごとに初期化する"""
+    monkeypatch.setattr(LLM_Telemetry, "TELEMETRY_JSONL_PATH", None)
+    monkeypatch.setattr(LLM_Telemetry, "TELEMETRY_PROMETHEUS_PATH", None)
+    monkeypatch.setattr(LLM_Telemetry, "_PROMETHEUS_TOTALS", {})
+
+FINAL_RESPONSE = {
+    "prompt_eval_count": 200,
+    "prompt_eval_duration": 400_000_000,
+    "eval_duration": 2_000_000_000,
+    "load_duration": 0,
+    "total_duration": 3_000_000_000,
+}
+
+
+def test_build_record_converts_server_durations():
+    record = LLM_Telemetry.build_record({"model": "m", "output_tokens": 50, "total_sec": 9.0}, FINAL_RESPONSE)
+    assert record["model"] == "m"
+    assert record["prompt_tokens"] == 200
+    assert record["prompt_eval_sec"] == pytest.approx(0.4)
+    assert record["eval_sec"] == pytest.approx(2.0)
+    assert record["load_sec"] is None
+    assert record["total_sec"] == pytest.approx(3.0)
+    assert record["prompt_tokens_per_sec"] == pytest.approx(500.0)
+    assert record["cached"] is False and record["aborted"] is False
+
+def test_build_record_without_server_response():
+    record = LLM_Telemetry.build_record({"model": "m", "total_sec": 0.01, "cached": True})
+    assert record["prompt_tokens"] is None
+    assert record["total_sec"] == 0.01
+    assert record["prompt_tokens_per_sec"] is None
+    assert record["cached"] is True
+
+def test_context_fields_nest_and_reset():
+    with LLM_Telemetry.telemetry_context(task="t1", stage="generate"):
+        with LLM_Telemetry.telemetry_context(stage="evaluate", retry=2):
+            assert LLM_Telemetry.current_context() == {"task": "t1", "stage": "evaluate", "retry": 2}
+            record = LLM_Telemetry.build_record({"model": "m"})
+        assert LLM_Telemetry.current_context() == {"task": "t1", "stage": "generate"}
+    assert LLM_Telemetry.current_context() == {}
+    assert (record["task"], record["stage"], record["retry"]) == ("t1", "evaluate", 2)
+
+def test_record_llm_call_is_disabled_without_outputs():
+    assert not LLM_Telemetry.is_enabled()
+    assert LLM_Telemetry.record_llm_call({"model": "m"}, FINAL_RESPONSE) is None
+
+def test_record_llm_call_writes_jsonl_and_prometheus(tmp_path):
+    jsonl_path = tmp_path / "out" / "telemetry.jsonl"
+    prometheus_path = tmp_path / "out" / "llm.prom"
+    LLM_Telemetry.configure_telemetry(str(jsonl_path), str(prometheus_path))
+
+    with LLM_Telemetry.telemetry_context(task='say "hi"', stage="generate"):
+        LLM_Telemetry.record_llm_call({"model": "m", "output_tokens": 50}, FINAL_RESPONSE)
+        LLM_Telemetry.record_llm_call({"model": "m", "output_tokens": 10, "cached": True})
+
+    records = [json.loads(line) for line in jsonl_path.read_text(encoding="utf-8").splitlines()]
+    assert [r["output_tokens"] for r in records] == [50, 10]
+    assert records[0]["task"] == 'say "hi"'
+
+    text = prometheus_path.read_text(encoding="utf-8")
+    labels = 'model="m",task="say \\"hi\\"",stage="generate"'
+    assert "# TYPE llm_requests_total counter" in text
+    assert f"llm_requests_total{{{labels}}} 2" in text
+    assert f"llm_cache_hits_total{{{labels}}} 1" in text
+    assert f"llm_output_tokens_total{{{labels}}} 60" in text
+    assert f"llm_prompt_tokens_total{{{labels}}} 200" in text
+    assert not list(prometheus_path.parent.glob("*.tmp"))
@@ -0,0 +1,115 @@
+import os
+import sys
+import json
+import asyncio
+
+import pytest
+
+# --- パス設定 ---
+source_directory = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(source_directory, "..", ".."))
+sys.path.insert(0, project_root)
+
+from Sources.Common import LLM_Telemetry
+from Sources.Common import LLM_Trace
+
+
+@pytest.fixture
+def trace(tmp_path):
+    """テストごとに記録を開始し、終了後に停止する"""
+    output_path = tmp_path / "trace" / "trace.json"
+    LLM_Trace.start_trace(str(output_path))
+    yield output_path
+    LLM_Trace.stop_trace()
+
+def _event(name, ts, dur, category="llm", tid=1):
+    return {"name": name, "cat": category, "ph": "X", "ts": ts, "dur": dur, "pid": 1, "tid": tid, "args": {}}
+
+
+def test_span_records_nothing_when_disabled():
+    LLM_Trace.stop_trace()
+    with LLM_Trace.span("ignored") as fields:
+        assert fields is None
+
+def test_nested_spans_with_context_and_args(trace):
+    with LLM_Telemetry.telemetry_context(task="t1"):
+        with LLM_Trace.span("outer", "task", source="a.txt") as fields:
+            fields["chunks"] = 3
+            with LLM_Trace.span("inner", "llm"):
+                pass
+    inner, outer = LLM_Trace.get_events()
+    assert (inner["name"], outer["name"]) == ("inner", "outer")
+    assert outer["args"] == {"task": "t1", "source": "a.txt", "chunks": 3}
+    assert outer["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+    assert inner["tid"] == outer["tid"]
+
+def test_span_records_errors_and_reraises(trace):
+    with pytest.raises(ValueError):
+        with LLM_Trace.span("failing"):
+            raise ValueError("bad input")
+    (event,) = LLM_Trace.get_events()
+    assert event["args"]["error"] == "ValueError: bad input"
+
+def test_long_args_are_truncated(trace):
+    with LLM_Trace.span("long", text="x" * 1000, value=1.5):
+        pass
+    (event,) = LLM_Trace.get_events()
+    assert len(event["args"]["text"]) == LLM_Trace.TRACE_ARG_MAX_LENGTH + 1
+    assert event["args"]["value"] == 1.5
+
+def test_traced_sync_and_async_functions(trace):
+    @LLM_Trace.traced("sync_call", "function", arg_names=("model_name",))
+    def sync_call(prompt, model_name="m"):
+        return prompt.upper()
+
+    @LLM_Trace.traced(category="llm")
+    async def async_call(value):
+        await asyncio.sleep(0)
+        return value * 2
+
+    async def run_async():
+        return await asyncio.gather(async_call(1), async_call(2))
+
+    assert sync_call("abc", model_name="qwen") == "ABC"
+    assert asyncio.run(run_async()) == [2, 4]
+    events = LLM_Trace.get_events()
+    assert [e["name"] for e in events] == ["sync_call", "async_call", "async_call"]
+    assert events[0]["args"] == {"model_name": "qwen"}
+    # 並行した asyncio タスクは別のトラックに記録される
+    assert events[1]["tid"] != events[2]["tid"]
+
+def test_summarize_trace_finds_idle_gaps():
+    events = [
+        _event("task", 0, 10_000, category="task"),
+        _event("llm1", 1_000, 2_000),
+        _event("llm2", 2_000, 2_000, tid=2),
+        _event("llm3", 7_000, 1_000),
+    ]
+    summary = LLM_Trace.summarize_trace(events)
+    assert summary["wall_ms"] == pytest.approx(10.0)
+    assert summary["busy_ms"] == pytest.approx(4.0)
+    assert summary["idle_ms"] == pytest.approx(6.0)
+    assert [(g["start_ms"], g["duration_ms"]) for g in summary["gaps"]] == [(4.0, 3.0), (8.0, 2.0), (0.0, 1.0)]
+    assert "空き 0.00s" in LLM_Trace.format_trace_summary(summary)
+
+def test_summarize_empty_trace():
+    assert LLM_Trace.summarize_trace([]) == {"wall_ms": 0.0, "busy_ms": 0.0, "idle_ms": 0.0, "gaps": []}
+    assert LLM_Trace.format_trace_summary(LLM_Trace.summarize_trace([])) == "記録なし"
+
+def test_save_trace_writes_chrome_trace_json(trace):
+    with LLM_Trace.span("request", "llm"):
+        pass
+    assert LLM_Trace.save_trace() == str(trace)
+    data = json.loads(trace.read_text(encoding="utf-8"))
+    metadata = [e for e in data["traceEvents"] if e["ph"] == "M"]
+    spans = [e for e in data["traceEvents"] if e["ph"] == "X"]
+    assert {e["name"] for e in metadata} >= {"process_name", "thread_name"}
+    assert [e["name"] for e in spans] == ["request"]
+    assert not list(trace.parent.glob("*.tmp"))
+
+def test_save_trace_without_output_path():
+    LLM_Trace.start_trace()
+    try:
+        assert LLM_Trace.save_trace() is None
+    finally:
+        LLM_Trace.stop_trace()